@@ -45,21 +45,29 @@ if 'bpy' in locals():
     importlib.reload(nvb.nvb_ops_anim)
     importlib.reload(nvb.nvb_ui)
 else:
-    from kotorblender.nvb import nvb_def
-    from kotorblender.nvb import nvb_utils
-    from kotorblender.nvb import nvb_io
-    from kotorblender.nvb import nvb_mdl
-    from kotorblender.nvb import nvb_node
-    from kotorblender.nvb import nvb_anim
-    from kotorblender.nvb import nvb_animnode
-
-    from kotorblender.nvb import nvb_props
-    from kotorblender.nvb import nvb_ops
-    from kotorblender.nvb import nvb_ops_anim
-    from kotorblender.nvb import nvb_ui
-
-import bpy
-import addon_utils
+    try:
+        import bpy
+    except ImportError:
+        # Not running in Blender. The add-on can't be registered, but the
+        # nvb modules reading and writing files may still be imported.
+        bpy = None
+
+    if bpy is not None:
+        from kotorblender.nvb import nvb_def
+        from kotorblender.nvb import nvb_utils
+        from kotorblender.nvb import nvb_io
+        from kotorblender.nvb import nvb_mdl
+        from kotorblender.nvb import nvb_node
+        from kotorblender.nvb import nvb_anim
+        from kotorblender.nvb import nvb_animnode
+
+        from kotorblender.nvb import nvb_props
+        from kotorblender.nvb import nvb_ops
+        from kotorblender.nvb import nvb_ops_anim
+        from kotorblender.nvb import nvb_ui
+
+if bpy is not None:
+    import addon_utils
 #import bpy_extras
 
 
@@ -0,0 +1,314 @@
+"""Convert and validate models and walkmeshes without Blender.
+
+Usage: python -m kotorblender.batch [options] PATH [PATH ...]
+
+PATH is a file, a directory (searched recursively) or a glob of mdl, wok,
+pwk and dwk files, ascii or binary. Every file is parsed and validated,
+with --output the result is written as binary mdl/mdx or walkmesh into
+that directory. Unchanged inputs are skipped on the next run.
+"""
+import argparse
+import collections
+import concurrent.futures
+import csv
+import glob
+import json
+import os
+import sys
+import time
+
+from .nvb import nvb_def
+from .nvb import nvb_mdl
+from .nvb import nvb_binmdl
+from .nvb import nvb_binwok
+from .nvb import nvb_cache
+from .nvb import nvb_utils
+
+
+FILE_TYPES = ('mdl', 'wok', 'pwk', 'dwk')
+
+# Remembers the inputs converted by previous runs, in the output directory
+MANIFEST_NAME = '.kotorblender-batch.json'
+
+REPORT_FIELDS = ['input', 'status', 'seconds', 'outputs', 'message']
+
+Job = collections.namedtuple('Job', ['path', 'fileType', 'name', 'outputDir',
+                                     'tsl'])
+
+
+def getFileType(path):
+    '''
+    Return the type of a model or walkmesh file (mdl, wok, pwk or dwk) and
+    its name without extensions, or (None, None) for anything else.
+    '''
+    (root, ext) = os.path.splitext(os.path.basename(path))
+    if ext.lower() == '.ascii':
+        (root, ext) = os.path.splitext(root)
+    fileType = ext[1:].lower()
+    if fileType not in FILE_TYPES:
+        return None, None
+    return fileType, root
+
+
+def findInputs(patterns):
+    '''
+    Yield (path, base directory) for all model and walkmesh files matching
+    patterns, the base directory is used to mirror the layout of the input
+    in the output directory.
+    '''
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for (dirpath, dirnames, filenames) in os.walk(pattern):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if getFileType(filename)[0]:
+                        yield os.path.join(dirpath, filename), pattern
+        else:
+            for path in sorted(glob.glob(pattern)):
+                if os.path.isfile(path) and getFileType(path)[0]:
+                    yield path, os.path.dirname(path)
+
+
+def getSources(job):
+    '''
+    Return all files the result of job depends on.
+    '''
+    sources = [job.path]
+    if job.fileType == 'mdl' and nvb_binmdl.isBinaryMdl(job.path):
+        mdxPath = nvb_binmdl.getMdxPath(job.path)
+        if os.path.isfile(mdxPath):
+            sources.append(mdxPath)
+    return sources
+
+
+def validateMdl(mdl):
+    '''
+    Check the node hierarchy the way the importer does, raises
+    nvb_def.MalformedMdlFile for the first problem found.
+    '''
+    nodes = list(mdl.nodeDict.values())
+    if not nodes:
+        raise nvb_def.MalformedMdlFile('Unable to find geometry')
+    root = nodes[0]
+    if root.nodetype != nvb_def.Nodetype.DUMMY or \
+       not nvb_utils.isNull(root.parentName):
+        raise nvb_def.MalformedMdlFile('First node has to be a dummy without a parent.')
+    names = set(node.name.lower() for node in nodes)
+    for node in nodes[1:]:
+        if nvb_utils.isNull(node.parentName):
+            raise nvb_def.MalformedMdlFile(node.name + ' has no parent.')
+        if node.parentName.lower() not in names:
+            raise nvb_def.MalformedMdlFile(node.name + ' has no parent ' + node.parentName)
+
+
+def loadWalkmesh(job):
+    '''
+    Return the walkmesh of job and the name of its model.
+    '''
+    wkm  = nvb_mdl.Xwk(job.fileType)
+    name = job.name
+    if nvb_binwok.isBinaryWalkmesh(job.path):
+        # Binary door walkmeshes are split into name0.dwk ... name2.dwk
+        state = None
+        if job.fileType == 'dwk' and name[-1:] in ('0', '1', '2'):
+            state = nvb_binwok.DOOR_STATES[int(name[-1])]
+            name  = name[:-1]
+        wkm.loadBinaryFiles([(job.path, state)], name)
+    else:
+        wkm.loadAsciiFile(job.path)
+    return wkm, name
+
+
+def convert(job):
+    '''
+    Parse, validate and write a single file. Runs in a worker process,
+    returns (status, seconds, output paths, message).
+    '''
+    start   = time.perf_counter()
+    outputs = []
+    try:
+        if job.fileType == 'mdl':
+            mdl = nvb_mdl.Mdl()
+            if nvb_binmdl.isBinaryMdl(job.path):
+                mdl.loadBinaryFile(job.path)
+            else:
+                mdl.loadAsciiFile(job.path)
+            validateMdl(mdl)
+            if job.outputDir:
+                (mdlData, mdxData) = nvb_binmdl.MdlWriter(mdl, job.tsl).write()
+                mdlPath = os.path.join(job.outputDir, job.name + '.mdl')
+                outputs.append((mdlPath, mdlData))
+                outputs.append((nvb_binmdl.getMdxPath(mdlPath), mdxData))
+        else:
+            (wkm, name) = loadWalkmesh(job)
+            walkmeshes = nvb_binwok.writeWalkmeshes(wkm)
+            if not walkmeshes:
+                raise nvb_def.MalformedMdlFile('No walkmesh found')
+            if job.outputDir:
+                for (suffix, data) in walkmeshes:
+                    outputs.append((os.path.join(
+                        job.outputDir, name + suffix + '.' + job.fileType), data))
+        if outputs:
+            os.makedirs(job.outputDir, exist_ok=True)
+        for (path, data) in outputs:
+            with open(path, 'wb') as f:
+                f.write(data)
+    except Exception as e:
+        message = '{}: {}'.format(type(e).__name__, e)
+        return 'error', time.perf_counter() - start, [], message
+    return 'ok', time.perf_counter() - start, [p for p, _ in outputs], ''
+
+
+class Manifest():
+    '''
+    Keys of the inputs converted into an output directory, an input is
+    skipped if its key and options are unchanged and its outputs exist.
+    '''
+    def __init__(self, outputDir):
+        self.path    = os.path.join(outputDir, MANIFEST_NAME) if outputDir else None
+        self.entries = dict()
+        self.keyer   = nvb_cache.ParseCache()
+        if self.path and os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print('Kotorblender - WARNING: Ignoring invalid ' + self.path)
+
+    def key(self, job):
+        return self.keyer.key(getSources(job), (job.fileType, job.tsl))
+
+    def isCurrent(self, job, key):
+        if self.path is None:
+            return False
+        entry = self.entries.get(os.path.abspath(job.path))
+        return entry is not None and entry[0] == key and \
+            all(os.path.isfile(p) for p in entry[1])
+
+    def update(self, job, key, outputs):
+        self.entries[os.path.abspath(job.path)] = [key, outputs]
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmpPath, self.path)
+
+
+def run(patterns, outputDir = '', workers = 0, tsl = False, force = False,
+        report = None, verbose = False):
+    '''
+    Convert all files matching patterns, return a Counter of the results.
+    report is an open file receiving one csv row per input.
+    '''
+    manifest = Manifest(outputDir)
+    writer   = None
+    if report is not None:
+        writer = csv.DictWriter(report, REPORT_FIELDS)
+        writer.writeheader()
+    counts = collections.Counter()
+
+    def record(job, status, seconds, outputs, message):
+        counts[status] += 1
+        if writer is not None:
+            writer.writerow({'input': job.path, 'status': status,
+                             'seconds': '{:.4f}'.format(seconds),
+                             'outputs': ' '.join(outputs),
+                             'message': message})
+            report.flush()
+        if status == 'error' or verbose:
+            print('{}: {} {}'.format(status, job.path, message).rstrip())
+
+    def jobs():
+        for (path, base) in findInputs(patterns):
+            (fileType, name) = getFileType(path)
+            jobOutputDir = ''
+            if outputDir:
+                relDir = os.path.relpath(os.path.dirname(path), base or '.')
+                jobOutputDir = os.path.normpath(os.path.join(outputDir, relDir))
+            yield Job(path, fileType, name, jobOutputDir, tsl)
+
+    def pending():
+        # Skip unchanged inputs before they ever reach a worker
+        for job in jobs():
+            try:
+                key = manifest.key(job)
+            except OSError as e:
+                record(job, 'error', 0.0, [], str(e))
+                continue
+            if not force and manifest.isCurrent(job, key):
+                record(job, 'skipped', 0.0, [], '')
+                continue
+            yield job, key
+
+    def done(job, key, result):
+        record(job, *result)
+        if result[0] == 'ok' and outputDir:
+            manifest.update(job, key, result[2])
+
+    try:
+        if workers < 2:
+            for (job, key) in pending():
+                done(job, key, convert(job))
+        else:
+            # Keep only a few jobs per worker in flight, so memory stays
+            # flat no matter how many files there are
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                inFlight = dict()
+                for (job, key) in pending():
+                    inFlight[executor.submit(convert, job)] = (job, key)
+                    if len(inFlight) >= workers * 4:
+                        (finished, _) = concurrent.futures.wait(
+                            inFlight, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in finished:
+                            done(*inFlight.pop(future), future.result())
+                for future in concurrent.futures.as_completed(inFlight):
+                    done(*inFlight[future], future.result())
+    finally:
+        manifest.save()
+    return counts
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog='python -m kotorblender.batch',
+        description='Validate and convert KotOR models and walkmeshes to '
+                    'binary, without Blender.')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='files, directories or globs of mdl, wok, pwk '
+                             'and dwk files (ascii or binary)')
+    parser.add_argument('-o', '--output', default='',
+                        help='write binary files into this directory, '
+                             'only validate if omitted')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--tsl', action='store_true',
+                        help='write models for TSL instead of KotOR')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='convert unchanged inputs again')
+    parser.add_argument('-r', '--report',
+                        help='write a csv report with the timing and errors '
+                             'of every input')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print every input, not only errors')
+    args = parser.parse_args(argv)
+
+    report = open(args.report, 'w', newline='') if args.report else None
+    start  = time.perf_counter()
+    try:
+        counts = run(args.paths, args.output, args.jobs, args.tsl,
+                     args.force, report, args.verbose)
+    finally:
+        if report is not None:
+            report.close()
+    print('{} ok, {} skipped, {} errors in {:.2f}s'.format(
+        counts['ok'], counts['skipped'], counts['error'],
+        time.perf_counter() - start))
+    return 1 if counts['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""Benchmarks for parsing, scene building, export and aabb generation.
+
+Usage: python -m kotorblender.bench generate [--scale S] DIR
+       python -m kotorblender.bench run [-n REPEAT] [-o RESULTS.json] DIR
+       python -m kotorblender.bench compare OLD.json NEW.json
+
+Scene build and export are only timed inside Blender, e.g.
+
+    blender --background --python-expr "import kotorblender.bench as b; b.main()" -- run DIR
+
+Results are written as json, compare two of them (e.g. from different
+commits) to spot regressions.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from . import corpus
+from . import scenarios
+
+
+def getMeta():
+    '''
+    Return information about the environment the benchmark ran in.
+    '''
+    meta = {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    try:
+        meta['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        meta['commit'] = None
+    try:
+        import numpy
+        meta['numpy'] = numpy.__version__
+    except ImportError:
+        meta['numpy'] = None
+    if scenarios.bpy is not None:
+        meta['blender'] = scenarios.bpy.app.version_string
+    return meta
+
+
+def timeScenario(scenario, path, repeat):
+    '''
+    Return the timings of repeat runs of scenario on path in seconds.
+    '''
+    run = scenario(path)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run(directory, repeat = 3, select = '*', verbose = True):
+    '''
+    Run all available scenarios on the corpus in directory, return the
+    results as a dict, ready to be written as json.
+    '''
+    scenarios.prepare()
+    paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+    results = dict()
+    for (name, scenario, extensions) in scenarios.available():
+        for path in paths:
+            if os.path.splitext(path)[1] not in extensions:
+                continue
+            key = name + '/' + os.path.basename(path)
+            if not fnmatch.fnmatch(key, select):
+                continue
+            timings = timeScenario(scenario, path, repeat)
+            results[key] = {'min': min(timings),
+                            'median': statistics.median(timings),
+                            'repeat': repeat}
+            if verbose:
+                print('{:<40} {:10.4f}s'.format(key, results[key]['min']))
+    return {'meta': getMeta(), 'results': results}
+
+
+def compare(old, new, threshold = 0.1):
+    '''
+    Print the ratio of new to old minimum timings, return the keys which
+    got slower by more than threshold.
+    '''
+    regressions = []
+    for key in sorted(set(old['results']) | set(new['results'])):
+        if key not in old['results'] or key not in new['results']:
+            print('{:<40} {}'.format(key, 'only in new' if key in new['results']
+                                                        else 'only in old'))
+            continue
+        oldTime = old['results'][key]['min']
+        newTime = new['results'][key]['min']
+        ratio   = newTime / oldTime if oldTime else float('inf')
+        flag    = ''
+        if ratio > 1.0 + threshold:
+            flag = '  SLOWER'
+            regressions.append(key)
+        elif ratio < 1.0 - threshold:
+            flag = '  faster'
+        print('{:<40} {:10.4f}s {:10.4f}s {:6.2f}x{}'.format(
+            key, oldTime, newTime, ratio, flag))
+    return regressions
+
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+        # Inside Blender the arguments for us follow a '--'
+        if '--' in sys.argv:
+            argv = sys.argv[sys.argv.index('--') + 1:]
+    parser = argparse.ArgumentParser(
+        prog='python -m kotorblender.bench',
+        description='Time model parsing, scene building and export on a '
+                    'synthetic corpus.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    generateParser = commands.add_parser('generate', help='write the corpus')
+    generateParser.add_argument('directory')
+    generateParser.add_argument('--scale', type=float, default=1.0,
+                                help='size of the models, 1.0 is a 20k face '
+                                     'walkmesh (default: %(default)s)')
+    generateParser.add_argument('--seed', type=int, default=1)
+
+    runParser = commands.add_parser('run', help='time the scenarios')
+    runParser.add_argument('directory')
+    runParser.add_argument('-n', '--repeat', type=int, default=3)
+    runParser.add_argument('-k', '--select', default='*',
+                           help='only run scenario/file keys matching this '
+                                'pattern, e.g. "parse_*"')
+    runParser.add_argument('-o', '--output', help='write the results as json')
+
+    compareParser = commands.add_parser('compare',
+                                        help='compare two result files')
+    compareParser.add_argument('old')
+    compareParser.add_argument('new')
+    compareParser.add_argument('--threshold', type=float, default=0.1,
+                               help='relative slowdown reported as a '
+                                    'regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        for path in corpus.generate(args.directory, args.scale, args.seed):
+            print(path)
+        return 0
+    if args.command == 'run':
+        results = run(args.directory, args.repeat, args.select)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+    with open(args.old, 'r') as f:
+        old = json.load(f)
+    with open(args.new, 'r') as f:
+        new = json.load(f)
+    return 1 if compare(old, new, args.threshold) else 0
@@ -0,0 +1,8 @@
+import sys
+
+from . import main
+
+
+# Spawned worker processes import the main module again
+if __name__ == '__main__':
+    sys.exit(main())
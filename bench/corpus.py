@@ -0,0 +1,260 @@
+"""Generator of synthetic ascii models and walkmeshes for benchmarks.
+
+The models are random but shaped like game assets: dense trimeshes,
+skinmeshes weighted to a deep skeleton, danglymeshes, emitters, a
+supermodel with many animations and an area walkmesh. The same seed and
+scale always produce the same files.
+"""
+import math
+import os
+import random
+
+from ..nvb import nvb_aabb
+
+
+EMITTER_PARAMS = [
+    ('update', 'Fountain'), ('render', 'Normal'), ('blend', 'Normal'),
+    ('texture', 'fx_spark'), ('spawntype', '0'), ('xgrid', '4'),
+    ('ygrid', '4'), ('deadspace', '0.0'), ('loop', '1'),
+]
+
+EMITTER_CONTROLLERS = [
+    ('birthrate', 1), ('lifeExp', 1), ('velocity', 1), ('spread', 1),
+    ('sizeStart', 1), ('sizeEnd', 1), ('alphaStart', 1), ('alphaEnd', 1),
+    ('colorStart', 3), ('colorEnd', 3), ('mass', 1), ('fps', 1),
+]
+
+
+def fmt(values):
+    return ' '.join('{:.6g}'.format(v) for v in values)
+
+
+class ModelBuilder():
+    '''
+    Collects the lines of an ascii mdl.
+    '''
+    def __init__(self, name, rnd, classification = 'Character'):
+        self.name  = name
+        self.rnd   = rnd
+        self.lines = ['# Synthetic benchmark model',
+                      'newmodel ' + name,
+                      'setsupermodel {} NULL'.format(name),
+                      'classification ' + classification,
+                      'setanimationscale 1',
+                      'beginmodelgeom ' + name,
+                      'node dummy ' + name,
+                      '  parent NULL',
+                      'endnode']
+
+    def dummy(self, name, parent, position = (0.0, 0.0, 0.0)):
+        self.lines += ['node dummy ' + name,
+                       '  parent ' + parent,
+                       '  position ' + fmt(position),
+                       'endnode']
+
+    def grid(self, size, spacing = 0.1):
+        '''
+        Return verts, tverts and faces of a size x size vertex grid, with
+        some noise in z.
+        '''
+        rnd    = self.rnd
+        verts  = [(x * spacing, y * spacing, rnd.uniform(-0.05, 0.05))
+                  for y in range(size) for x in range(size)]
+        tverts = [(x / (size - 1), y / (size - 1))
+                  for y in range(size) for x in range(size)]
+        faces  = []
+        for y in range(size - 1):
+            for x in range(size - 1):
+                v0 = y * size + x
+                v1 = v0 + 1
+                v2 = v0 + size
+                v3 = v2 + 1
+                faces.append((v0, v1, v3))
+                faces.append((v3, v2, v0))
+        return verts, tverts, faces
+
+    def meshBody(self, verts, tverts, faces, bitmap, matIds = None):
+        lines = ['  bitmap ' + bitmap,
+                 '  ambient 0.2 0.2 0.2',
+                 '  diffuse 0.8 0.8 0.8',
+                 '  render 1',
+                 '  shadow 1',
+                 '  verts {}'.format(len(verts))]
+        lines += ['    ' + fmt(v) for v in verts]
+        lines.append('  faces {}'.format(len(faces)))
+        for idx, f in enumerate(faces):
+            matId = matIds[idx] if matIds else 1
+            lines.append('    {0} {1} {2} {3} {0} {1} {2} {4}'.format(
+                f[0], f[1], f[2], 1 << (idx % 4), matId))
+        if tverts:
+            lines.append('  tverts {}'.format(len(tverts)))
+            lines += ['    ' + fmt(t) for t in tverts]
+        return lines
+
+    def trimesh(self, name, parent, size):
+        verts, tverts, faces = self.grid(size)
+        self.lines += ['node trimesh ' + name, '  parent ' + parent]
+        self.lines += self.meshBody(verts, tverts, faces, name + '_tex')
+        self.lines.append('endnode')
+
+    def danglymesh(self, name, parent, size):
+        verts, tverts, faces = self.grid(size)
+        self.lines += ['node danglymesh ' + name,
+                       '  parent ' + parent,
+                       '  period 2.5', '  tightness 3', '  displacement 0.1']
+        self.lines += self.meshBody(verts, tverts, faces, name + '_tex')
+        self.lines.append('  constraints {}'.format(len(verts)))
+        # Fixed at the top row, free at the bottom
+        self.lines += ['    {:.1f}'.format(255.0 * (idx // size) / (size - 1))
+                       for idx in range(len(verts))]
+        self.lines.append('endnode')
+
+    def skinmesh(self, name, parent, size, bones):
+        verts, tverts, faces = self.grid(size)
+        self.lines += ['node skin ' + name, '  parent ' + parent]
+        self.lines += self.meshBody(verts, tverts, faces, name + '_tex')
+        self.lines.append('  weights {}'.format(len(verts)))
+        rnd = self.rnd
+        for _ in verts:
+            influences = rnd.sample(bones, min(len(bones), rnd.randint(1, 4)))
+            weights = [rnd.random() + 0.1 for _ in influences]
+            total = sum(weights)
+            self.lines.append('    ' + ' '.join(
+                '{} {:.4f}'.format(b, w / total) for b, w in zip(influences, weights)))
+        self.lines.append('endnode')
+
+    def emitter(self, name, parent):
+        rnd = self.rnd
+        self.lines += ['node emitter ' + name,
+                       '  parent ' + parent,
+                       '  position ' + fmt((rnd.uniform(-1, 1), rnd.uniform(-1, 1), 1.0))]
+        self.lines += ['  {} {}'.format(k, v) for k, v in EMITTER_PARAMS]
+        for label, numVals in EMITTER_CONTROLLERS:
+            self.lines.append('  {} {}'.format(
+                label, fmt(rnd.uniform(0, 10) for _ in range(numVals))))
+        self.lines.append('endnode')
+
+    def animation(self, name, nodes, numKeys, length = 2.0):
+        rnd = self.rnd
+        self.lines += ['newanim {} {}'.format(name, self.name),
+                       '  length {}'.format(length),
+                       '  transtime 0.25',
+                       '  animroot ' + self.name,
+                       '  event {:.3f} snd_footstep'.format(length / 2)]
+        times = [length * k / max(1, numKeys - 1) for k in range(numKeys)]
+        for (nodeName, parent) in nodes:
+            self.lines += ['  node dummy ' + nodeName, '    parent ' + parent]
+            self.lines.append('    positionkey {}'.format(numKeys))
+            self.lines += ['      {:.4f} {}'.format(t, fmt(rnd.uniform(-0.1, 0.1) for _ in range(3)))
+                           for t in times]
+            self.lines.append('    orientationkey {}'.format(numKeys))
+            for t in times:
+                axis  = [rnd.uniform(-1, 1) for _ in range(3)]
+                scale = math.sqrt(sum(a * a for a in axis)) or 1.0
+                self.lines.append('      {:.4f} {} {:.5f}'.format(
+                    t, fmt(a / scale for a in axis), rnd.uniform(-3.1, 3.1)))
+            self.lines.append('  endnode')
+        self.lines.append('doneanim {} {}'.format(name, self.name))
+
+    def finish(self):
+        # Animations follow the geometry
+        geomEnd = next(idx for idx, line in enumerate(self.lines)
+                       if line.startswith('newanim'))  \
+            if any(l.startswith('newanim') for l in self.lines) else len(self.lines)
+        self.lines.insert(geomEnd, 'endmodelgeom ' + self.name)
+        self.lines.append('donemodel ' + self.name)
+        return '\n'.join(self.lines) + '\n'
+
+
+def skeleton(builder, numBones, root):
+    '''
+    Add a chain of bone dummies branching every few bones, return their
+    (name, parent) tuples.
+    '''
+    bones = []
+    parent = root
+    for idx in range(numBones):
+        name = 'bone{:03d}'.format(idx)
+        builder.dummy(name, parent, (0.0, 0.0, 0.1))
+        bones.append((name, parent))
+        # Start a new limb every eight bones
+        parent = root if idx % 8 == 7 else name
+    return bones
+
+
+def characterModel(rnd, scale):
+    builder  = ModelBuilder('bench_char', rnd)
+    numBones = max(4, int(60 * scale))
+    bones    = skeleton(builder, numBones, builder.name)
+    size     = max(4, int(60 * math.sqrt(scale)))
+    builder.skinmesh('body', builder.name, size, [b[0] for b in bones])
+    builder.danglymesh('cape', bones[0][0], max(4, size // 2))
+    builder.trimesh('head', bones[1][0], max(4, size // 3))
+    return builder.finish()
+
+
+def propModel(rnd, scale):
+    builder = ModelBuilder('bench_prop', rnd, 'Other')
+    # About 28k faces at scale 1. Neighbouring faces are in different
+    # smoothing groups, which splits most vertices four times in binary
+    # meshes, and those can't go beyond 64k vertices.
+    size    = max(4, min(120, int(120 * math.sqrt(scale))))
+    builder.trimesh('hull', builder.name, size)
+    for idx in range(max(1, int(8 * scale))):
+        builder.emitter('fx{:02d}'.format(idx), builder.name)
+    return builder.finish()
+
+
+def supermodel(rnd, scale):
+    builder  = ModelBuilder('bench_super', rnd)
+    numBones = max(4, int(60 * scale))
+    bones    = skeleton(builder, numBones, builder.name)
+    nodes    = [(builder.name, 'NULL')] + bones
+    for idx in range(max(2, int(100 * scale))):
+        builder.animation('anim{:03d}'.format(idx), nodes, max(2, int(20 * scale)))
+    return builder.finish()
+
+
+def areaWalkmesh(rnd, scale):
+    '''
+    Return an area model (mdl) with its aabb walkmesh, and the same mesh
+    as wok.
+    '''
+    name  = 'bench_area'
+    # 2 * (size - 1)^2 faces, about 20000 at scale 1
+    size  = max(4, int(101 * math.sqrt(scale)))
+    builder = ModelBuilder(name, rnd, 'Other')
+    verts, tverts, faces = builder.grid(size, 0.5)
+    # Mostly walkable, with some obstacles and grass
+    matIds = [rnd.choice((4, 4, 4, 3, 7)) for _ in faces]
+    tree = []
+    nvb_aabb.generateMeshTree(tree, verts, faces)
+    body = ['  parent ' + name]
+    body += builder.meshBody(verts, None, faces, 'NULL', matIds)
+    body.append('  aabb ' + fmt(tree[0][:6]) + ' {}'.format(tree[0][6]))
+    body += ['    ' + fmt(node[:6]) + ' {}'.format(node[6]) for node in tree[1:]]
+    builder.lines += ['node aabb ' + name + '_wok'] + body + ['endnode']
+    mdl = builder.finish()
+    wok = '\n'.join(['# Synthetic benchmark walkmesh',
+                     'node aabb ' + name + '_wok'] + body + ['endnode']) + '\n'
+    return mdl, wok
+
+
+def generate(directory, scale = 1.0, seed = 1):
+    '''
+    Write the corpus into directory, return the paths of the written files.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    rnd = random.Random(seed)
+    files = [('bench_char.mdl', characterModel(rnd, scale)),
+             ('bench_prop.mdl', propModel(rnd, scale)),
+             ('bench_super.mdl', supermodel(rnd, scale))]
+    (areaMdl, areaWok) = areaWalkmesh(rnd, scale)
+    files += [('bench_area.mdl', areaMdl), ('bench_area.wok', areaWok)]
+    paths = []
+    for (filename, text) in files:
+        path = os.path.join(directory, filename)
+        with open(path, 'w') as f:
+            f.write(text)
+        paths.append(path)
+    return paths
@@ -0,0 +1,158 @@
+"""Timed benchmark scenarios.
+
+Every scenario is a function taking the path of a corpus file. It does its
+setup and returns a callable without arguments, which is what gets timed.
+Scenarios in BLENDER_SCENARIOS need bpy, the others run anywhere.
+"""
+import os
+import tempfile
+
+from ..nvb import nvb_glob
+from ..nvb import nvb_mdl
+from ..nvb import nvb_index
+from ..nvb import nvb_aabb
+from ..nvb import nvb_binmdl
+from ..nvb import nvb_binwok
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+
+def loadAscii(path):
+    if path.endswith('.wok'):
+        wkm = nvb_mdl.Xwk('wok')
+        wkm.loadAsciiFile(path)
+        return wkm
+    mdl = nvb_mdl.Mdl()
+    mdl.loadAsciiFile(path)
+    return mdl
+
+
+def parseAscii(path):
+    '''
+    Stream and parse the whole file.
+    '''
+    return lambda: loadAscii(path)
+
+
+def parseIndex(path):
+    '''
+    Index the file the way the importer does, then parse every node and
+    animation from the index.
+    '''
+    def run():
+        mdlIndex = nvb_index.MdlIndex(path)
+        try:
+            mdl = nvb_mdl.Mdl()
+            mdl.loadAsciiIndex(mdlIndex)
+            list(mdl.nodeDict.values())
+            list(mdl.animDict.values())
+        finally:
+            mdlIndex.close()
+    return run
+
+
+def writeBinary(path):
+    mdl = loadAscii(path)
+    return lambda: nvb_binmdl.MdlWriter(mdl).write()
+
+
+def parseBinary(path):
+    (mdlData, mdxData) = nvb_binmdl.MdlWriter(loadAscii(path)).write()
+    return lambda: nvb_mdl.Mdl().loadBinary(mdlData, mdxData)
+
+
+def aabbBuild(path):
+    wkm   = loadAscii(path)
+    mesh  = next(node for node in wkm.nodeDict.values() if node.nodetype == 'aabb')
+    verts = mesh.verts
+    faces = mesh.facelist.faces
+    return lambda: nvb_aabb.generateMeshTree([], verts, faces)
+
+
+def walkmeshBinary(path):
+    wkm = loadAscii(path)
+    return lambda: nvb_binwok.writeWalkmeshes(wkm)
+
+
+def clearScene():
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj, do_unlink=True)
+    for collection in (bpy.data.meshes, bpy.data.materials, bpy.data.textures,
+                       bpy.data.images, bpy.data.actions):
+        for block in list(collection):
+            if not block.users:
+                collection.remove(block)
+
+
+def importModel(path):
+    from ..nvb import nvb_io
+    nvb_io.loadMdl(None, bpy.context, filepath=path, parseCache=None)
+
+
+def sceneBuild(path):
+    '''
+    Import into an empty scene, as File > Import does.
+    '''
+    def run():
+        clearScene()
+        importModel(path)
+    return run
+
+
+def export(exportFormat):
+    def setup(path):
+        from ..nvb import nvb_io
+        clearScene()
+        importModel(path)
+        outPath = os.path.join(tempfile.mkdtemp(prefix='kb_bench'),
+                               os.path.basename(path))
+        return lambda: nvb_io.saveMdl(None, bpy.context, filepath=outPath,
+                                      exportFormat=exportFormat)
+    return setup
+
+
+# name: (scenario, file extensions it runs on)
+SCENARIOS = [
+    ('parse_ascii',     parseAscii,     ('.mdl', '.wok')),
+    ('parse_index',     parseIndex,     ('.mdl',)),
+    ('write_binary',    writeBinary,    ('.mdl',)),
+    ('parse_binary',    parseBinary,    ('.mdl',)),
+    ('aabb_build',      aabbBuild,      ('.wok',)),
+    ('walkmesh_binary', walkmeshBinary, ('.wok',)),
+]
+
+BLENDER_SCENARIOS = [
+    ('scene_build',   sceneBuild,          ('.mdl',)),
+    ('export_ascii',  export('ASCII'),     ('.mdl',)),
+    ('export_binary', export('BINARY_K1'), ('.mdl',)),
+]
+
+
+def available():
+    '''
+    Return the scenarios which can run in this interpreter.
+    '''
+    if bpy is None:
+        return list(SCENARIOS)
+    ensureAddon()
+    return SCENARIOS + BLENDER_SCENARIOS
+
+
+def ensureAddon():
+    '''
+    Register the add-on if Blender was started without it enabled.
+    '''
+    if hasattr(bpy.types.Object, 'nvb'):
+        return
+    import addon_utils
+    addon_utils.enable(__package__.partition('.')[0], default_set=False)
+
+
+def prepare():
+    # Same options as a default import
+    nvb_glob.importAnim         = True
+    nvb_glob.importGeometry     = True
+    nvb_glob.importSmoothGroups = True
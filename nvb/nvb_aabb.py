@@ -1,4 +1,5 @@
-import mathutils
+"""Generation of axis aligned bounding box trees for walkmeshes."""
+
 
 def generateTree(aabb_tree, face_list, rlevel = 0):
 
@@ -12,9 +13,11 @@ def generateTree(aabb_tree, face_list, rlevel = 0):
         return
 
     # Calculate Bounding box centers and min/max coordinates
-    bb_min         = mathutils.Vector(( 100000.0,  100000.0,  100000.0))
-    bb_max         = mathutils.Vector((-100000.0, -100000.0, -100000.0))
-    bb_avgcentroid = mathutils.Vector((0.0, 0.0, 0.0))
+    # Plain lists, face vertices and centroids may be any sequences,
+    # e.g. tuples or mathutils vectors
+    bb_min         = [ 100000.0,  100000.0,  100000.0]
+    bb_max         = [-100000.0, -100000.0, -100000.0]
+    bb_avgcentroid = [0.0, 0.0, 0.0]
     for face in face_list:
         face_vertices = face[1]
         # Every vertex in the face
@@ -23,38 +26,37 @@ def generateTree(aabb_tree, face_list, rlevel = 0):
             for ax in range(3):
                 # First the min
                 if bb_min[ax] > vertex[ax]:
-                    bb_min[ax] = vertex[ax]
+                    bb_min[ax] = float(vertex[ax])
                 # Then the max
                 if bb_max[ax] < vertex[ax]:
-                     bb_max[ax] = vertex[ax]
+                     bb_max[ax] = float(vertex[ax])
 
         face_centroid = face[2]
-        bb_avgcentroid = bb_avgcentroid + face_centroid
-
-    bb_avgcentroid = bb_avgcentroid / len(face_list)
+        for ax in range(3):
+            bb_avgcentroid[ax] += face_centroid[ax]
 
-    bb_centroid = (bb_min + bb_max) /2
+    bb_avgcentroid = [c / len(face_list) for c in bb_avgcentroid]
 
     if (len(face_list) == 1):
         # Only one face left in face list
         # This node is a leaf, save the face in the leaf
         linked_face_idx = face_list[0][0]
-        aabb_treenode = [bb_min.x, bb_min.y, bb_min.z, bb_max.x, bb_max.y, bb_max.z, linked_face_idx]
+        aabb_treenode = bb_min + bb_max + [linked_face_idx]
         aabb_tree.append(aabb_treenode)
     else:
         # This is a node in the tree
         linked_face_idx = -1 # -1 indicates nodes
-        aabb_treenode = [bb_min.x, bb_min.y, bb_min.z, bb_max.x, bb_max.y, bb_max.z, linked_face_idx]
+        aabb_treenode = bb_min + bb_max + [linked_face_idx]
         aabb_tree.append(aabb_treenode)
 
         # Size of bounding box
-        bb_size = bb_max - bb_min
+        bb_size = [bb_max[ax] - bb_min[ax] for ax in range(3)]
 
         # Longest axis of bounding box
         split_axis = 0 # x
-        if (bb_size.y > bb_size.x):
+        if (bb_size[1] > bb_size[0]):
             split_axis = 1 # y
-        if (bb_size.z > bb_size.y):
+        if (bb_size[2] > bb_size[1]):
             split_axis = 2 # z
 
         # Change axis in case points are coplanar with
@@ -111,3 +113,13 @@ def generateTree(aabb_tree, face_list, rlevel = 0):
 
         generateTree(aabb_tree, face_list_left, rlevel+1)
         generateTree(aabb_tree, face_list_right, rlevel+1)
+
+
+def generateMeshTree(aabb_tree, verts, faces):
+    """Generate the tree for triangles given as indices into verts."""
+    face_list = []
+    for face_idx, face in enumerate(faces):
+        face_vertices = [tuple(verts[v]) for v in face]
+        centroid = [sum(co) / 3 for co in zip(*face_vertices)]
+        face_list.append((face_idx, face_vertices, centroid))
+    generateTree(aabb_tree, face_list)
@@ -1,7 +1,11 @@
 """TODO: DOC."""
 
 import collections
-import bpy
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
 
 from . import nvb_def
 from . import nvb_utils
@@ -16,11 +20,12 @@ class Animation():
         self.length    = 1.0
         self.transtime = 1.0
         self.root      = nvb_def.null
-        self.eventList = []
+        self.animroot  = ''
         self.nodeList  = collections.OrderedDict()
 
         self.nodes = []
         self.events = []
+        self.eventList = self.events
 
         if ascii_data:
             self.loadAscii(ascii_data)
@@ -83,9 +88,13 @@ class Animation():
         else:
             return None
 
-    def addAsciiNode(self, asciiBlock):
-        node = nvb_animnode.Node()
-        node.loadAscii(asciiBlock)
+    def addAsciiNode(self, asciiBlock, nodeidx = -1):
+        node = nvb_animnode.Animnode()
+        node.load_ascii(asciiBlock, nodeidx)
+        self.addNode(node)
+
+    def addNode(self, node):
+        self.nodes.append(node)
         key  = node.parentName + node.name
         if key in self.nodeList:
             #TODO: Should probably raise an exception
@@ -94,7 +103,7 @@ class Animation():
             self.nodeList[key] = node
 
     def addEvent(self, event):
-        self.eventList.append(event)
+        self.events.append(event)
 
 
     def addEventsToObject(self, rootDummy):
@@ -106,81 +115,50 @@ class Animation():
     def getAnimFromScene(self, scene, rootDummyName = ''):
         pass
 
-    def getAnimFromAscii(self, asciiBlock):
-        blockStart = -1
-        for idx, line in enumerate(asciiBlock):
-            try:
-                label = line[0].lower()
-            except IndexError:
-                # Probably empty line or whatever, skip it
-                continue
-            if (label == 'newanim'):
-                self.name = nvb_utils.getName(line[1])
-            elif (label == 'length'):
-                self.length = float(line[1])
-            elif (label == 'transtime'):
-                self.transtime = float(line[1])
-            elif (label == 'animroot'):
-                try:
-                    self.root = line[1]
-                except:
-                    self.root = 'undefined'
-            elif (label == 'event'):
-                self.addEvent((float(line[1]), line[2]))
-            elif (label == 'eventlist'):
-                numEvents = next((i for i, v in enumerate(asciiBlock[idx+1:]) if not nvb_utils.isNumber(v[0])), -1)
-                list(map(self.addEvent, ((float(v[0]), v[1]) for v in asciiBlock[idx+1:idx+1+numEvents])))
-            elif (label == 'node'):
-                blockStart = idx
-            elif (label == 'endnode'):
-                if (blockStart > 0):
-                    self.addAsciiNode(asciiBlock[blockStart:idx+1])
-                    blockStart = -1
-                elif (label == 'node'):
-                    raise nvb_def.MalformedMdlFile('Unexpected "endnode"')
-
-    def loadAscii(self, ascii_data):
-        self.getAnimFromAscii([l.strip().split() for l in ascii_data.splitlines()])
-        """Load an animation from a block from an ascii mdl file."""
-        animNodesStart = ascii_data.find('node ')
-        if (animNodesStart > -1):
-            self.loadAsciiAnimHeader(ascii_data[:animNodesStart-1])
-            self.loadAsciiAnimNodes(ascii_data[animNodesStart:])
-        else:
-            print('Neverblender - WARNING: Failed to load an animation.')
+    def loadAscii(self, ascii_lines):
+        """Load an animation from a block of tokenized ascii mdl lines.
 
-
-    def loadAsciiAnimHeader(self, ascii_data):
-        """TODO: DOC."""
-        ascii_lines = [l.strip().split() for l in ascii_data.splitlines()]
-        for line in ascii_lines:
+        Header, events and the nodes' controllers are read in a single pass.
+        """
+        l_float = float
+        l_isNumber = nvb_utils.isNumber
+        nodeStart = -1
+        nodeIdx = 0
+        for idx, line in enumerate(ascii_lines):
             try:
                 label = line[0].lower()
             except (IndexError, AttributeError):
                 continue  # Probably empty line, skip it
-            if (label == 'newanim'):
+            if (label == 'node'):
+                if (nodeStart > -1):
+                    self.addAsciiNode(ascii_lines[nodeStart:idx], nodeIdx)
+                    nodeIdx += 1
+                nodeStart = idx
+            elif (nodeStart > -1):
+                continue  # Part of the current node
+            elif (label == 'newanim'):
                 self.name = nvb_utils.str2identifier(line[1])
             elif (label == 'length'):
-                self.length = float(line[1])
+                self.length = l_float(line[1])
             elif (label == 'transtime'):
-                self.transtime = float(line[1])
+                self.transtime = l_float(line[1])
             elif (label == 'animroot'):
                 try:
+                    self.root = line[1]
                     self.animroot = line[1].lower()
                 except (ValueError, IndexError):
+                    self.root = 'undefined'
                     self.animroot = ''
             elif (label == 'event'):
-                self.events.append((float(line[1]), line[2]))
-
-    def loadAsciiAnimNodes(self, ascii_data):
-        """TODO: DOC."""
-        dlm = 'node '
-        node_list = [dlm + s for s in ascii_data.split(dlm) if s != '']
-        for idx, ascii_node in enumerate(node_list):
-            ascii_lines = [l.strip().split() for l in ascii_node.splitlines()]
-            node = nvb_animnode.Animnode()
-            node.load_ascii(ascii_lines, idx)
-            self.nodes.append(node)
+                self.addEvent((l_float(line[1]), line[2]))
+            elif (label == 'eventlist'):
+                numEvents = next((i for i, v in enumerate(ascii_lines[idx+1:]) if not l_isNumber(v[0])), -1)
+                for v in ascii_lines[idx+1:idx+1+numEvents]:
+                    self.addEvent((l_float(v[0]), v[1]))
+        if (nodeStart > -1):
+            self.addAsciiNode(ascii_lines[nodeStart:], nodeIdx)
+        else:
+            print('Neverblender - WARNING: Failed to load an animation.')
 
     def animNodeToAscii(self, bObject, asciiLines):
         node = nvb_animnode.Node()
@@ -244,6 +222,39 @@ class Animation():
         ascii_lines.append("doneanim {} {}".format(anim.name, animRootDummy.name))
         ascii_lines.append("")
 
+    def loadObjectNodes(self, obj, anim):
+        """Add the nodes of obj and its children, like generateAsciiNodes."""
+        node = nvb_animnode.Animnode()
+        if node.load_object(obj, anim, len(self.nodes)):
+            self.addNode(node)
+
+        children = [c for c in obj.children]
+        children.sort(key=lambda c: c.name)
+        children.sort(key=lambda c: c.nvb.imporder)
+        for c in children:
+            self.loadObjectNodes(c, anim)
+
+    def loadObjects(self, animRootDummy, anim):
+        """Load the animation anim of animRootDummy from its objects.
+
+        This takes the same data generateAscii writes, without the ascii.
+        """
+        fps = nvb_def.fps
+        self.name = nvb_utils.str2identifier(anim.name)
+        self.length = round((anim.frameEnd - anim.frameStart)/fps, 5)
+        self.transtime = round(anim.ttime, 3)
+        if anim.root:
+            self.root = anim.root
+            self.animroot = anim.root.lower()
+        else:
+            self.root = 'undefined'
+            self.animroot = ''
+        for event in anim.eventList:
+            event_time = (event.frame - anim.frameStart) / fps
+            self.addEvent((round(event_time, 3), event.name))
+
+        self.loadObjectNodes(animRootDummy, anim)
+
     def toAscii(self, animScene, animRootDummy, asciiLines, mdlName = ''):
         self.name      = animRootDummy.nvb.animname
         self.length    = nvb_utils.frame2nwtime(animScene.frame_end, animScene.render.fps)
@@ -1,79 +1,112 @@
 """TODO: DOC."""
 
-import mathutils
 import collections
-import bpy
 import re
 from math import sqrt,asin,cos
 
+try:
+    import bpy
+    import mathutils
+except ImportError:
+    bpy = mathutils = None
+
 from . import nvb_def
 from . import nvb_utils
 from . import nvb_parse
 
 
+# Returned for controllers without keys
+NO_KEYS = ()
+
+
+def packKeys(keys, numVals, conversion=None, name=''):
+    '''
+    Pack keys, each one a time followed by numVals values, into double
+    rows. Int controllers have their values truncated, but are stored as
+    floats like all others. Keys with too few values are skipped.
+    '''
+    if conversion is not int:
+        rows = nvb_parse.preparsedRows(keys, numVals + 1)
+        if rows is not None:
+            return rows
+    rows    = nvb_parse.Rows('d', numVals + 1)
+    l_float = float
+    l_int   = int
+    skipped = 0
+    for key in keys:
+        values = [l_float(v) for v in key[:numVals + 1]]
+        if len(values) != numVals + 1:
+            skipped += 1
+            continue
+        if conversion is int:
+            values[1:] = [l_float(l_int(v)) for v in values[1:]]
+        rows.append(values)
+    if skipped:
+        print('Kotorblender - WARNING: Skipped {:d} keys of {} with less than '
+              '{:d} values'.format(skipped, name or 'controller', numVals + 1))
+    return rows
+
+
 class Keys():
+    '''
+    Sparse store of the controllers of an animation node. Only controllers
+    with keys are stored, as packed rows of time and values, all others
+    read as an empty sequence, e.g. keys.position.
+    '''
+    __slots__ = ('controllers', '_rawascii')
+
     def __init__(self):
-        self.position       = []
-        self.orientation    = []
-        self.scale          = []
-        self.selfillumcolor = []
-        self.alpha          = []
-        # Lights/lamps
-        self.color  = []
-        self.radius = []
-        # Emitters
-        self.alphastart = []
-        self.alphamid = []
-        self.alphaend = []
-        self.birthrate = []
-        self.m_frandombirthrate = []
-        self.bounce_co = []
-        self.combinetime = []
-        self.drag = []
-        self.fps = []
-        self.frameend = []
-        self.framestart = []
-        self.grav = []
-        self.lifeexp = []
-        self.mass = []
-        self.p2p_bezier2 = []
-        self.p2p_bezier3 = []
-        self.particlerot = []
-        self.randvel = []
-        self.sizestart = []
-        self.sizemid = []
-        self.sizeend = []
-        self.sizestart_y = []
-        self.sizemid_y = []
-        self.sizeend_y = []
-        self.spread = []
-        self.threshold = []
-        self.velocity = []
-        self.xsize = []
-        self.ysize = []
-        self.blurlength = []
-        self.lightningdelay = []
-        self.lightningradius = []
-        self.lightningsubdiv = []
-        self.lightningscale = []
-        self.lightningzigzag = []
-        self.percentstart = []
-        self.percentmid = []
-        self.percentend = []
-        self.targetsize = []
-        self.numcontrolpts = []
-        self.controlptradius = []
-        self.controlptdelay = []
-        self.tangentspread = []
-        self.tangentlength = []
-        self.colorstart = []
-        self.colormid = []
-        self.colorend = []
+        self.controllers = dict()
         # Unknown. Import as text
-        self.rawascii = ''
+        self._rawascii = None
+
+    def __getattr__(self, name):
+        # Only called for controllers, everything else is a slot
+        if name in CONTROLLERS:
+            try:
+                return self.controllers.get(name, NO_KEYS)
+            except AttributeError:
+                pass
+        raise AttributeError(name)
+
+    def __contains__(self, name):
+        return name in self.controllers
+
+    def get(self, name):
+        return self.controllers.get(name, NO_KEYS)
+
+    def set(self, name, keys, numVals, conversion=None):
+        '''
+        Add keys for controller name. Keys of the same width are appended
+        to existing ones, otherwise they replace them.
+        '''
+        rows = packKeys(keys, numVals, conversion, name)
+        if name in self.controllers and \
+           self.controllers[name].width == rows.width:
+            self.controllers[name].data.extend(rows.data)
+        else:
+            self.controllers[name] = rows
+
+    def items(self):
+        return self.controllers.items()
+
+    @property
+    def rawascii(self):
+        if self._rawascii is None:
+            return ''
+        return self._rawascii.text()
+
+    @rawascii.setter
+    def rawascii(self, text):
+        self._rawascii = nvb_parse.RawAscii(text)
+
+    def addRawAscii(self, asciiBlock):
+        if self._rawascii is None:
+            self._rawascii = nvb_parse.RawAscii()
+        self._rawascii.addLines(asciiBlock)
 
     def hasAlpha(self):
-        return len(self.alpha) > 0
+        return 'alpha' in self.controllers
 
 
 class Node():
@@ -373,8 +406,7 @@ class Node():
         Parse animation keys incompatible with blender. They will be saved
         as plain text.
         '''
-        for line in asciiBlock:
-            self.keys.rawascii = self.keys.rawascii + '\n' + ' '.join(line)
+        self.keys.addRawAscii(asciiBlock)
         self.isEmpty = False
 
     @staticmethod
@@ -407,17 +439,11 @@ class Node():
                 pass
             elif label == 'parent':
                 self.parentName = nvb_utils.getName(line[1])
-            elif label in self.KEY_TYPE.keys() or \
-                 label in (attr + 'key' for attr in self.KEY_TYPE.keys()) or \
-                 label in (attr + 'bezierkey' for attr in self.KEY_TYPE.keys()):
+            elif findController(label)[0] is not None:
                 # Parse all controllers: unkeyed, keyed, or bezierkeyed
-                attrname = [attr for attr in self.KEY_TYPE.keys() if label.startswith(attr)][0]
-                attr_type = self.KEY_TYPE[attrname]
-                key_type = ''
-                key_type = 'key' if label.endswith('key') else key_type
-                key_type = 'bezierkey' if label.endswith('bezierkey') else key_type
-                #print('found {}{} {:d} values'.format(attrname, key_type, attr_type['values']))
-                numVals = attr_type['values']
+                controller, key_type = findController(label)
+                #print('found {}{} {:d} values'.format(controller.name, key_type, controller.values))
+                numVals = controller.values
                 if key_type:
                     if key_type == 'bezierkey':
                         numVals *= 3
@@ -426,36 +452,8 @@ class Node():
                 else:
                     numKeys = 1
                     subblock = [[0.0] + line[1:]]
-                # parse numvals plus one for time
-                nvb_parse._f(subblock, getattr(self.keys, attrname), numVals + 1)
-                self.isEmpty = False
-            elif label in (attr.lower() for attr in self.EMITTER_KEY_TYPE.keys()) or \
-                 label in (attr.lower() + 'key' for attr in self.EMITTER_KEY_TYPE.keys()) or \
-                 label in (attr.lower() + 'bezierkey' for attr in self.EMITTER_KEY_TYPE.keys()):
-                # Parse all controllers: unkeyed, keyed, or bezierkeyed
-                attrname = [attr for attr in self.EMITTER_KEY_TYPE.keys() if attr.lower() in label][0]
-                propname = attrname.lower()
-                attr_type = self.EMITTER_KEY_TYPE[attrname]
-                key_type = ''
-                key_type = 'key' if label.endswith('key') else key_type
-                key_type = 'bezierkey' if label.endswith('bezierkey') else key_type
-                #print('found {}{} {:d} values'.format(attrname, key_type, attr_type['values']))
-                numVals = attr_type['values']
-                if key_type:
-                    if key_type == 'bezierkey':
-                        numVals *= 3
-                    numKeys = type(self).findEnd(asciiBlock[idx+1:])
-                    subblock = asciiBlock[idx+1:idx+numKeys+1]
-                else:
-                    numKeys = 1
-                    subblock = [[0.0] + line[1:]]
-                # parse numvals plus one for time
-                if 'conversion' in attr_type and attr_type['conversion'] is int:
-                    nvb_parse._i(subblock, getattr(self.keys, propname), numVals + 1)
-                    #print(getattr(self.keys, attrname))
-                else:
-                    nvb_parse._f(subblock, getattr(self.keys, propname), numVals + 1)
-                #print(attrname + ' ' + label)
+                self.keys.set(controller.name, subblock, numVals,
+                              controller.conversion)
                 self.isEmpty = False
             # Some unknown text.
             # Probably keys for emitters = incompatible with blender. Import as text.
@@ -727,7 +725,13 @@ class Node():
 
 
     @staticmethod
-    def generate_ascii_keys(animObj, anim, asciiLines, options={}):
+    def get_keys(animObj, anim):
+        '''
+        Collect the keys of animObj in anim. Returns a list of
+        (attrname, keyname, ktype, keys) tuples, keys being lists of time
+        followed by the values and, for bezier keys, the left and right
+        control points.
+        '''
         keyDict = {}
 
         # Object Data
@@ -748,70 +752,53 @@ class Node():
             if action:
                 Node.getKeysFromAction(anim, action, keyDict)
 
-        l_str   = str
         l_round = round
 
-        for attrname in Node.KEY_TYPE.keys():
-            bezname = attrname + 'bezierkey'
-            keyname = attrname + 'key'
-            if (bezname not in keyDict or not len(keyDict[bezname])) and \
-               (keyname not in keyDict or not len(keyDict[keyname])):
-                continue
-            ktype = Node.KEY_TYPE[attrname]
-            # using a bezierkey
-            if bezname in keyDict and len(keyDict[bezname]):
-                keyname = bezname
-            asciiLines.append('    {} {}'.format(keyname, l_str(len(keyDict[keyname]))))
-            for frame, key in keyDict[keyname].items():
-                # convert raw frame number to animation-relative time
-                time = l_round(nvb_utils.frame2nwtime(frame - anim.frameStart), 5)
-                # orientation value conversion
-                if keyname.startswith('orientation'):
-                    key = nvb_utils.euler2nwangle(mathutils.Euler((key[0:3]), 'XYZ'))
-                # export title and
-                line = '      {: .7g}' + (' {: .7g}' * ktype['values'])
-                s = line.format(time, *key[0:ktype['values']])
-                # export bezierkey control points
-                if keyname == bezname:
-                    # left control point(s)
-                    s += (' {: .7g}' * ktype['values']).format(*key[ktype['axes']::2])
-                    # right control point(s)
-                    s += (' {: .7g}' * ktype['values']).format(*key[ktype['axes'] + 1::2])
-                asciiLines.append(s)
-        for attrname in Node.EMITTER_KEY_TYPE.keys():
-            bezname = attrname + 'bezierkey'
-            keyname = attrname + 'key'
-            if (bezname not in keyDict or not len(keyDict[bezname])) and \
-               (keyname not in keyDict or not len(keyDict[keyname])):
-                continue
-            ktype = Node.EMITTER_KEY_TYPE[attrname]
-            # using a bezierkey
-            if bezname in keyDict and len(keyDict[bezname]):
-                keyname = bezname
-            asciiLines.append('    {} {}'.format(keyname, l_str(len(keyDict[keyname]))))
-            for frame, key in keyDict[keyname].items():
-                # convert raw frame number to animation-relative time
-                time = l_round(nvb_utils.frame2nwtime(frame - anim.frameStart), 5)
-                # orientation value conversion
-                # export title and
-                value_str = " {: .7g}"
-                if "conversion" in ktype and ktype["conversion"] is int:
-                    #print(attrname)
-                    #print(key)
-                    #print(ktype)
-                    value_str = " {: d}"
-                    key[0:ktype['values']] = [int(k) for k in key[0:ktype['values']]]
-                    #print('converted')
-                    #print(key)
-                line = '      {: .7g}' + (value_str * ktype['values'])
-                s = line.format(time, *key[0:ktype['values']])
-                # export bezierkey control points
-                if keyname == bezname:
-                    # left control point(s)
-                    s += (' {: .7g}' * ktype['values']).format(*key[ktype['axes']::2])
-                    # right control point(s)
-                    s += (' {: .7g}' * ktype['values']).format(*key[ktype['axes'] + 1::2])
-                asciiLines.append(s)
+        controllers = []
+        for keyTypes in (Node.KEY_TYPE, Node.EMITTER_KEY_TYPE):
+            for attrname in keyTypes.keys():
+                bezname = attrname + 'bezierkey'
+                keyname = attrname + 'key'
+                if (bezname not in keyDict or not len(keyDict[bezname])) and \
+                   (keyname not in keyDict or not len(keyDict[keyname])):
+                    continue
+                ktype = keyTypes[attrname]
+                # using a bezierkey
+                if bezname in keyDict and len(keyDict[bezname]):
+                    keyname = bezname
+                numVals = ktype['values']
+                keys = []
+                for frame, key in keyDict[keyname].items():
+                    # convert raw frame number to animation-relative time
+                    time = l_round(nvb_utils.frame2nwtime(frame - anim.frameStart), 5)
+                    # orientation value conversion
+                    if keyname.startswith('orientation'):
+                        key = nvb_utils.euler2nwangle(mathutils.Euler((key[0:3]), 'XYZ'))
+                    key = list(key)
+                    if ktype.get('conversion') is int:
+                        key[0:numVals] = [int(k) for k in key[0:numVals]]
+                    values = key[0:numVals]
+                    # bezierkey control points, left then right
+                    if keyname == bezname:
+                        values += key[ktype['axes']::2][0:numVals]
+                        values += key[ktype['axes'] + 1::2][0:numVals]
+                    keys.append([time] + values)
+                controllers.append((attrname, keyname, ktype, keys))
+        return controllers
+
+    @staticmethod
+    def generate_ascii_keys(animObj, anim, asciiLines, options={}):
+        for attrname, keyname, ktype, keys in Node.get_keys(animObj, anim):
+            numVals = ktype['values']
+            value_str = ' {: .7g}'
+            if ktype.get('conversion') is int:
+                value_str = ' {: d}'
+            line = '      {: .7g}' + (value_str * numVals)
+            if keyname != attrname + 'key':
+                line += ' {: .7g}' * (2 * numVals)
+            asciiLines.append('    {} {}'.format(keyname, str(len(keys))))
+            for key in keys:
+                asciiLines.append(line.format(*key))
 
 
     @staticmethod
@@ -905,6 +892,54 @@ class Node():
         self.addKeysToAsciiIncompat(animObj, asciiLines)
         asciiLines.append('  endnode')
 
+
+class Controller():
+    '''
+    Metadata of an animation controller, from Node.KEY_TYPE or
+    Node.EMITTER_KEY_TYPE
+    '''
+    __slots__ = ('name', 'label', 'values', 'axes', 'objdata', 'conversion',
+                 'emitter')
+
+    def __init__(self, label, keyType, emitter):
+        self.name       = label.lower()
+        self.label      = label
+        self.values     = keyType['values']
+        self.axes       = keyType['axes']
+        self.objdata    = keyType.get('objdata', '')
+        self.conversion = keyType.get('conversion')
+        self.emitter    = emitter
+
+
+def buildControllers():
+    '''
+    Map lower case controller names to their metadata
+    '''
+    controllers = collections.OrderedDict()
+    for label, keyType in Node.KEY_TYPE.items():
+        controllers[label.lower()] = Controller(label, keyType, False)
+    for label, keyType in Node.EMITTER_KEY_TYPE.items():
+        controllers[label.lower()] = Controller(label, keyType, True)
+    return controllers
+
+CONTROLLERS = buildControllers()
+
+
+def findController(label):
+    '''
+    Find the controller of an ascii label, e.g. positionbezierkey.
+    Returns the controller and the key type ('', 'key' or 'bezierkey'),
+    or (None, '') if it isn't a known controller.
+    '''
+    label = label.lower()
+    if label in CONTROLLERS:
+        return CONTROLLERS[label], ''
+    if label.endswith('bezierkey') and label[:-9] in CONTROLLERS:
+        return CONTROLLERS[label[:-9]], 'bezierkey'
+    if label.endswith('key') and label[:-3] in CONTROLLERS:
+        return CONTROLLERS[label[:-3]], 'key'
+    return None, ''
+
 import copy
 
 from . import nvb_node
@@ -1059,36 +1094,16 @@ class Animnode():
                                        for v in ascii_lines[i+1:i+valcnt+1]]
                     self.uvdata = True
             else:  # Check for keys
-                key_name = label
-                key_is_single = True
-                key_type = ""
-                if key_name.endswith('key'):
-                    key_is_single = False
-                    key_name = key_name[:-3]
-                    key_type = 'key'
-                if key_name.endswith('bezier'):
-                    key_name = key_name[:-6]
-                    key_type = 'bezierkey'
-                if key_name in Node.KEY_TYPE.keys() or \
-                   key_name in [k.lower() for k in Node.EMITTER_KEY_TYPE.keys()]:
-                    attr_name = key_name
+                controller, key_type = findController(label)
+                if controller is not None:
                     key_data = self.object_data
-                    attr_type = None
-                    if attr_name not in Node.KEY_TYPE:
+                    if controller.emitter:
                         # emitter property
-                        attr_name = [
-                            attr for attr in Node.EMITTER_KEY_TYPE.keys() \
-                                if attr.lower() in label
-                        ][0]
                         key_data = self.emitter_data
-                        attr_type = Node.EMITTER_KEY_TYPE[attr_name]
-                    else:
-                        # object property
-                        attr_type = Node.KEY_TYPE[attr_name]
                     #XXX material data assignment currently bit of a hack
-                    if 'objdata' in attr_type and attr_type['objdata'] is None:
+                    elif controller.objdata is None:
                         key_data = self.material_data
-                    numVals = attr_type['values']
+                    numVals = controller.values
                     numKeys = 0
                     if key_type:
                         if key_type == 'bezierkey':
@@ -1098,20 +1113,11 @@ class Animnode():
                     else:
                         numKeys = 1
                         subblock = [[0.0] + line[1:]]
-                    #key_data[key_name] = [
-                    converter = float
-                    if 'conversion' in attr_type:
-                        converter = attr_type['conversion']
-                        #print('used converter for ' + attr_name)
-                    key_data[key_name] = [
-                        [
-                            # time followed by values, for each line
-                            [float(v[0])] + \
-                            list(map(
-                                converter, v[1:numVals+1]
-                            )) for v in subblock
-                        ],
-                        attr_type['objdata'] if 'objdata' in attr_type else '',
+                    key_data[controller.name] = [
+                        # time followed by values, for each line
+                        packKeys(subblock, numVals, controller.conversion,
+                                 controller.name),
+                        controller.objdata,
                         numVals
                     ]
                 '''
@@ -1134,6 +1140,27 @@ class Animnode():
                         break
                 '''
 
+    def add_keys(self, key_name, keys, num_vals):
+        """Add already converted keys, e.g. from a binary mdl.
+
+        key_name is the lower case name of the controller, like 'position'
+        or 'birthrate', keys a list of [time, values...] lists with num_vals
+        values each. Keys end up in the same place load_ascii puts them.
+        """
+        controller = CONTROLLERS.get(key_name)
+        if controller is None:
+            return
+        key_data = self.object_data
+        if controller.emitter:
+            key_data = self.emitter_data
+        elif controller.objdata is None:
+            key_data = self.material_data
+        key_data[key_name] = [
+            packKeys(keys, num_vals, controller.conversion, key_name),
+            controller.objdata,
+            num_vals
+        ]
+
     def create_data_material(self, obj, anim, options={}):
         """Creates animations in material actions."""
 
@@ -1478,3 +1505,27 @@ class Animnode():
         Node.generate_ascii_keys(obj, anim, asciiLines, options)
         #Node.generate_ascii_keys_incompat(obj, anim, asciiLines, options)
         asciiLines.append('  endnode')
+
+    def load_object(self, obj, anim, nodeidx=-1):
+        """Load the keys of obj in anim, the counterpart of generate_ascii.
+
+        Returns False if the node is not needed in the animation.
+        """
+        if not obj or not Node.exportNeeded(obj, anim):
+            return False
+        self.nodeidx = nodeidx
+        self.nodetype = "dummy"
+        if obj.nvb.meshtype == nvb_def.Meshtype.EMITTER:
+            self.nodetype = "emitter"
+        self.name = nvb_utils.str2identifier(
+            Node.getOriginalName(obj.name, anim.name))
+        parent_name = nvb_def.null
+        if obj.parent:
+            parent_name = Node.getOriginalName(obj.parent.name, anim.name)
+        self.parentName = nvb_utils.str2identifier(parent_name)
+        for attrname, keyname, ktype, keys in Node.get_keys(obj, anim):
+            numVals = ktype['values']
+            if keyname != attrname + 'key':
+                numVals *= 3
+            self.add_keys(attrname.lower(), keys, numVals)
+        return True
@@ -0,0 +1,1432 @@
+"""Reader and writer for compiled (binary) KotOR mdl and mdx files."""
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import nvb_def
+from . import nvb_node
+from . import nvb_anim
+from . import nvb_animnode
+from . import nvb_utils
+from . import nvb_parse
+from . import nvb_aabb
+
+
+# Offsets in the mdl are relative to the end of the file header
+# (u32 zero, u32 mdl size, u32 mdx size)
+FILE_HEADER_SIZE = 12
+
+# Model and animation headers start with a geometry header
+GEOMETRY_HEADER_SIZE = 80
+MODEL_HEADER_SIZE    = 196
+ANIM_HEADER_SIZE     = 136
+NODE_HEADER_SIZE     = 80
+CONTROLLER_SIZE      = 16
+FACE_SIZE            = 32
+EVENT_SIZE           = 36
+
+LIGHT_SIZE     = 92
+EMITTER_SIZE   = 224
+REFERENCE_SIZE = 36
+TRIMESH_SIZE   = 332  # K1, TSL meshes are 8 bytes larger
+SKIN_SIZE      = 100
+DANGLY_SIZE    = 28
+AABB_SIZE      = 4
+SABER_SIZE     = 20
+
+# First function pointer of the geometry header, tells K1 and TSL apart
+FN_PTR_TSL = {4285200, 4285872}  # PC, Xbox
+
+# Function pointers written to the headers, (K1, TSL) for PC
+FN_PTRS_MODEL  = ((4273776, 4216096), (4285200, 4216320))
+FN_PTRS_ANIM   = ((4273392, 4451552), (4284816, 4522928))
+FN_PTRS_MESH   = ((4216656, 4216672), (4216880, 4216896))
+FN_PTRS_SKIN   = ((4216592, 4216608), (4216816, 4216832))
+FN_PTRS_DANGLY = ((4216640, 4216624), (4216864, 4216848))
+
+# Model types of the geometry header
+MODEL_TYPE_MODEL = 2
+MODEL_TYPE_ANIM  = 5
+
+class NodeFlag():
+    HEADER  = 0x0001
+    LIGHT   = 0x0002
+    EMITTER = 0x0004
+    CAMERA  = 0x0008
+    REF     = 0x0010
+    MESH    = 0x0020
+    SKIN    = 0x0040
+    ANIM    = 0x0080
+    DANGLY  = 0x0100
+    AABB    = 0x0200
+    SABER   = 0x0800
+
+# Classification byte of the model header
+CLASSIFICATION = {
+    0x00: nvb_def.Classification.UNKNOWN,
+    0x01: nvb_def.Classification.EFFECT,
+    0x02: nvb_def.Classification.TILE,
+    0x04: nvb_def.Classification.CHARACTER,
+    0x08: nvb_def.Classification.DOOR,
+    0x10: nvb_def.Classification.SABER,
+    0x20: nvb_def.Classification.ITEM,
+    0x40: nvb_def.Classification.FLYER,
+}
+
+# Controller types by node type, as (label, number of values). Codes are
+# only unique within a node type.
+CONTROLLERS_HEADER = {
+    8:  ('position',    3),
+    20: ('orientation', 4),
+    36: ('scale',       1),
+}
+CONTROLLERS_MESH = {
+    100: ('selfillumcolor', 3),
+    132: ('alpha',          1),
+}
+CONTROLLERS_LIGHT = {
+    76:  ('color',                3),
+    88:  ('radius',               1),
+    96:  ('shadowradius',         1),
+    100: ('verticaldisplacement', 1),
+    140: ('multiplier',           1),
+}
+CONTROLLERS_EMITTER = {
+    80:  ('alphaend',           1),
+    84:  ('alphastart',         1),
+    88:  ('birthrate',          1),
+    92:  ('bounce_co',          1),
+    96:  ('combinetime',        1),
+    100: ('drag',               1),
+    104: ('fps',                1),
+    108: ('frameend',           1),
+    112: ('framestart',         1),
+    116: ('grav',               1),
+    120: ('lifeexp',            1),
+    124: ('mass',               1),
+    128: ('p2p_bezier2',        1),
+    132: ('p2p_bezier3',        1),
+    136: ('particlerot',        1),
+    140: ('randvel',            1),
+    144: ('sizestart',          1),
+    148: ('sizeend',            1),
+    152: ('sizestart_y',        1),
+    156: ('sizeend_y',          1),
+    160: ('spread',             1),
+    164: ('threshold',          1),
+    168: ('velocity',           1),
+    172: ('xsize',              1),
+    176: ('ysize',              1),
+    180: ('blurlength',         1),
+    184: ('lightningdelay',     1),
+    188: ('lightningradius',    1),
+    192: ('lightningscale',     1),
+    196: ('lightningsubdiv',    1),
+    200: ('lightningzigzag',    1),
+    216: ('alphamid',           1),
+    220: ('percentstart',       1),
+    224: ('percentmid',         1),
+    228: ('percentend',         1),
+    232: ('sizemid',            1),
+    236: ('sizemid_y',          1),
+    240: ('m_frandombirthrate', 1),
+    252: ('targetsize',         1),
+    256: ('numcontrolpts',      1),
+    260: ('controlptradius',    1),
+    264: ('controlptdelay',     1),
+    268: ('tangentspread',      1),
+    272: ('tangentlength',      1),
+    284: ('colormid',           3),
+    380: ('colorend',           3),
+    392: ('colorstart',         3),
+}
+
+# Emitter flags, bit masks by attribute
+EMITTER_FLAGS = [
+    ('p2p',            0x0001),
+    ('p2p_sel',        0x0002),
+    ('affectedByWind', 0x0004),
+    ('m_isTinted',     0x0008),
+    ('bounce',         0x0010),
+    ('random',         0x0020),
+    ('inherit',        0x0040),
+    ('inheritvel',     0x0080),
+    ('inherit_local',  0x0100),
+    ('splat',          0x0200),
+    ('inherit_part',   0x0400),
+    ('depth_texture',  0x0800),
+]
+
+# Unused offsets into the mdx are set to this value
+MDX_NONE = 0xFFFFFFFF
+
+# Bits of the mdx data bitmap
+class MdxFlag():
+    VERTEX  = 0x0001
+    UV1     = 0x0002
+    UV2     = 0x0004
+    UV3     = 0x0008
+    UV4     = 0x0010
+    NORMAL  = 0x0020
+    COLOR   = 0x0040
+    TANGENT = 0x0080
+
+AABB_NODE_SIZE = 40
+
+# Vertex normals closer than this (per axis) are merged into one vertex
+NORMAL_TOLERANCE = 0.001
+
+if numpy is not None:
+    FACE_DTYPE = numpy.dtype([('normal',   '<f4', (3,)),
+                              ('distance', '<f4'),
+                              ('material', '<u4'),
+                              ('adjacent', '<u2', (3,)),
+                              ('vertices', '<u2', (3,))])
+
+
+def isBinaryMdl(filepath):
+    '''
+    Binary mdls start with a zero u32, ascii ones with text.
+    '''
+    with open(filepath, 'rb') as f:
+        return f.read(4) == b'\x00\x00\x00\x00'
+
+
+def getMdxPath(filepath):
+    '''
+    The mdx is next to the mdl, with the same name.
+    '''
+    root = os.path.splitext(filepath)[0]
+    if isinstance(root, bytes):
+        return root + b'.mdx'
+    return root + '.mdx'
+
+
+class MdlReader():
+    '''
+    Reads binary mdl and mdx data into an nvb_mdl.Mdl.
+
+    Values are unpacked directly from the data with struct. Vertex data is
+    read through numpy views of the mdl/mdx data if numpy is available,
+    without copying.
+    '''
+    def __init__(self, mdlData, mdxData = None):
+        self.mdl = memoryview(mdlData)
+        self.mdx = memoryview(mdxData) if mdxData else None
+
+        self.tsl   = False
+        self.names = []
+        self.nodeFlags = dict()  # by node name, to type animation nodes
+
+    @classmethod
+    def fromFile(cls, filepath):
+        with open(filepath, 'rb') as f:
+            mdlData = f.read()
+        mdxData = None
+        mdxPath = getMdxPath(filepath)
+        if os.path.isfile(mdxPath):
+            with open(mdxPath, 'rb') as f:
+                mdxData = f.read()
+        else:
+            print('Kotorblender - WARNING: No mdx found {}'.format(mdxPath))
+        return cls(mdlData, mdxData)
+
+    def unpack(self, fmt, offset):
+        return struct.unpack_from('<' + fmt, self.mdl, FILE_HEADER_SIZE + offset)
+
+    def u32(self, offset):
+        return self.unpack('I', offset)[0]
+
+    def string(self, offset, size):
+        data = bytes(self.unpack('{}s'.format(size), offset)[0])
+        return data.split(b'\x00', 1)[0].decode('ascii', 'replace')
+
+    def cstring(self, offset):
+        start = FILE_HEADER_SIZE + offset
+        end = bytes(self.mdl[start:start+256]).find(b'\x00')
+        if end < 0:
+            end = 256
+        return bytes(self.mdl[start:start+end]).decode('ascii', 'replace')
+
+    def arrayDef(self, offset):
+        '''
+        Return (offset, count) of an array definition.
+        '''
+        return self.unpack('II', offset)
+
+    def floats(self, offset, count):
+        return list(self.unpack('{}f'.format(count), offset))
+
+    def vectors(self, data, offset, count, numVals, stride = 0):
+        '''
+        Read count vectors of numVals floats, stride bytes apart, from data.
+
+        Returns a (count, numVals) numpy view of data, or nvb_parse.Rows
+        if numpy is not available.
+        '''
+        stride = stride or 4 * numVals
+        if count == 0:
+            return []
+        if offset + (count-1) * stride + 4 * numVals > len(data):
+            raise nvb_def.MalformedMdlFile('Vertex data out of bounds')
+        if numpy is not None:
+            return numpy.ndarray((count, numVals), dtype='<f4',
+                                 buffer=data, offset=offset,
+                                 strides=(stride, 4))
+        fmt = struct.Struct('<{}f'.format(numVals))
+        rows = nvb_parse.Rows('f', numVals)
+        for i in range(count):
+            rows.append(fmt.unpack_from(data, offset + i*stride))
+        return rows
+
+    def load(self, mdl, importAnim = True):
+        try:
+            self.loadModel(mdl, importAnim)
+        except (struct.error, IndexError, ValueError, TypeError) as e:
+            raise nvb_def.MalformedMdlFile('Invalid binary mdl: ' + str(e))
+
+    def loadModel(self, mdl, importAnim):
+        fnPtr = self.u32(0)
+        self.tsl = fnPtr in FN_PTR_TSL
+
+        mdl.name = self.string(8, 32)
+        rootOffset = self.u32(40)
+
+        offset = GEOMETRY_HEADER_SIZE
+        (classification, subclassification, _,
+         affectedByFog) = self.unpack('4B', offset)
+        mdl.classification = CLASSIFICATION.get(classification,
+                                                nvb_def.Classification.UNKNOWN)
+        mdl.unknownC1 = subclassification
+        mdl.ignorefog = int(not affectedByFog)
+        animOffset, animCount = self.arrayDef(offset + 8)
+        mdl.animscale = self.unpack('f', offset + 52)[0]
+        mdl.supermodel = self.string(offset + 56, 32) or nvb_def.null
+        namesOffset, namesCount = self.arrayDef(offset + 104)
+
+        self.names = [self.cstring(o) for o in
+                      self.unpack('{}I'.format(namesCount), namesOffset)]
+
+        self.loadNode(mdl, rootOffset, nvb_def.null)
+
+        if importAnim and animCount:
+            for o in self.unpack('{}I'.format(animCount), animOffset):
+                anim = self.loadAnimation(o)
+                mdl.animations.append(anim)
+                mdl.addAnimation(anim)
+
+    def loadNode(self, mdl, offset, parentName):
+        (flags, nodeNumber, nameIndex, _,
+         _, _, px, py, pz, qw, qx, qy, qz) = self.unpack('4H2I7f', offset)
+
+        node = self.createNode(flags)
+        node.name       = nvb_utils.getName(self.names[nameIndex])
+        node.parentName = parentName
+        node.rootname   = mdl.name
+        node.position   = (px, py, pz)
+        node.orientation = tuple(nvb_utils.quat2nwangle((qx, qy, qz, qw)))
+
+        self.nodeFlags[node.name] = flags
+
+        dataOffset = offset + NODE_HEADER_SIZE
+        if flags & NodeFlag.LIGHT:
+            self.loadLight(node, dataOffset)
+            dataOffset += LIGHT_SIZE
+        if flags & NodeFlag.EMITTER:
+            self.loadEmitter(node, dataOffset)
+            dataOffset += EMITTER_SIZE
+        if flags & NodeFlag.REF:
+            self.loadReference(node, dataOffset)
+            dataOffset += REFERENCE_SIZE
+        if flags & NodeFlag.MESH:
+            meshOffset = dataOffset
+            dataOffset += TRIMESH_SIZE + (8 if self.tsl else 0)
+            self.loadMesh(node, meshOffset, dataOffset, flags)
+
+        # Geometry controllers hold a single key with the node's values,
+        # they are converted like the ascii properties of the same name
+        schema = type(node).getSchema()
+        for label, numVals, keys in self.readControllers(offset, flags):
+            values = keys[0][1:numVals+1]
+            prop = schema.get(label)
+            if prop is not None and prop[3] is None:
+                attrname, _, convert, _ = prop
+                if numVals == 1:
+                    setattr(node, attrname, convert(values[0]))
+                else:
+                    setattr(node, attrname, tuple(map(convert, values)))
+            elif node.keepRaw:
+                node._rawascii.addLine([label] + [str(v) for v in values],
+                                        node.rawIndent)
+
+        mdl.addNode(node)
+
+        childOffset, childCount = self.arrayDef(offset + 44)
+        for o in self.unpack('{}I'.format(childCount), childOffset):
+            self.loadNode(mdl, o, node.name)
+
+    @staticmethod
+    def createNode(flags):
+        if flags & NodeFlag.SABER:
+            return nvb_node.Lightsaber()
+        if flags & NodeFlag.AABB:
+            return nvb_node.Aabb()
+        if flags & NodeFlag.DANGLY:
+            return nvb_node.Danglymesh()
+        if flags & NodeFlag.SKIN:
+            return nvb_node.Skinmesh()
+        if flags & NodeFlag.MESH:
+            return nvb_node.Trimesh()
+        if flags & NodeFlag.EMITTER:
+            return nvb_node.Emitter()
+        if flags & NodeFlag.LIGHT:
+            return nvb_node.Light()
+        if flags & NodeFlag.REF:
+            return nvb_node.Reference()
+        return nvb_node.Dummy()
+
+    @staticmethod
+    def getControllers(flags):
+        '''
+        Return the controller types of a node with the given flags.
+        '''
+        controllers = dict(CONTROLLERS_HEADER)
+        if flags & NodeFlag.LIGHT:
+            controllers.update(CONTROLLERS_LIGHT)
+        if flags & NodeFlag.EMITTER:
+            controllers.update(CONTROLLERS_EMITTER)
+        if flags & NodeFlag.MESH:
+            controllers.update(CONTROLLERS_MESH)
+        return controllers
+
+    def readControllers(self, offset, flags):
+        '''
+        Yield (label, number of values, keys) for every known controller of
+        the node at offset. Keys are [time, values...] lists, bezier keys
+        hold three times the number of values. Orientations are converted
+        to axis angles.
+        '''
+        controllers = self.getControllers(flags)
+        ctrlOffset, ctrlCount = self.arrayDef(offset + 56)
+        dataOffset, dataCount = self.arrayDef(offset + 68)
+        if not ctrlCount:
+            return
+        data = self.floats(dataOffset, dataCount)
+        for idx in range(ctrlCount):
+            (ctrlType, _, numRows, timeIdx, dataIdx,
+             columns) = self.unpack('I4HB', ctrlOffset + idx * CONTROLLER_SIZE)
+            if ctrlType not in controllers:
+                continue
+            label, numVals = controllers[ctrlType]
+            times = data[timeIdx:timeIdx+numRows]
+            if label == 'orientation' and columns == 2:
+                # Compressed quaternions, one u32 per key
+                packed = self.unpack('{}I'.format(numRows),
+                                     dataOffset + 4 * dataIdx)
+                values = [self.decompressQuat(p) for p in packed]
+                keys = [[t] + nvb_utils.quat2nwangle(v)
+                        for t, v in zip(times, values)]
+                yield label, numVals, keys
+                continue
+            numCols = columns & 0x0F
+            if columns & 0x10:
+                # Bezier keys, value followed by two control points
+                numCols *= 3
+            keys = []
+            for row in range(numRows):
+                start = dataIdx + row * numCols
+                values = data[start:start+numCols]
+                if label == 'orientation':
+                    values = nvb_utils.quat2nwangle(values[:4])
+                keys.append([times[row]] + values)
+            yield label, numVals, keys
+
+    @staticmethod
+    def decompressQuat(packed):
+        x = ((packed & 0x7FF) / 1023.0) - 1.0
+        y = (((packed >> 11) & 0x7FF) / 1023.0) - 1.0
+        z = ((packed >> 22) / 511.0) - 1.0
+        mag2 = x*x + y*y + z*z
+        if mag2 < 1.0:
+            return (x, y, z, (1.0 - mag2) ** 0.5)
+        mag = mag2 ** 0.5
+        return (x/mag, y/mag, z/mag, 0.0)
+
+    def loadLight(self, node, offset):
+        node.flareradius = self.unpack('f', offset)[0]
+        sizesOffset, sizesCount = self.arrayDef(offset + 16)
+        posOffset, posCount = self.arrayDef(offset + 28)
+        shiftsOffset, shiftsCount = self.arrayDef(offset + 40)
+        texOffset, texCount = self.arrayDef(offset + 52)
+        (node.lightpriority, node.ambientonly, node.ndynamictype,
+         node.affectdynamic, node.shadow, node.lensflares,
+         node.fadinglight) = self.unpack('7I', offset + 64)
+        node.isdynamic = node.ndynamictype
+        flareList = node.flareList
+        flareList.sizes = self.floats(sizesOffset, sizesCount)
+        flareList.positions = self.floats(posOffset, posCount)
+        flareList.colorshifts = [tuple(self.floats(shiftsOffset + 12*i, 3))
+                                 for i in range(shiftsCount)]
+        flareList.textures = [self.cstring(o) for o in
+                              self.unpack('{}I'.format(texCount), texOffset)]
+
+    def loadEmitter(self, node, offset):
+        (node.deadspace, node.blastradius, node.blastlength,
+         node.numBranches, controlptsmoothing,
+         node.xgrid, node.ygrid, spawntype) = self.unpack('3fIf3I', offset)
+        node.controlptsmoothing = int(controlptsmoothing)
+        node.spawntype = str(spawntype)
+        node.update    = self.string(offset + 32, 32)
+        node.render    = self.string(offset + 64, 32)
+        node.blend     = self.string(offset + 96, 32)
+        node.texture   = self.string(offset + 128, 32) or nvb_def.null
+        node.chunkName = self.string(offset + 160, 16)
+        (twosidedtex, loop, node.renderorder,
+         frameBlending) = self.unpack('2IHB', offset + 176)
+        node.twosidedtex = bool(twosidedtex)
+        node.loop = bool(loop)
+        node.m_bFrameBlending = bool(frameBlending)
+        node.m_sDepthTextureName = self.string(offset + 187, 32) or nvb_def.null
+        flags = self.u32(offset + 220)
+        for attrname, mask in EMITTER_FLAGS:
+            setattr(node, attrname, bool(flags & mask))
+
+    def loadReference(self, node, offset):
+        node.refmodel = self.string(offset, 32) or nvb_def.null
+        node.reattachable = self.u32(offset + 32)
+
+    def loadMesh(self, node, offset, extOffset, flags):
+        facesOffset, numFaces = self.arrayDef(offset + 8)
+        node.center = self.unpack('3f', offset + 48)
+        node.diffuse = self.unpack('3f', offset + 60)
+        node.ambient = self.unpack('3f', offset + 72)
+        node.transparencyhint = self.u32(offset + 84)
+        node.bitmap = self.string(offset + 88, 32) or nvb_def.null
+        node.bitmap2 = self.string(offset + 120, 32) or nvb_def.null
+        (node.animateuv, node.uvdirectionx, node.uvdirectiony,
+         node.uvjitter, node.uvjitterspeed) = self.unpack('I4f', offset + 232)
+        (mdxStride, _, mdxVerts, _, _, mdxUV1, mdxUV2, _, _,
+         mdxTangent) = self.unpack('10I', offset + 252)
+        (numVerts, _, node.lightmapped, node.rotatetexture,
+         node.m_bIsBackgroundGeometry, node.shadow, node.beaming,
+         node.render) = self.unpack('2H6B', offset + 304)
+        tail = offset + 314
+        if self.tsl:
+            (node.dirt_enabled, _, node.dirt_texture, node.dirt_worldspace,
+             node.hologram_donotdraw) = self.unpack('2B2HB', tail)
+            tail += 8
+        mdxOffset, vertsOffset = self.unpack('2I', tail + 10)
+        node.tangentspace = int(mdxTangent != MDX_NONE)
+
+        if flags & NodeFlag.SABER:
+            # Sabers keep their vertices in the mdl only
+            (vertsOffset, uvOffset) = self.unpack('2I', extOffset)
+            node.verts = self.vectors(self.mdl, FILE_HEADER_SIZE + vertsOffset,
+                                      numVerts, 3)
+            node.tverts = self.vectors(self.mdl, FILE_HEADER_SIZE + uvOffset,
+                                       numVerts, 2)
+        else:
+            if self.mdx is not None and mdxVerts != MDX_NONE:
+                node.verts = self.vectors(self.mdx, mdxOffset + mdxVerts,
+                                          numVerts, 3, mdxStride)
+            else:
+                node.verts = self.vectors(self.mdl, FILE_HEADER_SIZE + vertsOffset,
+                                          numVerts, 3)
+            if self.mdx is not None and mdxUV1 != MDX_NONE:
+                node.tverts = self.vectors(self.mdx, mdxOffset + mdxUV1,
+                                           numVerts, 2, mdxStride)
+            if self.mdx is not None and mdxUV2 != MDX_NONE:
+                node.tverts1 = self.vectors(self.mdx, mdxOffset + mdxUV2,
+                                            numVerts, 2, mdxStride)
+
+        self.loadFaces(node, facesOffset, numFaces)
+        if len(node.tverts1):
+            node.texindices1 = node.facelist.uvIdx
+
+        if flags & NodeFlag.SKIN:
+            self.loadSkin(node, extOffset, mdxOffset, mdxStride, numVerts)
+        elif flags & NodeFlag.DANGLY:
+            self.loadDangly(node, extOffset)
+
+    def loadFaces(self, node, offset, count):
+        '''
+        Faces of the binary format carry no smoothing groups, every face is
+        put in group 1. Texture and vertex indices are identical.
+        '''
+        facelist = node.facelist
+        if count == 0:
+            return
+        if numpy is not None:
+            faces = numpy.frombuffer(self.mdl, dtype=FACE_DTYPE, count=count,
+                                     offset=FILE_HEADER_SIZE + offset)
+            facelist.faces = faces['vertices'].astype(numpy.int32)
+            facelist.uvIdx = facelist.faces.copy()
+            facelist.matId = faces['material'].astype(numpy.int32)
+            facelist.shdgr = numpy.ones(count, dtype=numpy.int32)
+            return
+        for idx in range(count):
+            values = self.unpack('4fI6H', offset + idx * FACE_SIZE)
+            face = values[8:11]
+            facelist.faces.append(face)
+            facelist.uvIdx.append(face)
+            facelist.matId.append(values[4])
+            facelist.shdgr.append(1)
+
+    def loadSkin(self, node, offset, mdxOffset, mdxStride, numVerts):
+        (mdxWeights, mdxBones, bonemapOffset,
+         bonemapCount) = self.unpack('4I', offset + 12)
+        if self.mdx is None:
+            return
+        # Maps node numbers to bone indices, invert it
+        boneNames = dict()
+        for nodeNumber, boneIdx in enumerate(self.floats(bonemapOffset, bonemapCount)):
+            if boneIdx >= 0 and nodeNumber < len(self.names):
+                boneNames[int(boneIdx)] = self.names[nodeNumber]
+        weights = self.vectors(self.mdx, mdxOffset + mdxWeights,
+                               numVerts, 4, mdxStride)
+        bones = self.vectors(self.mdx, mdxOffset + mdxBones,
+                             numVerts, 4, mdxStride)
+        node.weights = []
+        for vertWeights, vertBones in zip(weights, bones):
+            memberships = []
+            for weight, boneIdx in zip(vertWeights, vertBones):
+                if boneIdx >= 0 and weight > 0.0 and int(boneIdx) in boneNames:
+                    memberships.append([boneNames[int(boneIdx)], float(weight)])
+            node.weights.append(memberships)
+
+    def loadDangly(self, node, offset):
+        constraintsOffset, constraintsCount = self.arrayDef(offset)
+        (node.displacement, node.tightness,
+         node.period) = self.unpack('3f', offset + 12)
+        node.constraints = self.floats(constraintsOffset, constraintsCount)
+
+    def loadAnimation(self, offset):
+        anim = nvb_anim.Animation()
+        anim.name = nvb_utils.str2identifier(self.string(offset + 8, 32))
+        rootOffset = self.u32(offset + 40)
+        (anim.length, anim.transtime) = self.unpack('2f', offset + GEOMETRY_HEADER_SIZE)
+        anim.root = self.string(offset + 88, 32) or nvb_def.null
+        anim.animroot = nvb_utils.str2identifier(anim.root)
+        eventsOffset, eventsCount = self.arrayDef(offset + 120)
+        for idx in range(eventsCount):
+            eventOffset = eventsOffset + idx * EVENT_SIZE
+            anim.addEvent((self.unpack('f', eventOffset)[0],
+                           self.string(eventOffset + 4, 32)))
+        self.loadAnimNode(anim, rootOffset, nvb_def.null)
+        return anim
+
+    def loadAnimNode(self, anim, offset, parentName):
+        flags, _, nameIndex = self.unpack('3H', offset)
+        name = self.names[nameIndex]
+        node = nvb_animnode.Animnode()
+        node.nodeidx = len(anim.nodes)
+        node.name = nvb_utils.str2identifier(name)
+        node.parentName = nvb_utils.str2identifier(parentName)
+
+        # Controller codes depend on the node type, which is only reliably
+        # set on the geometry node of the same name
+        flags = self.nodeFlags.get(name, flags)
+        for label, numVals, keys in self.readControllers(offset, flags):
+            node.add_keys(label, keys, len(keys[0]) - 1)
+
+        anim.nodes.append(node)
+        key = node.parentName + node.name
+        if key not in anim.nodeList:
+            anim.nodeList[key] = node
+
+        childOffset, childCount = self.arrayDef(offset + 44)
+        for o in self.unpack('{}I'.format(childCount), childOffset):
+            self.loadAnimNode(anim, o, name)
+
+
+def quatMultiply(a, b):
+    ax, ay, az, aw = a
+    bx, by, bz, bw = b
+    return (aw*bx + ax*bw + ay*bz - az*by,
+            aw*by - ax*bz + ay*bw + az*bx,
+            aw*bz + ax*by - ay*bx + az*bw,
+            aw*bw - ax*bx - ay*by - az*bz)
+
+
+def quatConjugate(q):
+    return (-q[0], -q[1], -q[2], q[3])
+
+
+def quatRotate(q, v):
+    x, y, z, _ = quatMultiply(quatMultiply(q, (v[0], v[1], v[2], 0.0)),
+                              quatConjugate(q))
+    return (x, y, z)
+
+
+class MdlWriter():
+    '''
+    Writes an nvb_mdl.Mdl as binary mdl and mdx data.
+
+    This is the counterpart of MdlReader, it takes the node data as loaded
+    from an ascii or binary mdl. Blocks are appended to the output in a
+    single pass, headers are reserved first and filled in once the offsets
+    of their arrays are known.
+    '''
+    def __init__(self, mdl, tsl = False):
+        self.mdl = mdl
+        self.tsl = tsl
+
+        self.out = bytearray()
+        self.mdx = bytearray()
+
+        # Nodes in file order, node numbers are indices into this list
+        self.nodes = [node for node in mdl.nodeDict.values()]
+        self.nodeNumbers = dict()
+        self.children = dict()
+        for number, node in enumerate(self.nodes):
+            self.nodeNumbers.setdefault(node.name.lower(), number)
+            self.children.setdefault(node.parentName.lower(), []).append(node)
+        self.names = [node.name for node in self.nodes]
+        # Animated nodes without geometry still need a name
+        for anim in mdl.animations:
+            for animNode in anim.nodes:
+                if animNode.name not in self.nodeNumbers:
+                    self.nodeNumbers[animNode.name] = len(self.names)
+                    self.names.append(animNode.name)
+        self.transforms = dict()  # world space (rotation, translation)
+        self.skinBones = dict()  # node numbers of the bones of each skin
+        self.meshCount = 0
+
+    def tell(self):
+        return len(self.out)
+
+    def reserve(self, size):
+        offset = len(self.out)
+        self.out.extend(bytes(size))
+        return offset
+
+    def pack(self, fmt, offset, *values):
+        struct.pack_into('<' + fmt, self.out, offset, *values)
+
+    def append(self, fmt, *values):
+        offset = len(self.out)
+        self.out.extend(struct.pack('<' + fmt, *values))
+        return offset
+
+    def appendArray(self, fmt, values):
+        '''
+        Append a flat list of values, return an (offset, count, count)
+        array definition.
+        '''
+        if not values:
+            return (0, 0, 0)
+        offset = self.append('{}{}'.format(len(values), fmt), *values)
+        return (offset, len(values), len(values))
+
+    def appendString(self, s):
+        return self.append('{}s'.format(len(s) + 1), s.encode('ascii', 'replace'))
+
+    @staticmethod
+    def fixed(s, size):
+        if nvb_utils.isNull(s):
+            return b''
+        return s.encode('ascii', 'replace')[:size-1]
+
+    def write(self):
+        '''
+        Return the contents of the mdl and mdx as bytes.
+        '''
+        try:
+            self.writeModel()
+        except (struct.error, IndexError, ValueError, TypeError) as e:
+            raise nvb_def.MalformedMdlFile('Unable to write binary mdl: ' + str(e))
+        fileHeader = struct.pack('<3I', 0, len(self.out), len(self.mdx))
+        return fileHeader + bytes(self.out), bytes(self.mdx)
+
+    def writeModel(self):
+        mdl = self.mdl
+        if not self.nodes:
+            raise nvb_def.MalformedMdlFile('Unable to find geometry')
+        self.reserve(MODEL_HEADER_SIZE)
+
+        nameOffsets = [self.appendString(name) for name in self.names]
+        namesArray = self.appendArray('I', nameOffsets)
+
+        root = self.nodes[0]
+        self.computeTransforms(root, (0.0, 0.0, 0.0, 1.0), (0.0, 0.0, 0.0))
+        rootOffset = self.writeNode(root, 0)
+
+        animOffsets = [self.writeAnimation(anim) for anim in mdl.animations]
+        animArray = self.appendArray('I', animOffsets)
+
+        self.writeGeometryHeader(0, FN_PTRS_MODEL, mdl.name, rootOffset,
+                                 len(self.nodes), MODEL_TYPE_MODEL)
+        classification = 0
+        for code, name in CLASSIFICATION.items():
+            if name == mdl.classification:
+                classification = code
+        bbmin, bbmax, radius = self.modelBounds()
+        self.pack('4BI3I', GEOMETRY_HEADER_SIZE,
+                  classification, int(mdl.unknownC1) & 0xFF, 0,
+                  int(not mdl.ignorefog), 0, *animArray)
+        self.pack('I3f3f2f32s4I3I', GEOMETRY_HEADER_SIZE + 20,
+                  0, *(bbmin + bbmax + (radius, mdl.animscale)),
+                  self.fixed(mdl.supermodel, 32), rootOffset, 0,
+                  len(self.mdx), 0, *namesArray)
+
+    def writeGeometryHeader(self, offset, fnPtrs, name, rootOffset,
+                            numNodes, modelType):
+        self.pack('2I32s2I', offset, *fnPtrs[int(self.tsl)],
+                  self.fixed(name, 32), rootOffset, numNodes)
+        self.pack('B', offset + 76, modelType)
+
+    def computeTransforms(self, node, rotation, translation):
+        '''
+        Store the world space rotation and translation of node and its
+        children, needed for skin bind poses and the model bounds.
+        '''
+        localRot = nvb_utils.nwangle2quat(node.orientation)
+        position = quatRotate(rotation, node.position)
+        translation = tuple(t + p for t, p in zip(translation, position))
+        rotation = quatMultiply(rotation, localRot)
+        self.transforms[node.name.lower()] = (rotation, translation)
+        for child in self.children.get(node.name.lower(), []):
+            if child is not node:
+                self.computeTransforms(child, rotation, translation)
+
+    def modelBounds(self):
+        bbmin = [0.0, 0.0, 0.0]
+        bbmax = [0.0, 0.0, 0.0]
+        for node in self.nodes:
+            verts = getattr(node, 'verts', [])
+            if not len(verts) or node.name.lower() not in self.transforms:
+                continue
+            rotation, translation = self.transforms[node.name.lower()]
+            for v in verts:
+                v = quatRotate(rotation, (float(v[0]), float(v[1]), float(v[2])))
+                for axis in range(3):
+                    value = v[axis] + translation[axis]
+                    bbmin[axis] = min(bbmin[axis], value)
+                    bbmax[axis] = max(bbmax[axis], value)
+        center = [(a + b) / 2.0 for a, b in zip(bbmin, bbmax)]
+        radius = sum((b - c)**2 for b, c in zip(bbmax, center)) ** 0.5
+        return tuple(bbmin), tuple(bbmax), radius
+
+    @staticmethod
+    def getFlags(node):
+        if isinstance(node, nvb_node.Lightsaber):
+            return NodeFlag.HEADER | NodeFlag.MESH | NodeFlag.SABER
+        if isinstance(node, nvb_node.Aabb):
+            return NodeFlag.HEADER | NodeFlag.MESH | NodeFlag.AABB
+        if isinstance(node, nvb_node.Danglymesh):
+            return NodeFlag.HEADER | NodeFlag.MESH | NodeFlag.DANGLY
+        if isinstance(node, nvb_node.Skinmesh):
+            return NodeFlag.HEADER | NodeFlag.MESH | NodeFlag.SKIN
+        if isinstance(node, nvb_node.Trimesh):
+            return NodeFlag.HEADER | NodeFlag.MESH
+        if isinstance(node, nvb_node.Emitter):
+            return NodeFlag.HEADER | NodeFlag.EMITTER
+        if isinstance(node, nvb_node.Light):
+            return NodeFlag.HEADER | NodeFlag.LIGHT
+        if isinstance(node, nvb_node.Reference):
+            return NodeFlag.HEADER | NodeFlag.REF
+        return NodeFlag.HEADER
+
+    def writeNode(self, node, parentOffset):
+        flags = self.getFlags(node)
+        size = NODE_HEADER_SIZE
+        if flags & NodeFlag.LIGHT:
+            size += LIGHT_SIZE
+        if flags & NodeFlag.EMITTER:
+            size += EMITTER_SIZE
+        if flags & NodeFlag.REF:
+            size += REFERENCE_SIZE
+        if flags & NodeFlag.MESH:
+            size += TRIMESH_SIZE + (8 if self.tsl else 0)
+        if flags & NodeFlag.SKIN:
+            size += SKIN_SIZE
+        if flags & NodeFlag.DANGLY:
+            size += DANGLY_SIZE
+        if flags & NodeFlag.AABB:
+            size += AABB_SIZE
+        if flags & NodeFlag.SABER:
+            size += SABER_SIZE
+        offset = self.reserve(size)
+
+        dataOffset = offset + NODE_HEADER_SIZE
+        if flags & NodeFlag.LIGHT:
+            self.writeLight(node, dataOffset)
+            dataOffset += LIGHT_SIZE
+        if flags & NodeFlag.EMITTER:
+            self.writeEmitter(node, dataOffset)
+            dataOffset += EMITTER_SIZE
+        if flags & NodeFlag.REF:
+            self.writeReference(node, dataOffset)
+            dataOffset += REFERENCE_SIZE
+        if flags & NodeFlag.MESH:
+            meshOffset = dataOffset
+            dataOffset += TRIMESH_SIZE + (8 if self.tsl else 0)
+            self.writeMesh(node, meshOffset, dataOffset, flags)
+
+        ctrlArray, dataArray = self.writeControllers(self.getNodeControllers(node, flags), flags)
+
+        childOffsets = [self.writeNode(child, offset)
+                        for child in self.children.get(node.name.lower(), [])
+                        if child is not node]
+        childArray = self.appendArray('I', childOffsets)
+
+        number = self.nodeNumbers[node.name.lower()]
+        x, y, z, w = nvb_utils.nwangle2quat(node.orientation)
+        self.pack('4H2I7f9I', offset, flags, number, number, 0, 0,
+                  parentOffset, *node.position, w, x, y, z,
+                  *(childArray + ctrlArray + dataArray))
+        return offset
+
+    def getNodeControllers(self, node, flags):
+        '''
+        Return the controllers of a geometry node as (label, keys) tuples,
+        each holding a single key with the node's value.
+        '''
+        labels = [label for label, _ in self.getControllerLabels(flags).values()]
+        raw = dict()
+        for line in node.rawascii.splitlines():
+            tokens = line.split()
+            if tokens and tokens[0].lower() in labels:
+                raw[tokens[0].lower()] = tokens[1:]
+        controllers = []
+        for label in labels:
+            if label in raw:
+                values = [float(v) for v in raw[label]]
+            elif label == 'orientation' or not hasattr(node, label):
+                continue
+            else:
+                value = getattr(node, label)
+                values = [float(v) for v in value] \
+                    if isinstance(value, tuple) else [float(value)]
+            controllers.append((label, [[0.0] + values]))
+        controllers.append(('orientation', [[0.0] + list(node.orientation)]))
+        return controllers
+
+    @staticmethod
+    def getControllerLabels(flags):
+        return MdlReader.getControllers(flags)
+
+    def writeControllers(self, controllers, flags):
+        '''
+        Append controller records and their data, controllers is a list of
+        (label, keys), keys are [time, values...] lists. Orientations are
+        axis angles. Return the array definitions of records and data.
+        '''
+        codes = dict()
+        for code, (label, numVals) in self.getControllerLabels(flags).items():
+            codes[label] = (code, numVals)
+        records = []
+        data = []
+        for label, keys in controllers:
+            if label not in codes or not keys:
+                continue
+            code, numVals = codes[label]
+            numCols = len(keys[0]) - 1
+            if label == 'orientation':
+                keys = [[k[0]] + list(nvb_utils.nwangle2quat(k[1:5])) for k in keys]
+                numCols = 4
+            columns = numVals
+            if numCols == numVals * 3:
+                columns |= 0x10  # bezier
+            elif numCols != numVals:
+                continue
+            timeIdx = len(data)
+            data.extend(float(k[0]) for k in keys)
+            dataIdx = len(data)
+            for k in keys:
+                data.extend(float(v) for v in k[1:numCols+1])
+            records.append((code, 0xFFFF, len(keys), timeIdx, dataIdx, columns))
+        if not records:
+            return (0, 0, 0), (0, 0, 0)
+        ctrlOffset = self.tell()
+        for record in records:
+            self.append('I4HB3x', *record)
+        ctrlArray = (ctrlOffset, len(records), len(records))
+        return ctrlArray, self.appendArray('f', data)
+
+    def writeLight(self, node, offset):
+        flareList = node.flareList
+        numFlares = len(flareList.textures)
+        sizes = self.appendArray('f', [float(v) for v in flareList.sizes[:numFlares]])
+        positions = self.appendArray('f', [float(v) for v in flareList.positions[:numFlares]])
+        colorshifts = self.appendArray('f', [float(v) for c in flareList.colorshifts[:numFlares] for v in c])
+        if colorshifts[1]:
+            colorshifts = (colorshifts[0], colorshifts[1] // 3, colorshifts[2] // 3)
+        textures = self.appendArray('I', [self.appendString(t) for t in flareList.textures])
+        self.pack('f3I3I3I3I3I7I', offset, node.flareradius, 0, 0, 0,
+                  *(sizes + positions + colorshifts + textures),
+                  node.lightpriority, node.ambientonly, node.ndynamictype,
+                  node.affectdynamic, node.shadow, node.lensflares,
+                  node.fadinglight)
+
+    def writeEmitter(self, node, offset):
+        flags = 0
+        for attrname, mask in EMITTER_FLAGS:
+            if getattr(node, attrname):
+                flags |= mask
+        try:
+            spawntype = int(node.spawntype)
+        except ValueError:
+            spawntype = 0
+        self.pack('3fIf3I32s32s32s32s16s2IHB32sxI', offset,
+                  node.deadspace, node.blastradius, node.blastlength,
+                  int(node.numBranches), float(node.controlptsmoothing),
+                  int(node.xgrid), int(node.ygrid), spawntype,
+                  self.fixed(node.update, 32), self.fixed(node.render, 32),
+                  self.fixed(node.blend, 32), self.fixed(node.texture, 32),
+                  self.fixed(node.chunkName, 16), int(node.twosidedtex),
+                  int(node.loop), int(node.renderorder),
+                  int(node.m_bFrameBlending),
+                  self.fixed(node.m_sDepthTextureName, 32), flags)
+
+    def writeReference(self, node, offset):
+        self.pack('32sI', offset, self.fixed(node.refmodel, 32),
+                  int(node.reattachable))
+
+    def getMeshVertices(self, node):
+        '''
+        Binary meshes store one uv and normal per vertex, split vertices
+        which use different uvs or normals in different faces. Vertices are
+        only split if their normals differ by more than NORMAL_TOLERANCE.
+        Returns the new faces, for every new vertex the (vertex, uv,
+        lightmap uv) indices it came from, and the vertex normals.
+        '''
+        facelist = node.facelist
+        numFaces = len(facelist.faces)
+        components, compNormals = self.getCornerNormals(node)
+        if numpy is not None:
+            corners = numpy.empty((numFaces * 3, 4), dtype=numpy.int64)
+            corners[:, 0] = numpy.asarray(facelist.faces, dtype=numpy.int64).reshape(-1)
+            corners[:, 1] = numpy.asarray(facelist.uvIdx, dtype=numpy.int64).reshape(-1) \
+                if len(node.tverts) else -1
+            corners[:, 2] = numpy.asarray(node.texindices1, dtype=numpy.int64).reshape(-1) \
+                if len(node.tverts1) else -1
+            corners[:, 3] = components
+            # Unique corners, in the order they first appear
+            _, first, inverse = numpy.unique(corners, axis=0,
+                                             return_index=True, return_inverse=True)
+            order = numpy.argsort(first)
+            rank = numpy.empty_like(order)
+            rank[order] = numpy.arange(len(order))
+            candidates = corners[first[order]].tolist()
+            cornerCandidates = rank[inverse.reshape(-1)].tolist()
+        else:
+            uvIdx = facelist.uvIdx if len(node.tverts) else None
+            uvIdx1 = node.texindices1 if len(node.tverts1) else None
+            candidateMap = dict()
+            candidates = []
+            cornerCandidates = []
+            for faceIdx, face in enumerate(facelist.faces):
+                for corner in range(3):
+                    key = (int(face[corner]),
+                           int(uvIdx[faceIdx][corner]) if uvIdx is not None else -1,
+                           int(uvIdx1[faceIdx][corner]) if uvIdx1 is not None else -1,
+                           components[faceIdx*3 + corner])
+                    idx = candidateMap.get(key)
+                    if idx is None:
+                        idx = len(candidates)
+                        candidateMap[key] = idx
+                        candidates.append(key)
+                    cornerCandidates.append(idx)
+
+        # Candidates of the same vertex and uvs with close normals are merged
+        vertMap = dict()  # (vertex, uv, lightmap uv) -> new vertex indices
+        sources = []
+        vertNormals = []
+        newIndices = []
+        for candidate in candidates:
+            key = tuple(candidate[:3])
+            normal = compNormals[candidate[3]]
+            for idx in vertMap.get(key, ()):
+                if max(abs(a - b) for a, b in zip(normal, vertNormals[idx])) <= NORMAL_TOLERANCE:
+                    break
+            else:
+                idx = len(sources)
+                vertMap.setdefault(key, []).append(idx)
+                sources.append(key)
+                vertNormals.append(normal)
+            newIndices.append(idx)
+        faces = [[newIndices[cornerCandidates[i]] for i in range(start, start + 3)]
+                 for start in range(0, numFaces * 3, 3)]
+        return faces, sources, vertNormals
+
+    @staticmethod
+    def getCornerNormals(node):
+        '''
+        Return the smoothing component of every face corner (three per
+        face, in face order) and the normal of every component. Faces
+        around a vertex which share a smoothing group (bit flags), directly
+        or through other faces, form one component, its normal is the area
+        weighted sum of their normals. Faces of group 0 are flat.
+        '''
+        facelist = node.facelist
+        if numpy is not None:
+            faces = numpy.asarray(facelist.faces, dtype=numpy.int64).reshape(-1, 3)
+            if not len(faces):
+                return [], []
+            verts = numpy.asarray(node.verts, dtype=numpy.float64).reshape(-1, 3)
+            masks = numpy.asarray(facelist.shdgr, dtype=numpy.int64) & 0xFFFFFFFF
+            crosses = numpy.cross(verts[faces[:, 1]] - verts[faces[:, 0]],
+                                  verts[faces[:, 2]] - verts[faces[:, 0]])
+            cornerVerts = faces.reshape(-1)
+            cornerFaces = numpy.repeat(numpy.arange(len(faces)), 3)
+            cornerMasks = masks[cornerFaces]
+            # Grow the groups of every corner by the groups of the faces
+            # around its vertex sharing one of them, until nothing changes
+            usedBits = int(numpy.bitwise_or.reduce(masks))
+            bits = [b for b in range(32) if usedBits >> b & 1]
+            changed = len(bits) > 1
+            while changed:
+                changed = False
+                for b in bits:
+                    has = (cornerMasks >> b & 1).astype(bool)
+                    vertMasks = numpy.zeros(len(verts), dtype=numpy.int64)
+                    numpy.bitwise_or.at(vertMasks, cornerVerts[has], cornerMasks[has])
+                    grown = cornerMasks[has] | vertMasks[cornerVerts[has]]
+                    if numpy.any(grown != cornerMasks[has]):
+                        cornerMasks[has] = grown
+                        changed = True
+            # Grown groups of one vertex are either equal or disjoint
+            groups = numpy.where(cornerMasks > 0, cornerMasks, -1 - cornerFaces)
+            keys = cornerVerts << 34 | (groups + 2**33)
+            _, components = numpy.unique(keys, return_inverse=True)
+            components = components.reshape(-1)
+            numComponents = int(components.max()) + 1
+            sums = numpy.stack([numpy.bincount(components, crosses[cornerFaces, axis],
+                                               numComponents)
+                                for axis in range(3)], axis=1)
+            lengths = numpy.sqrt((sums * sums).sum(axis=1))
+            valid = lengths > 0.0
+            compNormals = numpy.empty_like(sums)
+            compNormals[:] = (0.0, 0.0, 1.0)
+            compNormals[valid] = sums[valid] / lengths[valid, None]
+            return components.tolist(), [tuple(n) for n in compNormals.tolist()]
+
+        crosses = []
+        vertFaces = dict()
+        for face in facelist.faces:
+            face = [int(i) for i in face]
+            v0, v1, v2 = (tuple(float(c) for c in node.verts[i]) for i in face)
+            e1 = [b - a for a, b in zip(v0, v1)]
+            e2 = [b - a for a, b in zip(v0, v2)]
+            crosses.append((e1[1]*e2[2] - e1[2]*e2[1],
+                            e1[2]*e2[0] - e1[0]*e2[2],
+                            e1[0]*e2[1] - e1[1]*e2[0]))
+            for i in face:
+                vertFaces.setdefault(i, []).append(len(crosses) - 1)
+
+        # Merge the faces around every vertex into components
+        cornerComponents = dict()  # (vertex, face) -> component
+        compSums = []
+        for vert, faceIndices in vertFaces.items():
+            groups = []  # [mask, faces]
+            for faceIdx in faceIndices:
+                mask = int(facelist.shdgr[faceIdx]) & 0xFFFFFFFF
+                group = [mask, [faceIdx]]
+                if mask:
+                    for other in [g for g in groups if g[0] & mask]:
+                        groups.remove(other)
+                        group[0] |= other[0]
+                        group[1].extend(other[1])
+                groups.append(group)
+            for _, groupFaces in groups:
+                acc = [0.0, 0.0, 0.0]
+                for faceIdx in groupFaces:
+                    cornerComponents[(vert, faceIdx)] = len(compSums)
+                    for axis in range(3):
+                        acc[axis] += crosses[faceIdx][axis]
+                compSums.append(acc)
+
+        components = [cornerComponents[(int(i), faceIdx)]
+                      for faceIdx, face in enumerate(facelist.faces) for i in face]
+        compNormals = []
+        for acc in compSums:
+            length = sum(c*c for c in acc) ** 0.5
+            compNormals.append(tuple(c / length for c in acc) if length > 0.0
+                               else (0.0, 0.0, 1.0))
+        return components, compNormals
+
+    def writeMesh(self, node, offset, extOffset, flags):
+        faces, sources, normals = self.getMeshVertices(node)
+        numVerts = len(sources)
+        if numVerts > 0xFFFF:
+            raise nvb_def.MalformedMdlFile('Too many vertices in ' + node.name)
+        verts = [tuple(float(c) for c in node.verts[s[0]]) for s in sources]
+
+        # Face normals, plane distances and areas
+        faceData = []
+        totalArea = 0.0
+        for face in faces:
+            v0, v1, v2 = (verts[i] for i in face)
+            e1 = [b - a for a, b in zip(v0, v1)]
+            e2 = [b - a for a, b in zip(v0, v2)]
+            cross = (e1[1]*e2[2] - e1[2]*e2[1],
+                     e1[2]*e2[0] - e1[0]*e2[2],
+                     e1[0]*e2[1] - e1[1]*e2[0])
+            length = sum(c*c for c in cross) ** 0.5
+            totalArea += length / 2.0
+            normal = tuple(c / length for c in cross) if length > 0.0 else (0.0, 0.0, 1.0)
+            distance = -sum(n*v for n, v in zip(normal, v0))
+            faceData.append((normal, distance))
+
+        # Adjacent faces share an edge of original vertices
+        edges = dict()
+        for faceIdx, face in enumerate(faces):
+            for corner in range(3):
+                a = sources[face[corner]][0]
+                b = sources[face[(corner+1) % 3]][0]
+                edges.setdefault((min(a, b), max(a, b)), []).append(faceIdx)
+        matIds = node.facelist.matId
+        facesOffset = self.tell()
+        for faceIdx, face in enumerate(faces):
+            adjacent = []
+            for corner in range(3):
+                a = sources[face[corner]][0]
+                b = sources[face[(corner+1) % 3]][0]
+                shared = [f for f in edges[(min(a, b), max(a, b))] if f != faceIdx]
+                adjacent.append(shared[0] if shared else 0xFFFF)
+            normal, distance = faceData[faceIdx]
+            self.append('4fI6H', *normal, distance, int(matIds[faceIdx]),
+                        *(adjacent + face))
+        facesArray = (facesOffset if faces else 0, len(faces), len(faces))
+
+        if verts:
+            bbmin = tuple(min(v[axis] for v in verts) for axis in range(3))
+            bbmax = tuple(max(v[axis] for v in verts) for axis in range(3))
+            average = tuple(sum(v[axis] for v in verts) / numVerts for axis in range(3))
+        else:
+            bbmin = bbmax = average = (0.0, 0.0, 0.0)
+        radius = max([sum((c - a)**2 for c, a in zip(v, average)) ** 0.5
+                      for v in verts] or [0.0])
+
+        # Vertex indices, their count and the inverted mesh counter
+        indicesOffset = self.appendArray('H', [i for face in faces for i in face])[0]
+        indicesCountArray = self.appendArray('I', [len(faces) * 3])
+        indicesOffsetArray = self.appendArray('I', [indicesOffset])
+        self.meshCount += 1
+        quo, rem = divmod(self.meshCount, 100)
+        invCounter = (2**quo) * 100 - self.meshCount + (100 if rem else 0) - (0 if quo else 1)
+        invCounterArray = self.appendArray('I', [invCounter])
+        vertsOffset = self.appendArray('f', [c for v in verts for c in v])[0]
+
+        # Interleaved vertex data in the mdx
+        uvs = [tuple(float(c) for c in node.tverts[s[1]]) for s in sources] \
+            if len(node.tverts) else None
+        uvs1 = [tuple(float(c) for c in node.tverts1[s[2]]) for s in sources] \
+            if len(node.tverts1) else None
+        layout = [('verts', MdxFlag.VERTEX, 3, verts),
+                  ('normals', MdxFlag.NORMAL, 3, normals)]
+        if uvs is not None:
+            layout.append(('uv1', MdxFlag.UV1, 2, uvs))
+        if uvs1 is not None:
+            layout.append(('uv2', MdxFlag.UV2, 2, uvs1))
+        if flags & NodeFlag.SKIN:
+            weights, bones = self.getSkinVertices(node, sources)
+            layout.append(('weights', 0, 4, weights))
+            layout.append(('bones', 0, 4, bones))
+        mdxOffsets = dict()
+        mdxBitmap = 0
+        stride = 0
+        for name, flag, numVals, _ in layout:
+            mdxOffsets[name] = stride
+            mdxBitmap |= flag
+            stride += 4 * numVals
+        mdxOffset = len(self.mdx)
+        row = struct.Struct('<{}f'.format(stride // 4))
+        for idx in range(numVerts):
+            self.mdx.extend(row.pack(*[c for _, _, _, values in layout for c in values[idx]]))
+        # The vertex data of each mesh is terminated by an extra row
+        self.mdx.extend(row.pack(*([10000000.0] * 3 + [0.0] * (stride // 4 - 3))))
+
+        def mdxOffsetOf(name):
+            return mdxOffsets.get(name, MDX_NONE)
+
+        fnPtrs = FN_PTRS_MESH
+        if flags & NodeFlag.SKIN:
+            fnPtrs = FN_PTRS_SKIN
+        elif flags & NodeFlag.DANGLY:
+            fnPtrs = FN_PTRS_DANGLY
+        numTextures = sum(1 for t in (node.bitmap, node.bitmap2) if not nvb_utils.isNull(t))
+        self.pack('2I3I3f3ff3f3f3fI32s32s12s12s9I2iI8xI4f', offset,
+                  *fnPtrs[int(self.tsl)], *facesArray, *bbmin, *bbmax,
+                  radius, *average, *node.diffuse, *node.ambient,
+                  int(node.transparencyhint),
+                  self.fixed(node.bitmap, 32), self.fixed(node.bitmap2, 32),
+                  b'', b'', *(indicesCountArray + indicesOffsetArray + invCounterArray),
+                  -1, -1, 0, int(node.animateuv), node.uvdirectionx,
+                  node.uvdirectiony, node.uvjitter, node.uvjitterspeed)
+        self.pack('13I2H6B', offset + 252, stride, mdxBitmap,
+                  mdxOffsetOf('verts'), mdxOffsetOf('normals'), MDX_NONE,
+                  mdxOffsetOf('uv1'), mdxOffsetOf('uv2'), MDX_NONE, MDX_NONE,
+                  MDX_NONE, MDX_NONE, MDX_NONE, MDX_NONE,
+                  numVerts, numTextures, int(node.lightmapped),
+                  int(node.rotatetexture), int(node.m_bIsBackgroundGeometry),
+                  int(node.shadow), int(node.beaming), int(node.render))
+        tail = offset + 314
+        if self.tsl:
+            self.pack('BxHHBx', tail, int(node.dirt_enabled),
+                      int(node.dirt_texture), int(node.dirt_worldspace),
+                      int(node.hologram_donotdraw))
+            tail += 8
+        self.pack('2xfI2I', tail, totalArea, 0, mdxOffset, vertsOffset)
+
+        if flags & NodeFlag.SKIN:
+            self.writeSkin(node, extOffset, mdxOffset, mdxOffsets)
+        elif flags & NodeFlag.DANGLY:
+            self.writeDangly(node, extOffset, sources, verts)
+        elif flags & NodeFlag.AABB:
+            self.writeAabb(node, extOffset, faces, verts)
+        elif flags & NodeFlag.SABER:
+            self.writeSaber(node, extOffset, verts, uvs, normals)
+
+    def getSkinVertices(self, node, sources):
+        '''
+        Return bone weights and indices, four per vertex. Bone indices
+        refer to the bones used by this skin, see writeSkin.
+        '''
+        bones = []
+        for memberships in node.weights:
+            for name, _ in memberships:
+                number = self.nodeNumbers.get(name.lower())
+                if number is not None and number not in bones:
+                    bones.append(number)
+        bones.sort()
+        self.skinBones[node.name.lower()] = bones
+        boneIdx = {number: idx for idx, number in enumerate(bones)}
+        vertWeights = []
+        vertBones = []
+        for source in sources:
+            memberships = node.weights[source[0]] if source[0] < len(node.weights) else []
+            weights = []
+            indices = []
+            for name, weight in memberships[:4]:
+                number = self.nodeNumbers.get(name.lower())
+                if number is not None:
+                    weights.append(float(weight))
+                    indices.append(float(boneIdx[number]))
+            weights += [0.0] * (4 - len(weights))
+            indices += [-1.0] * (4 - len(indices))
+            vertWeights.append(weights)
+            vertBones.append(indices)
+        return vertWeights, vertBones
+
+    def writeSkin(self, node, offset, mdxOffset, mdxOffsets):
+        bones = self.skinBones[node.name.lower()]
+        numNodes = len(self.names)
+        bonemap = [-1.0] * numNodes
+        for idx, number in enumerate(bones):
+            bonemap[number] = float(idx)
+        # Inverse bind poses, transform from skin space to bone space
+        skinRot, skinPos = self.transforms.get(node.name.lower(),
+                                               ((0.0, 0.0, 0.0, 1.0), (0.0, 0.0, 0.0)))
+        qbones = []
+        tbones = []
+        for name in self.names:
+            boneRot, bonePos = self.transforms.get(name.lower(),
+                                                   ((0.0, 0.0, 0.0, 1.0), (0.0, 0.0, 0.0)))
+            invRot = quatConjugate(boneRot)
+            rot = quatMultiply(invRot, skinRot)
+            pos = quatRotate(invRot, [s - b for s, b in zip(skinPos, bonePos)])
+            qbones.extend((rot[3], rot[0], rot[1], rot[2]))
+            tbones.extend(pos)
+        bonemapOffset = self.appendArray('f', bonemap)[0]
+        qbonesArray = self.appendArray('f', qbones)
+        qbonesArray = (qbonesArray[0], numNodes, numNodes)
+        tbonesArray = self.appendArray('f', tbones)
+        tbonesArray = (tbonesArray[0], numNodes, numNodes)
+        garbageArray = self.appendArray('I', [0] * numNodes)
+        boneNodes = (bones + [0] * 16)[:16]
+        self.pack('3I4I9I16H', offset, 0, 0, 0,
+                  mdxOffsets['weights'], mdxOffsets['bones'],
+                  bonemapOffset, numNodes,
+                  *(qbonesArray + tbonesArray + garbageArray), *boneNodes)
+
+    def writeDangly(self, node, offset, sources, verts):
+        constraints = [float(node.constraints[s[0]]) if s[0] < len(node.constraints) else 0.0
+                       for s in sources]
+        constraintsArray = self.appendArray('f', constraints)
+        vertsOffset = self.appendArray('f', [c for v in verts for c in v])[0]
+        self.pack('3I3fI', offset, *constraintsArray, node.displacement,
+                  node.tightness, node.period, vertsOffset)
+
+    def writeAabb(self, node, offset, faces, verts):
+        tree = node.aabbTree
+        if not tree and faces:
+            tree = []
+            nvb_aabb.generateMeshTree(tree, verts, faces)
+        rootOffset = 0
+        if tree:
+            rootOffset = self.writeAabbNode(tree, 0)[0]
+        self.pack('I', offset, rootOffset)
+
+    def writeAabbNode(self, tree, idx):
+        '''
+        Write the tree node at idx of the pre-order list tree and its
+        children. Return its offset and the index after its subtree.
+        '''
+        values = tree[idx]
+        offset = self.reserve(AABB_NODE_SIZE)
+        faceIdx = int(values[6])
+        if faceIdx >= 0:
+            self.pack('6f2IiI', offset, *values[:6], 0, 0, faceIdx, 0)
+            return offset, idx + 1
+        left, idx = self.writeAabbNode(tree, idx + 1)
+        right, idx = self.writeAabbNode(tree, idx)
+        size = [values[3+axis] - values[axis] for axis in range(3)]
+        plane = (1, 2, 4)[size.index(max(size))]
+        self.pack('6f2IiI', offset, *values[:6], left, right, -1, plane)
+        return offset, idx
+
+    def writeSaber(self, node, offset, verts, uvs, normals):
+        vertsOffset = self.appendArray('f', [c for v in verts for c in v])[0]
+        uvsOffset = self.appendArray('f', [c for v in (uvs or []) for c in v])[0]
+        normalsOffset = self.appendArray('f', [c for v in normals for c in v])[0]
+        self.pack('5I', offset, vertsOffset, uvsOffset, normalsOffset, 0, 0)
+
+    def writeAnimation(self, anim):
+        offset = self.reserve(ANIM_HEADER_SIZE)
+        eventsOffset = self.tell()
+        for time, name in anim.events:
+            self.append('f32s', float(time), self.fixed(name, 32))
+        eventsArray = (eventsOffset if anim.events else 0,
+                       len(anim.events), len(anim.events))
+
+        animNames = set(node.name for node in anim.nodes)
+        children = dict()
+        roots = []
+        for node in anim.nodes:
+            if node.parentName in animNames and node.parentName != node.name:
+                children.setdefault(node.parentName, []).append(node)
+            else:
+                roots.append(node)
+        rootOffset = 0
+        if roots:
+            rootOffset = self.writeAnimNode(roots[0], 0, children)
+        self.writeGeometryHeader(offset, FN_PTRS_ANIM, anim.name, rootOffset,
+                                 len(anim.nodes), MODEL_TYPE_ANIM)
+        root = anim.root if not nvb_utils.isNull(anim.root) else anim.animroot
+        self.pack('2f32s3I', offset + GEOMETRY_HEADER_SIZE, anim.length,
+                  anim.transtime, self.fixed(root, 32), *eventsArray)
+        return offset
+
+    def writeAnimNode(self, node, parentOffset, children):
+        offset = self.reserve(NODE_HEADER_SIZE)
+        number = self.nodeNumbers.get(node.name.lower(), 0)
+        geometry = self.nodes[number] if number < len(self.nodes) else None
+        flags = self.getFlags(geometry) if geometry is not None else NodeFlag.HEADER
+        controllers = []
+        for keyData in (node.object_data, node.material_data, node.emitter_data):
+            for label, (keys, _, _) in keyData.items():
+                controllers.append((label.lower(), keys))
+        ctrlArray, dataArray = self.writeControllers(controllers, flags)
+        childOffsets = [self.writeAnimNode(child, offset, children)
+                        for child in children.get(node.name, [])]
+        childArray = self.appendArray('I', childOffsets)
+        self.pack('4H2I7f9I', offset, NodeFlag.HEADER, number, number, 0, 0,
+                  parentOffset, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0,
+                  *(childArray + ctrlArray + dataArray))
+        return offset
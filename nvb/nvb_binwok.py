@@ -0,0 +1,464 @@
+"""Reader and writer for binary KotOR walkmeshes (wok, pwk and dwk)."""
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import nvb_def
+from . import nvb_node
+from . import nvb_parse
+from . import nvb_aabb
+
+
+BWM_SIGNATURE   = b'BWM V1.0'
+BWM_HEADER_SIZE = 136
+BWM_AABB_SIZE   = 44
+
+# Walkmesh types of the header
+WALKMESH_TYPE_PWK = 0  # placeables and doors
+WALKMESH_TYPE_WOK = 1  # area rooms
+
+# Door walkmeshes are split into one file per state, e.g. door0.dwk
+DOOR_STATES = ('closed', 'open1', 'open2')
+
+# Child index of aabb leaves
+BWM_NONE = 0xFFFFFFFF
+
+
+def isBinaryWalkmesh(filepath):
+    '''
+    Check the signature of a walkmesh file.
+    '''
+    try:
+        with open(filepath, 'rb') as f:
+            return f.read(len(BWM_SIGNATURE)) == BWM_SIGNATURE
+    except IOError:
+        return False
+
+
+def getWalkmeshFiles(filepath, wkmType):
+    '''
+    Return the binary walkmesh files for the walkmesh at filepath as a list
+    of (path, door state) tuples. Door walkmeshes may be split into one
+    file per state, the state is None for all other walkmeshes.
+    '''
+    if wkmType == 'dwk':
+        root, ext = os.path.splitext(filepath)
+        files = []
+        for idx, state in enumerate(DOOR_STATES):
+            path = '{}{}{}'.format(root, idx, ext)
+            if isBinaryWalkmesh(path):
+                files.append((path, state))
+        if files:
+            return files
+    if isBinaryWalkmesh(filepath):
+        return [(filepath, None)]
+    return []
+
+
+def isWalkable(material):
+    return material not in nvb_def.WkmMaterial.NONWALKABLE
+
+
+class BwmReader():
+    '''
+    Reads binary walkmesh data into an nvb_mdl.Xwk.
+
+    Binary walkmeshes hold no names, the nodes are named after the model
+    the way the ascii walkmeshes exported by kotorblender are. Vertices
+    and faces are numpy views of the data if numpy is available.
+    '''
+    def __init__(self, data):
+        self.data = memoryview(data)
+
+    @classmethod
+    def fromFile(cls, filepath):
+        with open(filepath, 'rb') as f:
+            return cls(f.read())
+
+    def unpack(self, fmt, offset):
+        return struct.unpack_from('<' + fmt, self.data, offset)
+
+    def load(self, wkm, name, state = None):
+        try:
+            self.loadWalkmesh(wkm, name, state)
+        except (struct.error, IndexError, ValueError, TypeError) as e:
+            raise nvb_def.MalformedMdlFile('Invalid binary walkmesh: ' + str(e))
+
+    def loadWalkmesh(self, wkm, name, state):
+        header = self.unpack('8sI15f16I', 0)
+        if header[0] != BWM_SIGNATURE:
+            raise nvb_def.MalformedMdlFile('Invalid binary walkmesh signature')
+        usePositions = (header[2:5], header[5:8])
+        position = header[14:17]
+        (numVerts, vertsOffset, numFaces, facesOffset, materialsOffset,
+         _, _, numAabbs, aabbsOffset, _, _, _,
+         numEdges, edgesOffset, _, _) = header[17:]
+
+        rootName = name + '_' + wkm.walkmeshType
+        if wkm.walkmeshType == 'wok':
+            mesh = nvb_node.Aabb(name)
+        elif wkm.walkmeshType == 'dwk':
+            mesh = nvb_node.Trimesh(rootName + '_wg_' + (state or DOOR_STATES[0]))
+            mesh.parentName = rootName
+        else:
+            mesh = nvb_node.Trimesh(name + '_wg')
+            mesh.parentName = rootName
+        mesh.roottype = wkm.walkmeshType
+        mesh.rootname = name
+        mesh.position = position
+
+        # Area walkmeshes are in world space, others are relative to the
+        # walkmesh position
+        mesh.verts = self.loadVerts(vertsOffset, numVerts)
+        if wkm.walkmeshType != 'wok':
+            mesh.verts = self.translate(mesh.verts, position, -1.0)
+        self.loadFaces(mesh, facesOffset, materialsOffset, numFaces)
+
+        if wkm.walkmeshType == 'wok':
+            mesh.aabbTree = self.loadAabbTree(aabbsOffset, numAabbs)
+            for idx in range(numEdges):
+                edge, transition = self.unpack('2i', edgesOffset + idx * 8)
+                if transition >= 0:
+                    mesh.roomlinks.append((edge, transition))
+        wkm.addNode(mesh)
+
+        if wkm.walkmeshType != 'wok':
+            for idx, usePosition in enumerate(usePositions):
+                if wkm.walkmeshType == 'dwk':
+                    useName = '{}_dp_{}_{:02d}'.format(rootName, state or DOOR_STATES[0], idx+1)
+                else:
+                    useName = '{}_use{:02d}'.format(rootName, idx+1)
+                dummy = nvb_node.Dummy(useName)
+                dummy.parentName = rootName
+                dummy.roottype = wkm.walkmeshType
+                dummy.rootname = name
+                dummy.position = usePosition
+                wkm.addNode(dummy)
+
+    def loadVerts(self, offset, count):
+        if count == 0:
+            return []
+        if offset + count * 12 > len(self.data):
+            raise nvb_def.MalformedMdlFile('Vertex data out of bounds')
+        if numpy is not None:
+            return numpy.frombuffer(self.data, dtype='<f4', count=count*3,
+                                    offset=offset).reshape(count, 3)
+        return nvb_parse.Rows('f', 3, self.unpack('{}f'.format(count*3), offset))
+
+    @staticmethod
+    def translate(verts, position, sign):
+        if not any(position):
+            return verts
+        if numpy is not None and isinstance(verts, numpy.ndarray):
+            return verts + numpy.array(position, dtype=numpy.float32) * sign
+        translated = nvb_parse.Rows('f', 3)
+        for v in verts:
+            translated.append([c + p * sign for c, p in zip(v, position)])
+        return translated
+
+    def loadFaces(self, mesh, facesOffset, materialsOffset, count):
+        '''
+        Binary walkmeshes have no smoothing groups or uvs, every face is
+        put in group 1 and texture indices equal vertex indices.
+        '''
+        facelist = mesh.facelist
+        if count == 0:
+            return
+        if numpy is not None:
+            faces = numpy.frombuffer(self.data, dtype='<u4', count=count*3,
+                                     offset=facesOffset)
+            facelist.faces = faces.reshape(count, 3).astype(numpy.int32)
+            facelist.uvIdx = facelist.faces.copy()
+            facelist.matId = numpy.frombuffer(self.data, dtype='<u4', count=count,
+                                              offset=materialsOffset).astype(numpy.int32)
+            facelist.shdgr = numpy.ones(count, dtype=numpy.int32)
+            return
+        for idx in range(count):
+            face = self.unpack('3I', facesOffset + idx * 12)
+            facelist.faces.append(face)
+            facelist.uvIdx.append(face)
+            facelist.matId.append(self.unpack('I', materialsOffset + idx * 4)[0])
+            facelist.shdgr.append(1)
+
+    def loadAabbTree(self, offset, count):
+        '''
+        Return the tree nodes in pre-order, like they are written to ascii
+        walkmeshes, (bbmin x, y, z, bbmax x, y, z, face index).
+        '''
+        tree = []
+        if count == 0:
+            return tree
+        stack = [0]
+        while stack:
+            idx = stack.pop()
+            if len(tree) >= count:
+                raise nvb_def.MalformedMdlFile('Invalid aabb tree')
+            values = self.unpack('6fi4I', offset + idx * BWM_AABB_SIZE)
+            tree.append(values[:7])
+            if values[6] < 0:
+                stack.append(values[10])
+                stack.append(values[9])
+        return tree
+
+
+class BwmWriter():
+    '''
+    Writes a walkmesh mesh node as binary walkmesh data.
+
+    Area walkmeshes (wok) store their faces sorted with the walkable faces
+    first, along with an aabb tree, the adjacency of the walkable faces
+    and the perimeter edges with their room links. Vertices of an area
+    walkmesh are in world space already, the vertices of all other
+    walkmeshes are translated by the position of their mesh.
+    '''
+    def __init__(self, mesh, wkmType, usePositions = (), rootPosition = (0.0, 0.0, 0.0)):
+        self.mesh = mesh
+        self.wkmType = wkmType
+        self.usePositions = (list(usePositions) + [(0.0, 0.0, 0.0)] * 2)[:2]
+        self.rootPosition = rootPosition
+
+        self.out = bytearray()
+
+    def append(self, fmt, *values):
+        offset = len(self.out)
+        self.out.extend(struct.pack('<' + fmt, *values))
+        return offset
+
+    def appendArray(self, fmt, values):
+        offset = len(self.out)
+        if values:
+            self.append('{}{}'.format(len(values), fmt), *values)
+        return offset
+
+    def write(self):
+        try:
+            return self.writeWalkmesh()
+        except (struct.error, IndexError, ValueError, TypeError) as e:
+            raise nvb_def.MalformedMdlFile('Unable to write binary walkmesh: ' + str(e))
+
+    def writeWalkmesh(self):
+        mesh = self.mesh
+        wok = self.wkmType == 'wok'
+        position = tuple(float(c) for c in mesh.position)
+        verts = [tuple(float(c) for c in v) for v in mesh.verts]
+        if not wok:
+            verts = [tuple(c + p for c, p in zip(v, position)) for v in verts]
+
+        faces = [tuple(int(i) for i in face) for face in mesh.facelist.faces]
+        materials = [int(m) for m in mesh.facelist.matId]
+        order = list(range(len(faces)))
+        if wok:
+            # Walkable faces first, the order is kept otherwise
+            order.sort(key=lambda idx: not isWalkable(materials[idx]))
+            faces = [faces[idx] for idx in order]
+            materials = [materials[idx] for idx in order]
+        numWalkable = sum(1 for m in materials if isWalkable(m))
+
+        normals = []
+        distances = []
+        for face in faces:
+            v0, v1, v2 = (verts[i] for i in face)
+            e1 = [b - a for a, b in zip(v0, v1)]
+            e2 = [b - a for a, b in zip(v0, v2)]
+            n = (e1[1]*e2[2] - e1[2]*e2[1],
+                 e1[2]*e2[0] - e1[0]*e2[2],
+                 e1[0]*e2[1] - e1[1]*e2[0])
+            length = sum(c*c for c in n) ** 0.5
+            n = tuple(c / length for c in n) if length > 0.0 else (0.0, 0.0, 1.0)
+            normals.append(n)
+            distances.append(-sum(a*b for a, b in zip(n, v0)))
+
+        self.out.extend(bytes(BWM_HEADER_SIZE))
+        vertsOffset = self.appendArray('f', [c for v in verts for c in v])
+        facesOffset = self.appendArray('I', [i for face in faces for i in face])
+        materialsOffset = self.appendArray('I', materials)
+        normalsOffset = self.appendArray('f', [c for n in normals for c in n])
+        distancesOffset = self.appendArray('f', distances)
+
+        aabbs = []
+        adjacency = []
+        edges = []
+        perimeters = []
+        if wok:
+            aabbs = self.getAabbTree(faces, verts, order)
+            adjacency, edges, perimeters = self.getEdges(faces, numWalkable)
+        aabbsOffset = len(self.out)
+        for values in aabbs:
+            self.append('6fi4I', *values)
+        adjacencyOffset = self.appendArray('i', [i for adj in adjacency for i in adj])
+        edgesOffset = self.appendArray('i', [i for edge in edges for i in edge])
+        perimetersOffset = self.appendArray('I', perimeters)
+
+        wkmType = WALKMESH_TYPE_WOK if wok else WALKMESH_TYPE_PWK
+        relUse = [tuple(float(c) for c in p) for p in self.usePositions]
+        absUse = [tuple(c + r for c, r in zip(p, self.rootPosition)) for p in relUse]
+        struct.pack_into('<8sI15f16I', self.out, 0, BWM_SIGNATURE, wkmType,
+                         *(relUse[0] + relUse[1] + absUse[0] + absUse[1]),
+                         *position,
+                         len(verts), vertsOffset, len(faces), facesOffset,
+                         materialsOffset, normalsOffset, distancesOffset,
+                         len(aabbs), aabbsOffset, 0,
+                         len(adjacency), adjacencyOffset,
+                         len(edges), edgesOffset,
+                         len(perimeters), perimetersOffset)
+        if aabbs:
+            self.checkAabbTree(aabbs, aabbsOffset, faces, verts)
+        return bytes(self.out)
+
+    def checkAabbTree(self, aabbs, aabbsOffset, faces, verts):
+        '''
+        Read the written aabb tree back and make sure it is the one we
+        meant to write: every face is in exactly one leaf, and the bounds
+        of a leaf contain the vertices of its face.
+        '''
+        tree = BwmReader(self.out).loadAabbTree(aabbsOffset, len(aabbs))
+        expected = [struct.unpack('<6fi', struct.pack('<6fi', *values[:7]))
+                    for values in aabbs]
+        if tree != expected:
+            raise nvb_def.MalformedMdlFile('Written aabb tree does not match the mesh')
+        leaves = sorted(node[6] for node in tree if node[6] >= 0)
+        if leaves != list(range(len(faces))):
+            raise nvb_def.MalformedMdlFile('Aabb tree does not hold every face once')
+        for node in tree:
+            if node[6] < 0:
+                continue
+            for vert in (verts[i] for i in faces[node[6]]):
+                for axis in range(3):
+                    # Bounds are single precision
+                    slack = 0.0001 * max(1.0, abs(vert[axis]))
+                    if not (node[axis] - slack <= vert[axis] <= node[3+axis] + slack):
+                        raise nvb_def.MalformedMdlFile(
+                            'Aabb of face {:d} does not contain its vertices'.format(node[6]))
+
+    def getAabbTree(self, faces, verts, order):
+        '''
+        Return the aabb tree as list of binary tree nodes. An existing tree
+        of the mesh is reused, otherwise it is generated.
+        '''
+        tree = list(getattr(self.mesh, 'aabbTree', []))
+        if tree:
+            newIndex = {old: new for new, old in enumerate(order)}
+            tree = [tuple(node[:6]) + (newIndex[int(node[6])] if node[6] >= 0 else -1,)
+                    for node in tree]
+        elif faces:
+            nvb_aabb.generateMeshTree(tree, verts, faces)
+        aabbs = []
+
+        def addNode(idx):
+            node = tree[idx]
+            entry = len(aabbs)
+            aabbs.append(None)
+            if int(node[6]) >= 0:
+                aabbs[entry] = tuple(node[:6]) + (int(node[6]), 4, 0, BWM_NONE, BWM_NONE)
+                return idx + 1
+            left = len(aabbs)
+            idx = addNode(idx + 1)
+            right = len(aabbs)
+            idx = addNode(idx)
+            size = [node[3+axis] - node[axis] for axis in range(3)]
+            plane = (1, 2, 4)[size.index(max(size))]
+            aabbs[entry] = tuple(node[:6]) + (-1, 4, plane, left, right)
+            return idx
+
+        if tree:
+            addNode(0)
+        return aabbs
+
+    def getEdges(self, faces, numWalkable):
+        '''
+        Return the adjacency of the walkable faces, the perimeter edges
+        with their room links and the perimeter loops. Edges are numbered
+        face index * 3 + edge of the face.
+        '''
+        edgeFaces = dict()
+        for faceIdx in range(numWalkable):
+            face = faces[faceIdx]
+            for corner in range(3):
+                a, b = face[corner], face[(corner+1) % 3]
+                edgeFaces.setdefault((min(a, b), max(a, b)), []).append(faceIdx * 3 + corner)
+
+        adjacency = []
+        perimeter = dict()  # start vertex -> edge indices
+        for faceIdx in range(numWalkable):
+            face = faces[faceIdx]
+            adjacent = []
+            for corner in range(3):
+                a, b = face[corner], face[(corner+1) % 3]
+                edge = faceIdx * 3 + corner
+                shared = [e for e in edgeFaces[(min(a, b), max(a, b))] if e != edge]
+                if shared:
+                    adjacent.append(shared[0])
+                else:
+                    adjacent.append(-1)
+                    perimeter.setdefault(a, []).append(edge)
+            adjacency.append(adjacent)
+
+        # Chain the perimeter edges into loops
+        transitions = {int(edge): int(room) for edge, room in self.mesh.roomlinks}
+        edges = []
+        perimeters = []
+        remaining = sorted(e for starts in perimeter.values() for e in starts)
+        used = set()
+        for start in remaining:
+            edge = start
+            while edge is not None and edge not in used:
+                used.add(edge)
+                edges.append((edge, transitions.get(edge, -1)))
+                faceIdx, corner = divmod(edge, 3)
+                end = faces[faceIdx][(corner+1) % 3]
+                candidates = [e for e in perimeter.get(end, []) if e not in used]
+                edge = candidates[0] if candidates else None
+            if len(edges) > (perimeters[-1] if perimeters else 0):
+                perimeters.append(len(edges))
+        return adjacency, edges, perimeters
+
+
+def writeWalkmeshes(wkm):
+    '''
+    Return the binary walkmeshes of wkm as (file suffix, data) tuples.
+    Door walkmeshes are written to one file per state, with the index of
+    the state as suffix.
+    '''
+    meshes = [node for node in wkm.nodeDict.values()
+              if isinstance(node, nvb_node.Trimesh) and len(node.verts)]
+    if not meshes:
+        return []
+    if wkm.walkmeshType == 'wok':
+        return [('', BwmWriter(meshes[0], 'wok').write())]
+
+    def findNode(nodes, suffix):
+        for node in nodes:
+            if node.name.lower().endswith(suffix):
+                return node
+        return None
+
+    nodes = list(wkm.nodeDict.values())
+    if wkm.walkmeshType == 'dwk':
+        parts = []
+        for idx, state in enumerate(DOOR_STATES):
+            mesh = findNode(meshes, 'wg_' + state)
+            if mesh is not None:
+                uses = [findNode(nodes, 'dp_{}_{:02d}'.format(state, i)) for i in (1, 2)]
+                parts.append((str(idx), mesh, uses))
+        if not parts:
+            parts = [('0', meshes[0], [])]
+    else:
+        uses = [findNode(nodes, 'use{:02d}'.format(i)) for i in (1, 2)]
+        parts = [('', meshes[0], uses)]
+
+    walkmeshes = []
+    for suffix, mesh, uses in parts:
+        root = None
+        for node in nodes:
+            if node.name.lower() == mesh.parentName.lower():
+                root = node
+        rootPosition = root.position if root is not None else (0.0, 0.0, 0.0)
+        usePositions = [use.position if use is not None else (0.0, 0.0, 0.0)
+                        for use in uses]
+        writer = BwmWriter(mesh, wkm.walkmeshType, usePositions, rootPosition)
+        walkmeshes.append((suffix, writer.write()))
+    return walkmeshes
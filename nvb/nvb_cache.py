@@ -0,0 +1,243 @@
+"""On-disk cache of parsed models and walkmeshes."""
+import collections
+import hashlib
+import os
+import pickle
+import stat
+
+
+# Bump whenever the parsed representation (nodes, animations, keys, ...)
+# changes, entries written by another version are never used
+PARSER_VERSION = 2
+
+ENTRY_EXT = '.kbcache'
+
+# Hits and misses of all caches in this session
+stats = collections.Counter()
+
+
+def defaultDirectory():
+    '''
+    Return the cache directory of the current user, entries are unpickled
+    so it must never be shared with other users.
+    '''
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or \
+               os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'kotorblender')
+
+
+def checkOwner(st, path):
+    '''
+    Raise a PermissionError unless st, the stat of path, belongs to the
+    current user. Not checked where there are no user ids (Windows).
+    '''
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        raise PermissionError(path + ' is not owned by the current user')
+
+
+def checkDirectory(directory):
+    '''
+    Raise an OSError unless directory is a directory owned and only
+    writable by the current user.
+    '''
+    st = os.stat(directory)
+    if not stat.S_ISDIR(st.st_mode):
+        raise NotADirectoryError(directory + ' is not a directory')
+    checkOwner(st, directory)
+    if hasattr(os, 'getuid') and st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(directory + ' is writable by other users')
+
+
+def makeDirectory(directory):
+    '''
+    Create a cache directory only accessible by the current user, raises
+    an OSError if it exists but isn't private to the current user.
+    '''
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    checkDirectory(directory)
+
+
+def openPrivate(path, mode = 'rb'):
+    '''
+    Open a file in a cache directory for reading. Raises an OSError unless
+    the file and its directory belong to the current user.
+    '''
+    checkDirectory(os.path.dirname(path) or os.curdir)
+    flags = os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_BINARY', 0)
+    fd = os.open(path, flags)
+    try:
+        checkOwner(os.fstat(fd), path)
+        return os.fdopen(fd, mode)
+    except:
+        os.close(fd)
+        raise
+
+
+def createPrivate(path, mode = 'wb'):
+    '''
+    Create a file only readable by the current user, replacing an
+    existing one instead of writing through it.
+    '''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | \
+            getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_BINARY', 0)
+    fd = os.open(path, flags, 0o600)
+    try:
+        return os.fdopen(fd, mode)
+    except:
+        os.close(fd)
+        raise
+
+
+class ParseCache():
+    '''
+    Parsed Mdl and Xwk objects, pickled to a local directory.
+
+    Unpickling runs code, so the directory and its entries have to belong
+    to the current user, anything else is ignored.
+
+    Entries are keyed by the paths, sizes and modification times of the
+    files they were parsed from, the parser version and the import options
+    affecting the result. The least recently used entries are evicted once
+    the directory grows beyond maxSize bytes.
+    '''
+    def __init__(self, directory = '', maxSize = 256 * 1024 * 1024):
+        self.directory = directory or defaultDirectory()
+        self.maxSize   = maxSize
+
+    def key(self, filepaths, options = ()):
+        '''
+        Return the key for the files in filepaths, raises an OSError if one
+        of them doesn't exist.
+        '''
+        digest = hashlib.sha1()
+        digest.update(repr((PARSER_VERSION, pickle.HIGHEST_PROTOCOL,
+                            tuple(options))).encode('utf-8'))
+        for filepath in filepaths:
+            filepath = os.path.abspath(os.fsdecode(filepath))
+            st = os.stat(filepath)
+            digest.update(repr((filepath, st.st_size,
+                                st.st_mtime_ns)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.directory, key + ENTRY_EXT)
+
+    def load(self, key):
+        '''
+        Return the cached object for key, or None.
+        '''
+        path = self.entryPath(key)
+        try:
+            with openPrivate(path) as f:
+                obj = pickle.load(f)
+        except FileNotFoundError:
+            stats['misses'] += 1
+            return None
+        except PermissionError as e:
+            # Possibly planted by someone else, never unpickle or remove it
+            print('Kotorblender - WARNING: Ignoring cache entry ' + path +
+                  ': ' + str(e))
+            stats['misses'] += 1
+            return None
+        except Exception as e:
+            # Truncated, or written by an incompatible version
+            print('Kotorblender - WARNING: Invalid cache entry ' + path +
+                  ': ' + str(e))
+            self.remove(path)
+            stats['misses'] += 1
+            return None
+        try:
+            # Mark as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        stats['hits'] += 1
+        return obj
+
+    def store(self, key, obj):
+        '''
+        Write obj to the cache, failures are reported but not raised.
+        '''
+        path    = self.entryPath(key)
+        tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            makeDirectory(self.directory)
+            with createPrivate(tmpPath) as f:
+                pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpPath, path)
+        except Exception as e:
+            print('Kotorblender - WARNING: Unable to cache ' + path +
+                  ': ' + str(e))
+            self.remove(tmpPath)
+            return
+        stats['stores'] += 1
+        self.evict()
+
+    def get(self, filepaths, parse, options = ()):
+        '''
+        Return the cached object for filepaths, or parse and cache it.
+        parse is a callable without arguments returning the parsed object.
+        '''
+        key = self.key(filepaths, options)
+        obj = self.load(key)
+        if obj is None:
+            obj = parse()
+            self.store(key, obj)
+        return obj
+
+    def entries(self):
+        '''
+        Return a list of (last use, size, path) of all entries, oldest first.
+        '''
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(ENTRY_EXT):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def usage(self):
+        '''
+        Return the number of entries and their total size in bytes.
+        '''
+        entries = self.entries()
+        return len(entries), sum(e[1] for e in entries)
+
+    def evict(self):
+        entries = self.entries()
+        total   = sum(e[1] for e in entries)
+        for _, size, path in entries:
+            if total <= self.maxSize:
+                break
+            if self.remove(path):
+                stats['evictions'] += 1
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self.remove(path)
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
@@ -9,9 +9,15 @@ materialMode = 'SIN'
 texturePath   = ''
 textureSearch = False
 
+# nvb_texture.Prefetcher of the running import, None if not prefetching
+texturePrefetcher = None
+
 minimapMode     = False
 minimapSkipFade = False
 
+# Number of processes used to parse nodes and animations, 0 to disable
+parseWorkers = 0
+
 # Export
 exportSmoothGroups = True
 exportTxi = False
@@ -20,3 +26,7 @@ scene          = None
 meshConvert    = 'RENDER'
 applyModifiers = True
 
+# Evaluated meshes of the running export by object name, None outside of
+# saveMdl, see Trimesh.getExportMesh
+exportMeshes = None
+
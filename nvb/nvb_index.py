@@ -0,0 +1,222 @@
+"""Index of the blocks of an ascii mdl, for parsing them on demand.
+
+MdlIndex finds the header, node and animation blocks of a file without
+parsing any values. LazyDict and LazyValues hold the nodes and animations
+of a model, parsing each block the first time it is accessed.
+"""
+import collections
+import collections.abc
+import mmap
+import re
+
+from . import nvb_def
+from . import nvb_parse
+
+
+# Labels which delimit blocks, only matched at the start of a line,
+# which also skips over commented out lines
+_BLOCK_LABELS = re.compile(
+    rb'^[ \t]*(node|endnode|newanim|doneanim|parent)\b([^\r\n#]*)',
+    re.IGNORECASE | re.MULTILINE)
+
+NodeEntry = collections.namedtuple('NodeEntry',
+                                   ['nodetype', 'name', 'parentName',
+                                    'start', 'end'])
+
+AnimEntry = collections.namedtuple('AnimEntry', ['name', 'start', 'end'])
+
+
+class MdlIndex():
+    '''
+    Byte offsets of the header, nodes and animations of an ascii mdl.
+
+    The file is memory mapped and scanned once, without parsing any values.
+    Single blocks may then be tokenized on demand with lines().
+    '''
+    def __init__(self, filepath, scan = True):
+        self.filepath = filepath
+
+        self.header = (0, 0)
+        self.nodes  = []  # NodeEntry, in file order
+        self.anims  = []  # AnimEntry, in file order
+        # True if there is an animation in front of the first node
+        self.animsBeforeGeometry = False
+
+        self._file = None
+        self._mmap = None
+
+        if scan:
+            self.scan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def buffer(self):
+        '''
+        Return the mapped file contents, (re-)opening the file if necessary.
+        '''
+        if self._mmap is None:
+            self._file = open(self.filepath, 'rb')
+            try:
+                self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                self._mmap = b''
+        return self._mmap
+
+    def close(self):
+        '''
+        Release the mapping and the file, they are reopened on demand.
+        '''
+        if self._mmap is not None and not isinstance(self._mmap, bytes):
+            self._mmap.close()
+        self._mmap = None
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+    def scan(self):
+        buf = self.buffer()
+        size = len(buf)
+
+        def lineEnd(pos):
+            pos = buf.find(b'\n', pos)
+            return size if pos < 0 else pos + 1
+
+        def decode(b):
+            return b.decode('utf-8', 'replace')
+
+        self.nodes = []
+        self.anims = []
+        self.animsBeforeGeometry = False
+        headerEnd = None
+        block = None  # [event, start, args, parent]
+        for match in _BLOCK_LABELS.finditer(buf):
+            label = match.group(1).lower()
+            pos   = match.start()
+            if block is not None:
+                if block[0] == b'newanim':
+                    if label == b'doneanim':
+                        self._addAnim(block, lineEnd(match.end()), decode)
+                        block = None
+                    continue
+                if label == b'parent':
+                    block[3] = match.group(2).split()[:1]
+                    continue
+                if label == b'endnode':
+                    self._addNode(block, lineEnd(match.end()), decode)
+                    block = None
+                    continue
+                if label != b'node':
+                    continue
+                # Missing 'endnode', the next node terminates this one
+                self._addNode(block, pos, decode)
+                block = None
+            if label == b'node' or label == b'newanim':
+                if headerEnd is None:
+                    headerEnd = pos
+                    self.animsBeforeGeometry = (label == b'newanim')
+                block = [label, pos, match.group(2).split(), None]
+        if block is not None:
+            if block[0] == b'newanim':
+                self._addAnim(block, size, decode)
+            else:
+                self._addNode(block, size, decode)
+        self.header = (0, size if headerEnd is None else headerEnd)
+
+    def _addNode(self, block, end, decode):
+        args = block[2]
+        nodetype = decode(args[0]).lower() if len(args) > 0 else ''
+        name     = decode(args[1]) if len(args) > 1 else ''
+        parentName = decode(block[3][0]) if block[3] else nvb_def.null
+        self.nodes.append(NodeEntry(nodetype, name, parentName, block[1], end))
+
+    def _addAnim(self, block, end, decode):
+        args = block[2]
+        name = decode(args[0]) if args else ''
+        self.anims.append(AnimEntry(name, block[1], end))
+
+    def lines(self, start, end):
+        '''
+        Return the tokenized lines of the range start:end.
+        '''
+        text = self.buffer()[start:end].decode('utf-8', 'replace')
+        return [tokens for _, tokens in nvb_parse.tokenize(text.splitlines())]
+
+    def headerLines(self):
+        return self.lines(*self.header)
+
+
+class LazyDict(collections.abc.MutableMapping):
+    '''
+    Ordered dictionary which creates its values on first access.
+
+    Takes (key, loader) pairs, loader is a callable without arguments
+    returning the value. Keys, length and membership tests never call a
+    loader.
+    '''
+    def __init__(self, loaders = ()):
+        self._loaders = collections.OrderedDict(loaders)
+        self._values  = dict()
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = self._loaders[key]()
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self._loaders:
+            self._loaders[key] = None
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._loaders[key]
+        self._values.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._loaders
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+    def isLoaded(self, key):
+        return key in self._values
+
+
+class LazyValues(collections.abc.Sequence):
+    '''
+    List of the values of a LazyDict, loading them on access.
+
+    Behaves like a list made from the values at creation: values appended
+    later are kept as they are and the LazyDict isn't changed, so it can
+    replace the plain lists next to the dicts.
+    '''
+    def __init__(self, lazyDict):
+        self._dict  = lazyDict
+        self._items = [(True, key) for key in lazyDict]
+
+    def _get(self, item):
+        isKey, value = item
+        return self._dict[value] if isKey else value
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._get(item) for item in self._items[idx]]
+        return self._get(self._items[idx])
+
+    def __len__(self):
+        return len(self._items)
+
+    def append(self, value):
+        self._items.append((False, value))
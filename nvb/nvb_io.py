@@ -1,13 +1,28 @@
 """TODO: DOC."""
 
 import os
-import re
 import bpy
 
 from . import nvb_glob
 from . import nvb_def
 from . import nvb_mdl
+from . import nvb_index
+from . import nvb_binmdl
+from . import nvb_binwok
 from . import nvb_utils
+from . import nvb_profile
+from . import nvb_material
+from . import nvb_texture
+from . import nvb_txi
+
+
+def parseCached(parseCache, filepaths, parse, options = ()):
+    '''
+    Return the result of parse, through parseCache if there is one
+    '''
+    if parseCache is None:
+        return parse()
+    return parseCache.get(filepaths, parse, options)
 
 
 def loadMdl(operator,
@@ -20,9 +35,13 @@ def loadMdl(operator,
             materialMode = 'SIN',
             textureSearch = False,
             minimapMode = False,
-            minimapSkipFade = False):
+            minimapSkipFade = False,
+            parseWorkers = 0,
+            parseCache = None,
+            profile = False):
     '''
-    Called from blender ui
+    Called from blender ui, parseCache is an optional nvb_cache.ParseCache.
+    With profile the time spent in each phase is reported, see nvb_profile.
     '''
     nvb_glob.importGeometry     = importGeometry
     nvb_glob.importSmoothGroups = importSmoothGroups
@@ -37,7 +56,35 @@ def loadMdl(operator,
     nvb_glob.minimapMode     = minimapMode
     nvb_glob.minimapSkipFade = minimapSkipFade
 
+    nvb_glob.parseWorkers = parseWorkers
+
+    profiler = nvb_profile.start('Import', profile)
+    if profiler is not None:
+        before = nvb_profile.datablockCounts(bpy.data)
+    try:
+        with nvb_profile.span('import', file=filepath):
+            warnings = importMdl(filepath, importWalkmesh, parseCache)
+        for warning in warnings:
+            operator.report({'WARNING'}, warning)
+    finally:
+        if profiler is not None:
+            profiler.countDatablocks(before, nvb_profile.datablockCounts(bpy.data))
+        nvb_profile.stop(operator, filepath)
+
+    return {'FINISHED'}
+
+
+def importMdl(filepath, importWalkmesh, parseCache):
+    '''
+    Import the model and its walkmeshes, return warnings for the ui.
+    '''
     scene = bpy.context.scene
+    # Pick up materials added or removed since the last import
+    nvb_material.registry.sync()
+    if nvb_glob.materialMode != 'NON':
+        # Scan for textures once, instead of once per image
+        with nvb_profile.span('scan textures'):
+            nvb_texture.getLocator(nvb_glob.texturePath, nvb_glob.textureSearch)
 
     # Try to load walkmeshes ... pwk (placeable) and dwk (door)
     # If the files are and the option is activated we'll import them
@@ -54,12 +101,30 @@ def loadMdl(operator,
                                        os.path.splitext(wkmFilename)[0] +
                                        '.' + wkmType)
             fp = os.fsencode(wkmFilepath)
+            binaryFiles = []
+            if not using_extra_extension:
+                binaryFiles = nvb_binwok.getWalkmeshFiles(wkmFilepath, wkmType)
             if using_extra_extension or not os.path.isfile(fp):
                 fp = os.fsencode(wkmFilepath + '.ascii')
             try:
-                asciiLines = [line.strip().split() for line in open(fp, 'r')]
-                wkm = nvb_mdl.Xwk(wkmType)
-                wkm.loadAscii(asciiLines)
+                wkmName = os.path.splitext(wkmFilename)[0]
+                if binaryFiles:
+                    sources = [path for (path, state) in binaryFiles]
+                    def parseWkm():
+                        newWkm = nvb_mdl.Xwk(wkmType)
+                        newWkm.loadBinaryFiles(binaryFiles, wkmName)
+                        return newWkm
+                else:
+                    sources = [fp]
+                    def parseWkm():
+                        newWkm = nvb_mdl.Xwk(wkmType)
+                        newWkm.loadAsciiFile(fp)
+                        return newWkm
+                with nvb_profile.span('parse walkmesh', type=wkmType):
+                    newWkm = parseCached(parseCache, sources, parseWkm,
+                                         (wkmType, wkmName))
+                # keep the last walkmesh found, not the last one tried
+                wkm = newWkm
                 # adding walkmesh to scene has to be done within mdl import now
                 #wkm.importToScene(scene)
             except IOError:
@@ -75,48 +140,92 @@ def loadMdl(operator,
                     )
                 )
 
-    # read the ascii mdl text
     fp = os.fsencode(filepath)
-    ascii_mdl = ''
-    f = open(fp, 'r')
-    ascii_mdl = f.read()
-    f.close()
+    print('Importing: ' + filepath)
+    mdlIndices = []
+    warnings = []
+    sources = [fp]
+    binary = nvb_binmdl.isBinaryMdl(fp)
+    if binary and os.path.isfile(nvb_binmdl.getMdxPath(fp)):
+        sources.append(nvb_binmdl.getMdxPath(fp))
 
-    # strip any comments from the text immediately,
-    # newer method of text processing is not robust against comments
-    ascii_mdl = re.sub(r'#.+$', '', ascii_mdl, flags=re.MULTILINE)
+    def parseMdl():
+        mdl = nvb_mdl.Mdl()
+        if binary:
+            # compiled model, read it directly along with its mdx
+            mdl.loadBinaryFile(fp)
+        else:
+            # index the ascii mdl, nodes and animations are only parsed when
+            # the import actually needs them
+            mdlIndex = nvb_index.MdlIndex(fp)
+            mdlIndices.append(mdlIndex)
+            warning = mdl.loadAsciiIndex(mdlIndex, nvb_glob.parseWorkers)
+            if warning:
+                warnings.append(warning)
+        return mdl
+    # The indices map the mdl, close them even if the import fails, an
+    # open mapping keeps the file locked on Windows
+    try:
+        with nvb_profile.span('parse mdl', binary=binary):
+            mdl = parseCached(parseCache, sources, parseMdl,
+                              ('mdl', nvb_glob.importAnim))
+        prefetcher = None
+        if nvb_glob.materialMode != 'NON' and nvb_glob.importGeometry:
+            prefetcher = prefetchTextures(mdl)
+        nvb_glob.texturePrefetcher = prefetcher
+        try:
+            mdl.importToScene(scene, wkm)
+        finally:
+            nvb_glob.texturePrefetcher = None
+            if prefetcher is not None:
+                prefetcher.close()
+        if nvb_glob.materialMode != 'NON':
+            nvb_txi.saveCatalogs()
 
-    # prepare the old style data
-    asciiLines = [line.strip().split() for line in ascii_mdl.splitlines()]
+        # processing to use AABB node as trimesh for walkmesh file
+        if wkm is not None and wkm.walkmeshType == 'wok' and mdl.nodeDict and wkm.nodeDict:
+            aabb = None
+            wkmesh = None
+            # find aabb node in model
+            for (nodeKey, node) in mdl.nodeDict.items():
+                if node.nodetype == 'aabb':
+                    aabb = node
+            # find mesh node in wkm
+            for (nodeKey, node) in wkm.nodeDict.items():
+                if node.nodetype == 'aabb' or node.nodetype == 'trimesh':
+                    wkmesh = node
+            if aabb and wkmesh:
+                with nvb_profile.span('import walkmesh', type='wok'):
+                    #print(aabb.lytposition)
+                    aabb.computeLayoutPosition(wkmesh)
+                    #print(aabb.lytposition)
+                    if len(wkmesh.roomlinks):
+                        aabb.roomlinks = wkmesh.roomlinks
+                        aabb.setRoomLinks(scene.objects[aabb.name].data)
+    finally:
+        for mdlIndex in mdlIndices:
+            mdlIndex.close()
 
-    print('Importing: ' + filepath)
-    mdl = nvb_mdl.Mdl()
-    #mdl.loadAscii(asciiLines)
-    mdl.loadAscii(ascii_mdl)
-    mdl.importToScene(scene, wkm)
-
-    # processing to use AABB node as trimesh for walkmesh file
-    if wkm is not None and wkm.walkmeshType == 'wok' and mdl.nodeDict and wkm.nodeDict:
-        aabb = None
-        wkmesh = None
-        # find aabb node in model
-        for (nodeKey, node) in mdl.nodeDict.items():
-            if node.nodetype == 'aabb':
-                aabb = node
-        # find mesh node in wkm
-        for (nodeKey, node) in wkm.nodeDict.items():
-            if node.nodetype == 'aabb' or node.nodetype == 'trimesh':
-                wkmesh = node
-        if aabb and wkmesh:
-            #print(aabb.lytposition)
-            aabb.computeLayoutPosition(wkmesh)
-            #print(aabb.lytposition)
-            if len(wkmesh.roomlinks):
-                aabb.roomlinks = wkmesh.roomlinks
-                aabb.setRoomLinks(scene.objects[aabb.name].data)
+    nvb_material.registry.synced()
+    return warnings
 
 
-    return {'FINISHED'}
+def prefetchTextures(mdl):
+    '''
+    Start reading the textures of mdl in the background, returns an
+    nvb_texture.Prefetcher. Nodes are parsed one by one, so the reads
+    overlap with parsing the rest of them.
+    '''
+    locator    = nvb_texture.getLocator(nvb_glob.texturePath,
+                                        nvb_glob.textureSearch, refresh=False)
+    prefetcher = nvb_texture.Prefetcher(locator)
+    registry   = nvb_material.registry
+    for node in mdl.nodeDict.values():
+        for name in (getattr(node, 'bitmap', None), getattr(node, 'bitmap2', None)):
+            if name and not nvb_utils.isNull(name) and \
+               registry.findImage(name) is None:
+                prefetcher.request(name)
+    return prefetcher
 
 
 def saveMdl(operator,
@@ -126,9 +235,12 @@ def saveMdl(operator,
          exportSmoothGroups = True,
          exportTxi = True,
          applyModifiers = True,
+         exportFormat = 'ASCII',
+         profile = False,
          ):
     '''
-    Called from blender ui
+    Called from blender ui, with profile the time spent in each phase is
+    reported, see nvb_profile
     '''
     nvb_glob.exports            = exports
     nvb_glob.exportSmoothGroups = exportSmoothGroups
@@ -160,14 +272,44 @@ def saveMdl(operator,
         bpy.context.scene.frame_set(0)
         #print('frame set to 0 for export')
 
+    nvb_profile.start('Export', profile)
+    # Objects are evaluated once and shared by the mdl and walkmesh writers
+    nvb_glob.exportMeshes = dict()
+    try:
+        with nvb_profile.span('export', file=filepath):
+            exportMdl(filepath, exports, exportTxi, exportFormat)
+    finally:
+        for mesh in nvb_glob.exportMeshes.values():
+            bpy.data.meshes.remove(mesh)
+        nvb_glob.exportMeshes = None
+        nvb_profile.stop(operator, filepath)
+
+    # Return frame to pre-export, if specified in options
+    if frame_set_current is not None and bpy.context.scene:
+        #print('current frame restored to {}'.format(frame_set_current))
+        bpy.context.scene.frame_set(frame_set_current)
+
+    return {'FINISHED'}
+
+
+def exportMdl(filepath, exports, exportTxi, exportFormat):
     mdlRoot = nvb_utils.get_mdl_base(scene=bpy.context.scene)
     if mdlRoot:
         print('Kotorblender: Exporting ' + mdlRoot.name)
         mdl = nvb_mdl.Mdl()
-        asciiLines = []
-        mdl.generateAscii(asciiLines, mdlRoot)
-        with open(os.fsencode(filepath), 'w') as f:
-            f.write('\n'.join(asciiLines))
+        if exportFormat == 'ASCII':
+            asciiLines = []
+            mdl.generateAscii(asciiLines, mdlRoot)
+            with open(os.fsencode(filepath), 'w') as f:
+                f.write('\n'.join(asciiLines))
+        else:
+            # compiled model, the vertex data goes into the mdx
+            mdlData, mdxData = mdl.generateBinary(mdlRoot, exports,
+                                                  exportFormat == 'BINARY_TSL')
+            with open(os.fsencode(filepath), 'wb') as f:
+                f.write(mdlData)
+            with open(nvb_binmdl.getMdxPath(os.fsencode(filepath)), 'wb') as f:
+                f.write(mdxData)
 
         if 'WALKMESH' in exports:
             wkmRoot = None
@@ -196,7 +338,15 @@ def saveMdl(operator,
                     wkmRoot = bpy.data.objects[wkmRootName]
                     wkm     = nvb_mdl.Xwk('dwk')
 
-            if wkmRoot:
+            if wkmRoot and exportFormat != 'ASCII':
+                # compiled walkmesh, doors are written to one file per state
+                (wkmPath, wkmFilename) = os.path.split(filepath)
+                wkmName = os.path.splitext(wkmFilename)[0]
+                for (suffix, data) in wkm.generateBinary(wkmRoot, exports):
+                    wkmFilepath = os.path.join(wkmPath, wkmName + suffix + '.' + wkm.walkmeshType)
+                    with open(os.fsencode(wkmFilepath), 'wb') as f:
+                        f.write(data)
+            elif wkmRoot:
                 asciiLines = []
                 wkm.generateAscii(asciiLines, wkmRoot)
 
@@ -216,10 +366,3 @@ def saveMdl(operator,
                         texture.nvb.exported_in_save = False
                 except:
                     pass
-
-    # Return frame to pre-export, if specified in options
-    if frame_set_current is not None and bpy.context.scene:
-        #print('current frame restored to {}'.format(frame_set_current))
-        bpy.context.scene.frame_set(frame_set_current)
-
-    return {'FINISHED'}
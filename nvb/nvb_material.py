@@ -0,0 +1,121 @@
+"""Registry of the materials, textures and images used by imports."""
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+
+# The importer doesn't change the specular color of new materials
+DEFAULT_SPECULAR = (1.0, 1.0, 1.0)
+
+
+def quantize(values, steps = 100):
+    return tuple(int(round(v * steps)) for v in values)
+
+
+def materialKey(diffuse, specular, imageName, alpha, lightmap = ''):
+    '''
+    Return the key of a material with these properties. Colors and alpha
+    are quantized, so similar materials share a key.
+    '''
+    return (quantize(diffuse), quantize(specular), imageName.lower(),
+            quantize((alpha,))[0], lightmap.lower())
+
+
+def getMaterialKey(material):
+    '''
+    Return the key of an existing material, the same as materialKey()
+    returns for the properties it was created from.
+    '''
+    imageName = ''
+    alpha     = material.alpha
+    texture   = material.active_texture
+    if texture:
+        if texture.type == 'IMAGE' and texture.image:
+            imageName = texture.image.name
+        alpha = material.texture_slots[material.active_texture_index].alpha_factor
+    lightmap = ''
+    lightmapSlot = material.texture_slots[1]
+    if lightmapSlot and lightmapSlot.texture:
+        lightmap = lightmapSlot.texture.name
+    return materialKey(material.diffuse_color, material.specular_color,
+                       imageName, alpha, lightmap)
+
+
+class Registry():
+    '''
+    Maps material keys and lower case texture and image names to the names
+    of datablocks, for lookups in constant time.
+
+    Lives as long as the add-on, so it is shared by all imports of a
+    batch. It is rebuilt from bpy.data when datablocks were added or
+    removed by anything else, entries for renamed or removed datablocks
+    are dropped when they are looked up.
+    '''
+    def __init__(self):
+        self.materials = dict()
+        self.textures  = dict()
+        self.images    = dict()
+        self.state     = None
+
+    @staticmethod
+    def getState():
+        return (bpy.data.filepath, len(bpy.data.materials),
+                len(bpy.data.textures), len(bpy.data.images))
+
+    def sync(self):
+        '''
+        Rebuild the registry if bpy.data changed since the last import.
+        '''
+        if self.state != self.getState():
+            self.rebuild()
+
+    def synced(self):
+        '''
+        Remember the state of bpy.data after an import.
+        '''
+        self.state = self.getState()
+
+    def rebuild(self):
+        self.materials.clear()
+        self.textures.clear()
+        self.images.clear()
+        for material in bpy.data.materials:
+            self.materials.setdefault(getMaterialKey(material), material.name)
+        for texture in bpy.data.textures:
+            self.textures.setdefault(texture.name.lower(), texture.name)
+        for image in bpy.data.images:
+            self.images.setdefault(image.name.lower(), image.name)
+        self.synced()
+
+    @staticmethod
+    def find(collection, names, key):
+        name = names.get(key)
+        if name is None:
+            return None
+        block = collection.get(name)
+        if block is None:
+            del names[key]
+        return block
+
+    def findMaterial(self, key):
+        return self.find(bpy.data.materials, self.materials, key)
+
+    def addMaterial(self, key, material):
+        self.materials[key] = material.name
+
+    def findTexture(self, name):
+        return self.find(bpy.data.textures, self.textures, name.lower())
+
+    def addTexture(self, texture):
+        self.textures[texture.name.lower()] = texture.name
+
+    def findImage(self, name):
+        return self.find(bpy.data.images, self.images, name.lower())
+
+    def addImage(self, image):
+        self.images[image.name.lower()] = image.name
+
+
+registry = Registry()
@@ -2,16 +2,26 @@
 import os
 import collections
 import enum
+import multiprocessing
 import re
 from datetime import datetime
 
-import bpy
+try:
+    import bpy
+except ImportError:
+    bpy = None
 
 from . import nvb_node
 from . import nvb_anim
 from . import nvb_glob
 from . import nvb_def
 from . import nvb_utils
+from . import nvb_parse
+from . import nvb_index
+from . import nvb_parallel
+from . import nvb_binmdl
+from . import nvb_binwok
+from . import nvb_profile
 
 
 class Mdl():
@@ -32,8 +42,25 @@ class Mdl():
 
         self.mdlnodes = []
 
+    def __getstate__(self):
+        '''
+        Parse everything left in lazy dicts before pickling, their loaders
+        can't be pickled. Used to cache parsed models.
+        '''
+        state = self.__dict__.copy()
+        for name in ('nodeDict', 'animDict'):
+            if isinstance(state.get(name), nvb_index.LazyDict):
+                state[name] = collections.OrderedDict(state[name].items())
+        for name in ('mdlnodes', 'animations'):
+            if name in state and not isinstance(state[name], list):
+                state[name] = list(state[name])
+        return state
+
 
     def loadAsciiNode(self, asciiBlock):
+        self.addNode(self.createAsciiNode(asciiBlock))
+
+    def createAsciiNode(self, asciiBlock):
         if asciiBlock is None:
             raise nvb_def.MalformedMdlFile('Empty Node')
 
@@ -67,17 +94,23 @@ class Mdl():
         # tell the node what model it is part of
         node.rootname = self.name
 
-        node.loadAscii(asciiBlock)
-        self.addNode(node)
+        with nvb_profile.span('parse node', type=nodeType):
+            node.loadAscii(asciiBlock)
+        return node
 
     def loadAsciiAnimation(self, asciiBlock):
+        animation = self.createAsciiAnimation(asciiBlock)
+        self.animations.append(animation)
+        self.addAnimation(animation)
+
+    def createAsciiAnimation(self, asciiBlock):
         if asciiBlock is None:
             raise nvb_def.MalformedMdlFile('Empty Animation')
 
         animation = nvb_anim.Animation()
-        animation.getAnimFromAscii(asciiBlock)
-
-        self.addAnimation(animation)
+        with nvb_profile.span('parse animation'):
+            animation.loadAscii(asciiBlock)
+        return animation
 
     def addNode(self, newNode):
         # Blender requires unique object names. Names in mdls are only
@@ -94,12 +127,20 @@ class Mdl():
                 self.nodeDict[key] = newNode
                 self.mdlnodes.append(newNode)
 
+    @staticmethod
+    def animKey(name):
+        '''
+        Key of an animation in animDict.
+        '''
+        return nvb_utils.str2identifier(name)
+
     def addAnimation(self, anim):
         if anim:
-            if anim.name in self.animDict:
+            key = self.animKey(anim.name)
+            if key in self.animDict:
                 print('Kotorblender - WARNING: Animation name conflict.')
             else:
-                self.animDict[anim.name] = anim
+                self.animDict[key] = anim
 
     def importToScene(self, scene, wkm):
         rootDummy = None
@@ -113,7 +154,8 @@ class Mdl():
             (nodeKey, node) = next(it)
             if (type(node) == nvb_node.Dummy) and \
                (nvb_utils.isNull(node.parentName)):
-                obj                    = node.addToScene(scene)
+                with nvb_profile.span('addToScene', node=node.name, type=node.nodetype):
+                    obj                = node.addToScene(scene)
                 obj.nvb.dummytype      = nvb_def.Dummytype.MDLROOT
                 obj.nvb.supermodel     = self.supermodel
                 obj.nvb.classification = self.classification
@@ -130,7 +172,8 @@ class Mdl():
                 raise nvb_def.MalformedMdlFile('First node has to be a dummy without a parent.')
 
             for (nodeKey, node) in it:
-                obj = node.addToScene(scene)
+                with nvb_profile.span('addToScene', node=node.name, type=node.nodetype):
+                    obj = node.addToScene(scene)
                 obj.nvb.imporder = objIdx
                 objIdx += 1
                 if (nvb_utils.isNull(node.parentName)):
@@ -177,7 +220,8 @@ class Mdl():
         # Import the walkmesh, it will use any placeholder dummies just imported,
         # and the walkmesh nodes will be copied during animation import
         if (nvb_glob.importWalkmesh) and not wkm is None and wkm.walkmeshType != 'wok':
-            wkm.importToScene(scene)
+            with nvb_profile.span('import walkmesh', type=wkm.walkmeshType):
+                wkm.importToScene(scene)
 
         # Attempt to import animations
         # Search for the rootDummy if not already present
@@ -201,75 +245,150 @@ class Mdl():
         # Load the 'default' animation first, so it is at the front
         anims = [a for a in animationlist if a.name == 'default']
         for a in anims:
-            a.create(mdl_base, options)
+            with nvb_profile.span('create animation', anim=a.name):
+                a.create(mdl_base, options)
         # Load the rest of the anims
         anims = [a for a in animationlist if a.name != 'default']
         for a in anims:
-            a.create(mdl_base, options)
-
-
-    def loadAscii(self, ascii_block):
-        geom_start = ascii_block.find("node ")
-        anim_start = ascii_block.find("newanim ")
-        geom_end   = ascii_block.find("endmodelgeom ")
+            with nvb_profile.span('create animation', anim=a.name):
+                a.create(mdl_base, options)
+
+
+    def loadAscii(self, ascii_data, loadAnims = None):
+        """Load the model from ascii data.
+
+        ascii_data is either the full text of the mdl or an iterable of
+        lines, e.g. an open file, which will be parsed as a stream, block
+        by block. Animations are loaded if loadAnims is set, defaults to
+        the import option.
+        """
+        if loadAnims is None:
+            loadAnims = nvb_glob.importAnim
+        if isinstance(ascii_data, str):
+            ascii_data = ascii_data.splitlines()
+        geom_found = False
+        for event, ascii_lines in nvb_parse.blocks(nvb_parse.tokenize(ascii_data)):
+            if event == 'node':
+                geom_found = True
+                self.loadAsciiNode(ascii_lines)
+            elif event == 'anim':
+                if not geom_found:
+                    raise nvb_def.MalformedMdlFile('Animations before geometry')
+                if loadAnims:
+                    self.loadAsciiAnimation(ascii_lines)
+            elif event == 'header':
+                with nvb_profile.span('parse header'):
+                    self.read_ascii_header(ascii_lines)
+        if not geom_found:
+            raise nvb_def.MalformedMdlFile('Unable to find geometry')
 
-        if (anim_start > 0) and (geom_start > anim_start):
+    def loadAsciiFile(self, filepath):
+        """Load the model from an ascii mdl file, streaming its contents."""
+        with open(filepath, 'r') as f:
+            self.loadAscii(f)
+
+    def loadBinary(self, mdlData, mdxData = None):
+        """Load the model from the contents of a binary mdl and its mdx."""
+        reader = nvb_binmdl.MdlReader(mdlData, mdxData)
+        reader.load(self, nvb_glob.importAnim)
+
+    def loadBinaryFile(self, filepath):
+        """Load the model from a binary mdl file and the mdx next to it."""
+        reader = nvb_binmdl.MdlReader.fromFile(filepath)
+        reader.load(self, nvb_glob.importAnim)
+
+    def loadAsciiIndex(self, mdlIndex, workers = 0):
+        """Load the model from an index of an ascii mdl (nvb_index.MdlIndex).
+
+        Only the header is parsed right away. Nodes and animations are parsed
+        on first access through nodeDict and animDict (or the lists
+        mdlnodes and animations), so tools which only need the hierarchy or
+        a single node/animation don't pay for the rest of the file. With
+        more than one worker, all blocks are tokenized in worker processes
+        instead. Returns a warning if that wasn't possible, None otherwise.
+        """
+        if mdlIndex.animsBeforeGeometry:
             raise nvb_def.MalformedMdlFile('Animations before geometry')
-        if (geom_start < 0):
+        if not mdlIndex.nodes:
             raise nvb_def.MalformedMdlFile('Unable to find geometry')
+        with nvb_profile.span('parse header'):
+            self.read_ascii_header(mdlIndex.headerLines())
 
-        self.read_ascii_header(ascii_block[:geom_start-1])
-        # Import Geometry
-        #Mdl.read_ascii_geom(ascii_block[geom_start:geom_end],
-        self.read_ascii_geom(ascii_block[geom_start:geom_end],
-                            self.mdlnodes)
-        # Import Animations
-        if nvb_glob.importAnim and (anim_start > 0):
-            self.read_ascii_anims(ascii_block[anim_start:])
-
-
-    def read_ascii_anims(self, ascii_block):
-        """Load all animations from an ascii mdl block."""
-        delim = "newanim "
-        animList = [delim + b for b in ascii_block.split(delim) if b]
-        self.animations = list(map(
-            lambda txt: nvb_anim.Animation(ascii_data=txt),
-            animList
-        ))
-        for anim in self.animations:
-            self.addAnimation(anim)
-
-    #@staticmethod
-    def read_ascii_geom(self, ascii_block, nodelist):
-        """Load all geometry nodes from an ascii mdl block."""
-        delim = "node "
-        #print(ascii_block)
-        ascii_nodes = [delim + b for b in ascii_block.split(delim) if b]
-        for idx, ascii_node in enumerate(ascii_nodes):
-            ascii_lines = [l.strip().split() for l in ascii_node.splitlines()]
-            node = None
-            node_type = ''
-            node_name = 'UNNAMED'
-            try:  # Read node type
-                node_type = ascii_lines[0][1].lower()
-            except (IndexError, AttributeError):
-                raise nvb_def.MalformedMdlFile('Unable to read node type')
-            try:  # Read node name
-                node_name = ascii_lines[0][2].lower()
-            except (IndexError, AttributeError):
-                raise nvb_def.MalformedMdlFile('Unable to read node name')
-            #try:  # Create (node) object
-            #    node = Mdl.nodelookup[node_type](node_name)
-            #except KeyError:
-            #    raise nvb_def.MalformedMdlFile('Invalid node type')
-            # Parse and add to node list
-            #node.loadAscii(ascii_lines) #, idx)
-            self.loadAsciiNode(ascii_lines)
-            nodelist.append(node)
-
-    def read_ascii_header(self, ascii_block):
-        """TODO: DOC."""
-        ascii_lines = [l.strip().split() for l in ascii_block.splitlines()]
+        def loader(create, entry):
+            return lambda: create(mdlIndex.lines(entry.start, entry.end))
+
+        nodeEntries = collections.OrderedDict()
+        for entry in mdlIndex.nodes:
+            key = nvb_utils.getName(entry.parentName) + nvb_utils.getName(entry.name)
+            if key in nodeEntries:
+                print('Kotorblender - WARNING: Node name conflict ' + key + '.')
+            else:
+                nodeEntries[key] = entry
+        self.nodeDict = nvb_index.LazyDict(
+            (key, loader(self.createAsciiNode, entry)) for key, entry in nodeEntries.items())
+        self.mdlnodes = nvb_index.LazyValues(self.nodeDict)
+
+        animEntries = collections.OrderedDict()
+        if nvb_glob.importAnim:
+            for entry in mdlIndex.anims:
+                key = self.animKey(entry.name)
+                if key in animEntries:
+                    print('Kotorblender - WARNING: Animation name conflict.')
+                else:
+                    animEntries[key] = entry
+        self.animDict = nvb_index.LazyDict(
+            (key, loader(self.createAsciiAnimation, entry)) for key, entry in animEntries.items())
+        self.animations = nvb_index.LazyValues(self.animDict)
+
+        if workers > 1:
+            jobs = []
+            if nvb_glob.importGeometry:
+                jobs.append((self.nodeDict, self.createAsciiNode, nodeEntries))
+            jobs.append((self.animDict, self.createAsciiAnimation, animEntries))
+            error = self.loadParallel(mdlIndex.filepath, jobs, workers)
+            if error:
+                warning = 'Parsing in a single process, ' + error
+                print('Kotorblender - WARNING: ' + warning + '.')
+                return warning
+        return None
+
+    def loadParallel(self, filepath, jobs, workers):
+        """Tokenize blocks of an ascii mdl in a pool of worker processes.
+
+        jobs is a list of (lazyDict, create, entries) tuples, the nodes or
+        animations are created from the tokenized blocks and stored in
+        lazyDict. Returns None if the blocks were parsed, otherwise the
+        reason why not, the lazy dicts are left alone in that case.
+        """
+        batches = []
+        for lazyDict, create, entries in jobs:
+            keys = list(entries.keys())
+            # A few batches per worker to balance differently sized blocks
+            batchSize = max(1, len(keys) // (workers * 4))
+            for idx in range(0, len(keys), batchSize):
+                batchKeys = keys[idx:idx+batchSize]
+                ranges = [(entries[k].start, entries[k].end) for k in batchKeys]
+                batches.append((lazyDict, batchKeys, create, ranges))
+        if not batches:
+            return None
+
+        # Blender before 2.91 is its own sys.executable
+        executable = None
+        if bpy is not None:
+            executable = getattr(bpy.app, 'binary_path_python', None)
+        try:
+            results = nvb_parallel.prepare(
+                filepath, [ranges for _, _, _, ranges in batches], workers,
+                executable)
+        except (OSError, EOFError, multiprocessing.ProcessError) as e:
+            return 'worker processes failed: ' + str(e)
+        for (lazyDict, batchKeys, create, _), blocks in zip(batches, results):
+            for key, segments in zip(batchKeys, blocks):
+                lazyDict[key] = create(nvb_parse.Lines(segments))
+        return None
+
+    def read_ascii_header(self, ascii_lines):
+        """Read the model header from a list of tokenized lines."""
         for line in ascii_lines:
             try:
                 label = line[0].lower()
@@ -328,8 +447,7 @@ class Mdl():
                            Using default value " + self.animscale)
 
 
-    def geometryToAscii(self, bObject, asciiLines, simple = False, nameDict = None):
-
+    def createExportNode(self, bObject):
         nodeType = nvb_utils.getNodeType(bObject)
         switch = {'dummy':      nvb_node.Dummy,
                   'patch':      nvb_node.Patch,
@@ -341,10 +459,13 @@ class Mdl():
                   'light':      nvb_node.Light,
                   'aabb':       nvb_node.Aabb}
         try:
-            node = switch[nodeType]()
+            return switch[nodeType]()
         except KeyError:
             raise nvb_def.MalformedMdlFile('Invalid node type')
 
+    def geometryToAscii(self, bObject, asciiLines, simple = False, nameDict = None):
+
+        node = self.createExportNode(bObject)
         node.toAscii(bObject, asciiLines, self.classification, simple, nameDict=nameDict)
 
         '''
@@ -359,6 +480,27 @@ class Mdl():
         for (imporder, child) in childList:
             self.geometryToAscii(child, asciiLines, simple, nameDict=nameDict)
 
+    def geometryToNodes(self, bObject, simple = False, nameDict = None):
+        '''
+        Add the nodes of bObject and its children to the model, in the
+        order geometryToAscii writes them.
+        '''
+        node = self.createExportNode(bObject)
+        # Same as for parsed nodes
+        if isinstance(self, Xwk):
+            node.roottype = self.walkmeshType
+        node.rootname = self.name
+        node.loadObject(bObject, self.classification, simple, nameDict=nameDict)
+        self.addNode(node)
+
+        childList = []
+        for child in bObject.children:
+            childList.append((child.nvb.imporder, child))
+        childList.sort(key=lambda tup: tup[0])
+
+        for (imporder, child) in childList:
+            self.geometryToNodes(child, simple, nameDict=nameDict)
+
 
     def generateAsciiAnimations(self, ascii_lines, rootDummy, options={}):
         if rootDummy.nvb.animList:
@@ -367,8 +509,23 @@ class Mdl():
                 nvb_anim.Animation.generateAscii(rootDummy, anim,
                                                  ascii_lines, options)
 
+    def generateAnimations(self, rootDummy):
+        '''
+        Add the animations of rootDummy to the model, the counterpart of
+        generateAsciiAnimations.
+        '''
+        for anim in rootDummy.nvb.animList:
+            animation = nvb_anim.Animation()
+            animation.loadObjects(rootDummy, anim)
+            self.animations.append(animation)
+            self.addAnimation(animation)
 
-    def generateAscii(self, asciiLines, rootDummy, exports = {'ANIMATION', 'WALKMESH'}):
+
+    def loadHeaderFromObject(self, rootDummy):
+        '''
+        Take the model header from rootDummy. Returns the map of exported
+        node names, see below, or None if no node is renamed.
+        '''
         self.name           = rootDummy.name
         self.classification = rootDummy.nvb.classification
         self.supermodel     = rootDummy.nvb.supermodel
@@ -412,6 +569,10 @@ class Mdl():
         # set object_name_map to none if feature is unused
         if not len(object_name_map.keys()):
             object_name_map = None
+        return object_name_map
+
+    def generateAscii(self, asciiLines, rootDummy, exports = {'ANIMATION', 'WALKMESH'}):
+        object_name_map = self.loadHeaderFromObject(rootDummy)
 
         # Header
         currentTime   = datetime.now()
@@ -452,17 +613,39 @@ class Mdl():
                                rootDummy.location[1],
                                rootDummy.location[2])
             asciiLines.append('  layoutposition {: .7g} {: .7g} {: .7g}'.format(*lytposition))
-        self.geometryToAscii(rootDummy, asciiLines, False, nameDict=object_name_map)
+        with nvb_profile.span('export geometry'):
+            self.geometryToAscii(rootDummy, asciiLines, False, nameDict=object_name_map)
         asciiLines.append('endmodelgeom ' + self.name)
         # Animations
         if 'ANIMATION' in exports:
             asciiLines.append('')
             asciiLines.append('# ANIM ASCII')
-            self.generateAsciiAnimations(asciiLines, rootDummy)
+            with nvb_profile.span('export animations'):
+                self.generateAsciiAnimations(asciiLines, rootDummy)
         # The End
         asciiLines.append('donemodel ' + self.name)
         asciiLines.append('')
 
+    def generateNodes(self, rootDummy, exports = {'ANIMATION', 'WALKMESH'}):
+        """Load the nodes and animations of rootDummy into this model.
+
+        Nodes are filled from the objects directly, with the same data
+        generateAscii writes, but without formatting and parsing it.
+        """
+        object_name_map = self.loadHeaderFromObject(rootDummy)
+        with nvb_profile.span('export geometry'):
+            self.geometryToNodes(rootDummy, False, nameDict=object_name_map)
+        if 'ANIMATION' in exports:
+            with nvb_profile.span('export animations'):
+                self.generateAnimations(rootDummy)
+
+    def generateBinary(self, rootDummy, exports = {'ANIMATION', 'WALKMESH'}, tsl = False):
+        """Return the contents of a binary mdl and mdx for rootDummy."""
+        self.generateNodes(rootDummy, exports)
+        with nvb_profile.span('compile binary'):
+            writer = nvb_binmdl.MdlWriter(self, tsl)
+            return writer.write()
+
 class Xwk(Mdl):
     def __init__(self, wkmType = 'pwk'):
         Mdl.__init__(self)
@@ -472,24 +655,41 @@ class Xwk(Mdl):
     def loadAsciiAnimation(self, asciiBlock):
         pass # No animations in walkmeshes
 
-    def loadAscii(self, asciiLines):
-        # Parse the walkmesh
-        blockStart = -1
-        for idx, line in enumerate(asciiLines):
-            try:
-                label = line[0]
-            except IndexError:
-                # Probably empty line or whatever, just skip it
-                continue
-            if (label == 'node'):
-                blockStart = idx
-            elif (label == 'endnode'):
-                if (blockStart >= 0):
-                    self.loadAsciiNode(asciiLines[blockStart:idx+1])
-                    blockStart = -1
-                else:
-                    # "endnode" before "node"
-                    raise nvb_def.MalformedMdlFile('Unexpected "endnode" at line' + str(idx))
+    def loadAscii(self, ascii_data):
+        """Load the walkmesh nodes from ascii data (text or lines)."""
+        if isinstance(ascii_data, str):
+            ascii_data = ascii_data.splitlines()
+        for event, ascii_lines in nvb_parse.blocks(nvb_parse.tokenize(ascii_data)):
+            if event == 'node':
+                self.loadAsciiNode(ascii_lines)
+
+    def loadBinaryFiles(self, files, name):
+        """Load the walkmesh from binary walkmesh files.
+
+        files is a list of (path, door state) tuples as returned by
+        nvb_binwok.getWalkmeshFiles, name is the name of the model.
+        """
+        for filepath, state in files:
+            reader = nvb_binwok.BwmReader.fromFile(filepath)
+            reader.load(self, name, state)
+
+    def generateNodes(self, rootDummy, exports = {'ANIMATION', 'WALKMESH'}):
+        """Load the walkmesh nodes of rootDummy, like generateAscii."""
+        self.name = rootDummy.name
+
+        with nvb_profile.span('export walkmesh', type=self.walkmeshType):
+            for child in rootDummy.children:
+                self.geometryToNodes(child, True)
+
+    def generateBinary(self, rootDummy, exports = {'ANIMATION', 'WALKMESH'}):
+        """Return the binary walkmeshes for rootDummy.
+
+        Returns a list of (file suffix, data) tuples, doors have one
+        walkmesh per state.
+        """
+        self.generateNodes(rootDummy, exports)
+        with nvb_profile.span('compile binary'):
+            return nvb_binwok.writeWalkmeshes(self)
 
     def generateAscii(self, asciiLines, rootDummy, exports = {'ANIMATION', 'WALKMESH'}):
         self.name = rootDummy.name
@@ -498,8 +698,9 @@ class Xwk(Mdl):
         currentTime = datetime.now()
         asciiLines.append('# Exported from blender at ' + currentTime.strftime('%A, %Y-%m-%d'))
         # Geometry
-        for child in rootDummy.children:
-            self.geometryToAscii(child, asciiLines, True)
+        with nvb_profile.span('export walkmesh', type=self.walkmeshType):
+            for child in rootDummy.children:
+                self.geometryToAscii(child, asciiLines, True)
 
     def importToScene(self, scene):
         if self.nodeDict:
@@ -627,10 +828,8 @@ class Xwk(Mdl):
 
 class Wok(Xwk):
     def __init__(self, name = 'UNNAMED', wkmType = 'wok'):
-        self.nodeDict       = collections.OrderedDict()
+        Xwk.__init__(self, 'wok')
         self.name           = name
-        self.walkmeshType   = 'wok'
-        self.classification = nvb_def.Classification.UNKNOWN
 
     def geometryToAscii(self, bObject, asciiLines, simple):
 
@@ -646,6 +845,28 @@ class Wok(Xwk):
             for child in bObject.children:
                 self.geometryToAscii(child, asciiLines, simple)
 
+    def geometryToNodes(self, bObject, simple = False, nameDict = None):
+        nodeType = nvb_utils.getNodeType(bObject)
+        if nodeType == 'aabb':
+            node = nvb_node.Aabb()
+            node.roottype = 'wok'
+            node.nodetype = 'trimesh'
+            node.rootname = self.name
+            node.getRoomLinks(bObject.data)
+            node.loadObject(bObject, self.classification, simple)
+            self.addNode(node)
+            return  # We'll take the first aabb object
+        else:
+            for child in bObject.children:
+                self.geometryToNodes(child, simple)
+
+    def generateNodes(self, rootDummy, exports = {'ANIMATION', 'WALKMESH'}):
+        self.name = rootDummy.name
+
+        # Geometry = AABB
+        with nvb_profile.span('export walkmesh', type='wok'):
+            self.geometryToNodes(rootDummy, True)
+
     def generateAscii(self, asciiLines, rootDummy, exports = {'ANIMATION', 'WALKMESH'}):
         self.name = rootDummy.name
 
@@ -653,7 +874,8 @@ class Wok(Xwk):
         currentTime   = datetime.now()
         asciiLines.append('# Exported from blender at ' + currentTime.strftime('%A, %Y-%m-%d'))
         # Geometry = AABB
-        self.geometryToAscii(rootDummy, asciiLines, True)
+        with nvb_profile.span('export walkmesh', type='wok'):
+            self.geometryToAscii(rootDummy, asciiLines, True)
 
     def importToScene(self, scene):
         pass
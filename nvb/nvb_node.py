@@ -1,10 +1,16 @@
 """TODO: DOC."""
+import array
 import re
-import mathutils
-import bpy
-import bpy_extras.image_utils
-import bmesh
-from bpy_extras.io_utils import unpack_list, unpack_face_list
+
+try:
+    import bpy
+    import bpy_extras.image_utils
+    import bmesh
+    import mathutils
+except ImportError:
+    # Outside of Blender nodes can still be read and written, but not
+    # added to or exported from a scene
+    bpy = bpy_extras = bmesh = mathutils = None
 
 from . import nvb_glob
 from . import nvb_def
@@ -12,16 +18,26 @@ from . import nvb_utils
 from . import nvb_aabb
 from . import nvb_parse
 from . import nvb_txi
+from . import nvb_profile
+from . import nvb_material
+from . import nvb_texture
 
 class FaceList():
+    """
+    Faces as packed int32 columns, numpy arrays when parsed with numpy
+    """
+    __slots__ = ('faces', 'shdgr', 'uvIdx', 'matId')
+
     def __init__(self):
-        self.faces = []  # int 3-tuple, vertex indices
-        self.shdgr = []  # int, shading group for this face
-        self.uvIdx = []  # int 3-tuple, texture/uv vertex indices
-        self.matId = []  # int, material index
+        self.faces = nvb_parse.Rows('i', 3)  # int 3-tuple, vertex indices
+        self.shdgr = array.array('i')  # int, shading group for this face
+        self.uvIdx = nvb_parse.Rows('i', 3)  # int 3-tuple, texture/uv vertex indices
+        self.matId = array.array('i')  # int, material index
 
 
 class FlareList():
+    __slots__ = ('textures', 'sizes', 'positions', 'colorshifts')
+
     def __init__(self):
         self.textures    = []
         self.sizes       = []
@@ -33,6 +49,37 @@ class GeometryNode():
     """
     Basic node from which every other is derived
     """
+    __slots__ = ('nodetype', 'roottype', 'rootname', 'name', 'parentName',
+                 'position', 'orientation', 'scale', 'wirecolor', 'objref',
+                 'parsed_spans', '_rawascii')
+
+    # Maps lower case labels to (attribute, number of values, converter,
+    # block type). The block type decides which lines belong to a label:
+    #   None        the values follow the label on the same line, a single
+    #               value is stored as is, more values as tuple, if the
+    #               number of values is None all of them are stored
+    #   'counted'   the label is followed by the number of lines, each line
+    #               holding number of values, like 'verts 4'
+    #   'uncounted' all following lines starting with a number
+    #   'method'    the converter is the name of a method, called with the
+    #               node's lines and the label's index and returning the
+    #               number of lines it parsed
+    # For (un)counted blocks without an attribute the converter is the name
+    # of a method which is called with the lines of the block.
+    # Schemas are merged along the class hierarchy, see getSchema().
+    schema = {
+        'parent':      ('parentName',  1, nvb_utils.getName, None),
+        'position':    ('position',    3, float, None),
+        'orientation': ('orientation', 4, float, None),
+        'scale':       ('scale',       1, float, None),
+        'wirecolor':   ('wirecolor',   3, float, None),
+    }
+    # Whether to keep unparsed lines in rawascii, and their indentation
+    keepRaw   = False
+    rawIndent = ''
+
+    _schemas = dict()
+
     def __init__(self, name = 'UNNAMED'):
         self.nodetype = 'undefined'
 
@@ -49,10 +96,20 @@ class GeometryNode():
         # Name of the corresponding object in blender
         # (used to resolve naming conflicts)
         self.objref   = ''
-        # Parsed lines (by number), allow last parser to include unhandled data
-        self.parsed_lines = [];
-        self.rawascii         = '' # unprocessed directives
+        # Parsed lines as (start, end) ranges of line numbers, in order,
+        # allow last parser to include unhandled data
+        self.parsed_spans = []
+        self._rawascii    = nvb_parse.RawAscii() # unprocessed directives
+
+
 
+    @property
+    def rawascii(self):
+        return self._rawascii.text()
+
+    @rawascii.setter
+    def rawascii(self, text):
+        self._rawascii = nvb_parse.RawAscii(text)
 
 
     def __eq__(self, other):
@@ -86,46 +143,106 @@ class GeometryNode():
             floatList.append( (l_float(line[0]), l_float(line[1]), l_float(line[2])) )
 
 
-    def loadAscii(self, asciiNode):
-        l_float = float
-        l_isNumber = nvb_utils.isNumber
+    @classmethod
+    def getSchema(cls):
+        """Return the schema of this class merged with its bases."""
+        schema = GeometryNode._schemas.get(cls)
+        if schema is None:
+            schema = dict()
+            for klass in reversed(cls.__mro__):
+                schema.update(klass.__dict__.get('schema', {}))
+            cls.extendSchema(schema)
+            GeometryNode._schemas[cls] = schema
+        return schema
+
+    @classmethod
+    def extendSchema(cls, schema):
+        """Add entries to the schema which can't be declared statically."""
+        pass
 
-        for index, line in enumerate(asciiNode):
+    def loadAscii(self, asciiNode):
+        """Parse the lines of a node in a single pass.
+
+        Every label is looked up in the schema of the node type. If keepRaw
+        is set, lines with an unknown label, and the numeric lines following
+        them, are kept in rawascii, as their tokens joined by single spaces
+        and prefixed with rawIndent. Lines with a known label but malformed
+        values are dropped, along with the values of their block, they would
+        be exported twice otherwise.
+        """
+        schema = type(self).getSchema()
+        numLines = len(asciiNode)
+        idx = 0
+        while idx < numLines:
+            line = asciiNode[idx]
             try:
                 label = line[0].lower()
             except IndexError:
                 # Probably empty line or whatever, skip it
+                idx += 1
+                continue
+            if (label == 'node'):
+                self.name = nvb_utils.getName(line[2])
+                self.addParsedSpan(idx, idx+1)
+            elif (label == 'endnode'):
+                self.addParsedSpan(idx, idx+1)
+                break
+            elif label in schema:
+                try:
+                    numParsed = self.loadAsciiProperty(schema[label], asciiNode, idx)
+                except (ValueError, IndexError):
+                    # Malformed values, e.g. 'undefined' instead of a number,
+                    # drop the values of blocks as well
+                    numParsed = 1
+                    if schema[label][3] is not None:
+                        numParsed += nvb_parse.countNumeric(asciiNode[idx+1:])
+                numParsed = max(numParsed, 1)
+                self.addParsedSpan(idx, idx+numParsed)
+                idx += numParsed
                 continue
+            idx += 1
+        self.finishAscii(asciiNode)
+        if self.keepRaw:
+            self.addUnparsedToRaw(asciiNode)
 
-            if not l_isNumber(label):
-                if (label == 'node'):
-                    self.name = nvb_utils.getName(line[2])
-                    self.parsed_lines.append(index)
-                elif (label == 'endnode'):
-                    self.parsed_lines.append(index)
-                    return
-                elif (label == 'parent'):
-                    self.parentName = nvb_utils.getName(line[1])
-                    self.parsed_lines.append(index)
-                elif (label == 'position'):
-                    self.position = (l_float(line[1]),
-                                     l_float(line[2]),
-                                     l_float(line[3]))
-                    self.parsed_lines.append(index)
-                elif (label == 'orientation'):
-                    self.orientation = (l_float(line[1]),
-                                        l_float(line[2]),
-                                        l_float(line[3]),
-                                        l_float(line[4]))
-                    self.parsed_lines.append(index)
-                elif (label == 'scale'):
-                    self.scale = l_float(line[1])
-                    self.parsed_lines.append(index)
-                elif (label == 'wirecolor'):
-                    self.wirecolor = (l_float(line[1]),
-                                      l_float(line[2]),
-                                      l_float(line[3]))
-                    self.parsed_lines.append(index)
+    def loadAsciiProperty(self, prop, asciiNode, idx):
+        """Parse a single schema entry, return the number of parsed lines."""
+        attrname, numVals, convert, blockType = prop
+        line = asciiNode[idx]
+        if blockType is None:
+            if numVals is None:
+                value = tuple(map(convert, line[1:]))
+            elif numVals == 1:
+                value = convert(line[1])
+            else:
+                value = tuple([convert(line[i]) for i in range(1, numVals+1)])
+            setattr(self, attrname, value)
+            return 1
+        if blockType == 'method':
+            return getattr(self, convert)(asciiNode, idx)
+        numBlockLines = -1
+        if blockType == 'counted':
+            try:
+                numBlockLines = int(line[1])
+            except (IndexError, ValueError):
+                pass
+        if numBlockLines < 0:
+            numBlockLines = nvb_parse.countNumeric(asciiNode[idx+1:])
+        blockLines = asciiNode[idx+1:idx+numBlockLines+1]
+        if attrname is None:
+            getattr(self, convert)(blockLines)
+        else:
+            # Attributes of members, like 'flareList.sizes'
+            target = self
+            if '.' in attrname:
+                member, attrname = attrname.split('.')
+                target = getattr(self, member)
+            setattr(target, attrname, nvb_parse.block(blockLines, numVals, convert))
+        return numBlockLines + 1
+
+    def finishAscii(self, asciiNode):
+        """Called after all lines have been parsed."""
+        pass
 
     def setObjectData(self, obj):
         self.objref = obj.name  # used to resolve naming conflicts
@@ -214,26 +331,78 @@ class GeometryNode():
         self.addDataToAscii(obj, asciiLines, classification, simple, nameDict=nameDict)
         asciiLines.append('endnode')
 
+    @staticmethod
+    def getExportName(obj, nameDict = None):
+        '''
+        Return the name obj is exported with, NULL if there is no object.
+        '''
+        if obj is None:
+            return nvb_def.null
+        if nameDict and obj.name in nameDict:
+            return nameDict[obj.name]
+        return obj.name
+
+    def loadObjectRawAscii(self, obj):
+        '''
+        Parse the unprocessed data of an object, like the ascii exporter
+        and importer would. Known labels end up in the node, the rest in
+        rawascii.
+        '''
+        if obj.nvb.rawascii and obj.nvb.rawascii in bpy.data.texts:
+            text = bpy.data.texts[obj.nvb.rawascii].as_string()
+            self.loadAscii([tokens for _, tokens in nvb_parse.tokenize(text.splitlines())])
+
+    def loadObjectData(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict = None):
+        self.parentName = self.getExportName(obj.parent, nameDict)
+        # Scaling fix
+        transmat = self.getAdjustedMatrix(obj)
+        self.position    = tuple(transmat.to_translation())
+        self.orientation = tuple(nvb_utils.getAuroraRotFromObject(obj))
+        self.wirecolor   = tuple(obj.nvb.wirecolor)
+        self.scale       = round(nvb_utils.getAuroraScale(obj), 3)
+        self.loadObjectRawAscii(obj)
+
+    def loadObject(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict = None):
+        '''
+        Fill the node with the data of a blender object, the counterpart
+        of toAscii for exporters which don't need the ascii lines, e.g.
+        the binary mdl writer.
+        '''
+        self.name = self.getExportName(obj, nameDict)
+        self.loadObjectData(obj, classification, simple, nameDict=nameDict)
+
+    def addParsedSpan(self, start, end):
+        '''
+        Mark the lines start:end as parsed, spans have to be added in order.
+        '''
+        spans = self.parsed_spans
+        if spans and spans[-1][1] >= start:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+        else:
+            spans.append((start, end))
+
     def addUnparsedToRaw(self, asciiNode):
-        for idx, line in enumerate(asciiNode):
-            if idx in self.parsed_lines or not len(''.join(line).strip()):
-                continue
-            self.rawascii += '\n' + ' '.join(line)
+        '''
+        Keep all lines between the parsed spans, they are joined on demand.
+        '''
+        start = 0
+        for spanStart, spanEnd in self.parsed_spans:
+            self._rawascii.addLines(asciiNode[start:spanStart], self.rawIndent)
+            start = max(start, spanEnd)
+        self._rawascii.addLines(asciiNode[start:], self.rawIndent)
 
 
 class Dummy(GeometryNode):
     '''
 
     '''
+    __slots__ = ('dummytype',)
     def __init__(self, name = 'UNNAMED'):
         GeometryNode.__init__(self, name)
         self.nodetype  = 'dummy'
 
         self.dummytype = nvb_def.Dummytype.NONE
 
-    def loadAscii(self, asciiNode):
-        GeometryNode.loadAscii(self, asciiNode)
-
     def setObjectData(self, obj):
         GeometryNode.setObjectData(self, obj)
 
@@ -296,10 +465,24 @@ class Dummy(GeometryNode):
         if subtype == nvb_def.Dummytype.NONE:
             pass
 
+    def loadObjectData(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
+        self.parentName = self.getExportName(obj.parent, nameDict)
+        if obj.nvb.dummytype == nvb_def.Dummytype.MDLROOT:
+            # Only parent for rootdummys
+            return
+
+        # Scaling fix
+        self.scale = 1.0
+        transmat = self.getAdjustedMatrix(obj)
+        self.position    = tuple(transmat.to_translation())
+        self.orientation = tuple(nvb_utils.euler2nwangle(transmat.to_euler('XYZ')))
+        self.wirecolor   = tuple(obj.nvb.wirecolor)
+
 
 class Patch(GeometryNode):
     """Same as a plain Dummy."""
 
+    __slots__ = ('dummytype',)
     def __init__(self, name = 'UNNAMED'):
         GeometryNode.__init__(self, name)
         self.nodetype = 'patch'
@@ -314,6 +497,13 @@ class Patch(GeometryNode):
 
 class Reference(GeometryNode):
     """Contains a reference to another mdl."""
+    __slots__ = ('dummytype', 'refmodel', 'reattachable')
+
+    schema = {
+        'refmodel':     ('refmodel',     1, str, None),
+        'reattachable': ('reattachable', 1, int, None),
+    }
+    keepRaw = True
 
     def __init__(self, name = 'UNNAMED'):
         GeometryNode.__init__(self, name)
@@ -323,28 +513,6 @@ class Reference(GeometryNode):
         self.refmodel     = nvb_def.null
         self.reattachable = 0
 
-    def loadAscii(self, asciiNode):
-        GeometryNode.loadAscii(self, asciiNode)
-        l_isNumber = nvb_utils.isNumber
-
-        for idx, line in enumerate(asciiNode):
-            try:
-                label = line[0].lower()
-            except IndexError:
-                # Probably empty line or whatever, skip it
-                continue
-            if not l_isNumber(label):
-                if (label == 'refmodel'):
-                    # self.refmodel = line[1].lower()
-                    self.refmodel = line[1]
-                    self.parsed_lines.append(idx)
-                elif (label == 'reattachable'):
-                    self.reattachable = int(line[1])
-                    self.parsed_lines.append(idx)
-        if (self.nodetype == 'reference'):
-            self.addUnparsedToRaw(asciiNode)
-
-
     def setObjectData(self, obj):
         GeometryNode.setObjectData(self, obj)
         obj.nvb.dummytype    = self.dummytype
@@ -357,9 +525,58 @@ class Reference(GeometryNode):
         asciiLines.append('  refmodel ' + obj.nvb.refmodel)
         asciiLines.append('  reattachable ' + str(int(obj.nvb.reattachable)))
 
+    def loadObjectData(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
+        GeometryNode.loadObjectData(self, obj, classification, nameDict=nameDict)
+        self.refmodel     = obj.nvb.refmodel
+        self.reattachable = int(obj.nvb.reattachable)
+
 
 class Trimesh(GeometryNode):
     """TODO: Doc."""
+    __slots__ = ('meshtype', 'center', 'lightmapped', 'render', 'shadow',
+                 'beaming', 'inheritcolor', 'm_bIsBackgroundGeometry',
+                 'dirt_enabled', 'dirt_texture', 'dirt_worldspace',
+                 'hologram_donotdraw', 'animateuv', 'uvdirectionx',
+                 'uvdirectiony', 'uvjitter', 'uvjitterspeed', 'alpha',
+                 'transparencyhint', 'selfillumcolor', 'ambient', 'diffuse',
+                 'bitmap', 'bitmap2', 'tangentspace', 'rotatetexture', 'verts',
+                 'facelist', 'tverts', 'tverts1', 'texindices1', 'roomlinks',
+                 'lytposition')
+
+    schema = {
+        'render':             ('render',             1, int, None),
+        'shadow':             ('shadow',             1, int, None),
+        'lightmapped':        ('lightmapped',        1, int, None),
+        'beaming':            ('beaming',            1, int, None),
+        'inheritcolor':       ('inheritcolor',       1, int, None),
+        'tangentspace':       ('tangentspace',       1, int, None),
+        'rotatetexture':      ('rotatetexture',      1, int, None),
+        'm_bisbackgroundgeometry': ('m_bIsBackgroundGeometry', 1, int, None),
+        'dirt_enabled':       ('dirt_enabled',       1, int, None),
+        'dirt_texture':       ('dirt_texture',       1, int, None),
+        'dirt_worldspace':    ('dirt_worldspace',    1, int, None),
+        'hologram_donotdraw': ('hologram_donotdraw', 1, int, None),
+        'animateuv':          ('animateuv',          1, int, None),
+        'uvdirectionx':       ('uvdirectionx',       1, float, None),
+        'uvdirectiony':       ('uvdirectiony',       1, float, None),
+        'uvjitter':           ('uvjitter',           1, float, None),
+        'uvjitterspeed':      ('uvjitterspeed',      1, float, None),
+        'alpha':              ('alpha',              1, float, None),
+        'transparencyhint':   ('transparencyhint',   1, int, None),
+        'selfillumcolor':     ('selfillumcolor',     3, float, None),
+        'ambient':            ('ambient',            3, float, None),
+        'diffuse':            ('diffuse',            3, float, None),
+        'center':             ('center',             3, float, None),
+        'bitmap':             ('bitmap',             1, str, None),
+        'bitmap2':            ('bitmap2',            1, str, None),
+        'verts':              ('verts',              3, float, 'counted'),
+        'faces':              (None,                 8, 'parseFaceList', 'counted'),
+        'tverts':             ('tverts',             2, float, 'counted'),
+        'tverts1':            ('tverts1',            2, float, 'counted'),
+        'texindices1':        ('texindices1',        3, int, 'counted'),
+        'roomlinks':          ('roomlinks',          2, int, 'counted'),
+    }
+    keepRaw = True
 
     def __init__(self, name = 'UNNAMED'):
         GeometryNode.__init__(self, name)
@@ -400,11 +617,17 @@ class Trimesh(GeometryNode):
         self.lytposition      = (0.0, 0.0, 0.0)
 
     def createImage(self, imgName, imgPath):
-        image = bpy_extras.image_utils.load_image(imgName + '.tga',
-                                                  imgPath,
-                                                  recursive=nvb_glob.textureSearch,
-                                                  place_holder=False,
-                                                  ncase_cmp=True)
+        image = None
+        with nvb_profile.span('load image', image=imgName):
+            if nvb_glob.texturePrefetcher is not None:
+                # The file is being read in the background
+                nvb_glob.texturePrefetcher.wait(imgName)
+            locator = nvb_texture.getLocator(imgPath, nvb_glob.textureSearch,
+                                             refresh=False)
+            filepath = locator.find(imgName)
+            if filepath is not None:
+                image = bpy_extras.image_utils.load_image(filepath,
+                                                          place_holder=False)
         if (image is None):
             print('Kotorblender - WARNING: Could not load image ' + imgName)
             print(imgPath)
@@ -414,143 +637,12 @@ class Trimesh(GeometryNode):
 
         return image
 
-    def loadAscii(self, asciiNode):
-        GeometryNode.loadAscii(self, asciiNode)
-
-        l_int   = int
-        l_float = float
-        l_isNumber = nvb_utils.isNumber
-        for idx, line in enumerate(asciiNode):
-            try:
-                label = line[0].lower()
-            except IndexError:
-                # Probably empty line or whatever, skip it
-                continue
-
-            if not l_isNumber(label):
-                if (label == 'render'):
-                    self.render = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'shadow'):
-                    self.shadow = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'lightmapped'):
-                    self.lightmapped = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'beaming'):
-                    self.beaming = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'inheritcolor '):
-                    self.inheritcolor = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'tangentspace'):
-                    self.tangentspace = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'rotatetexture'):
-                    self.rotatetexture = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'm_bisbackgroundgeometry'):
-                    self.m_bIsBackgroundGeometry = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'dirt_enabled'):
-                    self.dirt_enabled = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'dirt_texture'):
-                    self.dirt_texture = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'dirt_worldspace'):
-                    self.dirt_worldspace = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'hologram_donotdraw'):
-                    self.hologram_donotdraw = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'animateuv'):
-                    self.animateuv = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'uvdirectionx'):
-                    self.uvdirectionx = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'uvdirectiony'):
-                    self.uvdirectiony = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'uvjitter'):
-                    self.uvjitter = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'uvjitterspeed'):
-                    self.uvjitterspeed = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'alpha'):
-                    self.alpha = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'transparencyhint'):
-                    self.transparencyhint = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'selfillumcolor'):  # Self illumination color
-                    self.selfillumcolor = (l_float(line[1]),
-                                           l_float(line[2]),
-                                           l_float(line[3]))
-                    self.parsed_lines.append(idx)
-                elif (label == 'ambient'):
-                    self.ambient = (l_float(line[1]),
-                                    l_float(line[2]),
-                                    l_float(line[3]))
-                    self.parsed_lines.append(idx)
-                elif (label == 'diffuse'):
-                    self.diffuse = (l_float(line[1]),
-                                    l_float(line[2]),
-                                    l_float(line[3]))
-                    self.parsed_lines.append(idx)
-                elif (label == 'center'):
-                    # Unused ? Becuase we don't do anything with this
-                    try:
-                        self.center = (l_float(line[1]),
-                                       l_float(line[2]),
-                                       l_float(line[3]))
-                        self.parsed_lines.append(idx)
-                    except:
-                        # Probably an 'undefined' string which cannot be
-                        # converted to float
-                        pass
-                elif (label == 'bitmap'):
-                    self.bitmap = line[1]
-                    self.parsed_lines.append(idx)
-                elif (label == 'bitmap2'):
-                    self.bitmap2 = line[1]
-                    self.parsed_lines.append(idx)
-                elif (label == 'verts'):
-                    numVals = l_int(line[1])
-                    nvb_parse.f3(asciiNode[idx+1:idx+numVals+1], self.verts)
-                    #self.verts = [(float(l[0]), float(l[1]), float(l[2])) for l in asciiNode[idx+1:idx+numVals+1]]
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-                elif (label == 'faces'):
-                    numVals = l_int(line[1])
-                    self.parseFaceList(asciiNode[idx+1:idx+numVals+1])
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-                elif (label == 'tverts'):
-                    numVals = l_int(line[1])
-                    nvb_parse.f2(asciiNode[idx+1:idx+numVals+1], self.tverts)
-                    #self.tverts = [(float(l[0]), float(l[1])) for l in asciiNode[idx+1:idx+numVals+1]]
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-                elif (label == 'tverts1'):
-                    numVals = l_int(line[1])
-                    nvb_parse.f2(asciiNode[idx+1:idx+numVals+1], self.tverts1)
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-                elif (label == 'texindices1'):
-                    numVals = l_int(line[1])
-                    nvb_parse.i3(asciiNode[idx+1:idx+numVals+1], self.texindices1, initialFloat=False)
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-                elif (label == 'roomlinks'):
-                    try:
-                        numVals = l_int(line[1])
-                    except:
-                        numVals = next((i for i, v in enumerate(asciiNode[idx+1:]) if not l_isNumber(v[0])), -1)
-                    nvb_parse.i2(asciiNode[idx+1:idx+numVals+1], self.roomlinks)
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-        if (self.nodetype == 'trimesh'):
-            self.addUnparsedToRaw(asciiNode)
-
-
     def parseFaceList(self, asciiFaces):
+        columns = nvb_parse.facearrays(asciiFaces)
+        if columns is not None:
+            (self.facelist.faces, self.facelist.shdgr,
+             self.facelist.uvIdx, self.facelist.matId) = columns
+            return
         l_int = int
         for line in asciiFaces:
             self.facelist.faces.append((l_int(line[0]),
@@ -562,58 +654,120 @@ class Trimesh(GeometryNode):
                                         l_int(line[6])))
             self.facelist.matId.append(l_int(line[7]))
 
+    def getTexture(self, texName, imgName):
+        """Return the texture texName with the image imgName, reusing
+        textures and images imported before.
+        """
+        registry = nvb_material.registry
+        # If a texture with the same name was already created treat
+        # them as if they were the same, i.e. just use the old one
+        texture = registry.findTexture(texName)
+        if texture is None:
+            texture = bpy.data.textures.new(texName, type='IMAGE')
+            registry.addTexture(texture)
+
+        # Load the image for the texture, but check if it was
+        # already loaded before. If so, use that one.
+        image = registry.findImage(imgName)
+        if image is None:
+            image = self.createImage(imgName, nvb_glob.texturePath)
+            if image is not None:
+                registry.addImage(image)
+        if image is not None:
+            texture.image = image
+        return texture
+
     def createMaterial(self, name, bitmap):
-        material = None
+        registry = nvb_material.registry
         texName  = self.bitmap.lower()
+        lightmap = ''
+        if not nvb_utils.isNull(self.bitmap2):
+            lightmap = self.bitmap2
+        key = nvb_material.materialKey(self.diffuse,
+                                       nvb_material.DEFAULT_SPECULAR,
+                                       '' if nvb_utils.isNull(bitmap) else bitmap,
+                                       self.alpha,
+                                       lightmap)
         if nvb_glob.materialMode == 'SIN':
             # Avoid duplicate materials, search for similar ones.
-            material = nvb_utils.materialExists(self.diffuse,
-                                                (0.0, 0.0, 0.0),
-                                                texName,
-                                                self.alpha)
-
-        if not material:
-            material = bpy.data.materials.new(name)
-            material.diffuse_color     = self.diffuse
-            material.diffuse_intensity = 1.0
-
-            if not nvb_utils.isNull(self.bitmap):
-                textureSlot = material.texture_slots.add()
-                # If a texture with the same name was already created treat
-                # them as if they were the same, i.e. just use the old one
-                if (texName in bpy.data.textures):
-                    textureSlot.texture = bpy.data.textures[texName]
-                else:
-                    textureSlot.texture = bpy.data.textures.new(texName, type='IMAGE')
-                textureSlot.texture_coords        = 'UV'
-                textureSlot.use_map_color_diffuse = True
-
-                # Load the image for the texture, but check if it was
-                # already loaded before. If so, use that one.
-                imgName = bitmap
-                if (imgName in bpy.data.images):
-                    image = bpy.data.images[imgName]
-                    textureSlot.texture.image = image
+            material = registry.findMaterial(key)
+            if material is not None:
+                return material
+
+        material = bpy.data.materials.new(name)
+        material.diffuse_color     = self.diffuse
+        material.diffuse_intensity = 1.0
+
+        if not nvb_utils.isNull(self.bitmap):
+            textureSlot = material.texture_slots.add()
+            textureSlot.texture = self.getTexture(texName, bitmap)
+            textureSlot.texture_coords        = 'UV'
+            textureSlot.use_map_color_diffuse = True
+            if self.tangentspace == 1:
+                textureSlot.texture.nvb.bumpmapped = True
+            with nvb_profile.span('load txi'):
+                prefetcher = nvb_glob.texturePrefetcher
+                if prefetcher is not None and prefetcher.has(bitmap):
+                    properties = prefetcher.wait(bitmap)
+                    if properties:
+                        nvb_txi.applyTxi(textureSlot.texture, properties)
                 else:
-                    image = self.createImage(imgName, nvb_glob.texturePath)
-                    if image is not None:
-                        textureSlot.texture.image = image
-                if self.tangentspace == 1:
-                    textureSlot.texture.nvb.bumpmapped = True
-                nvb_txi.loadTxi(textureSlot.texture)
+                    nvb_txi.loadTxi(textureSlot.texture)
 
-            nvb_utils.setMaterialAuroraAlpha(material, self.alpha)
+        nvb_utils.setMaterialAuroraAlpha(material, self.alpha)
 
+        # Lightmap material?
+        if lightmap:
+            # configure material:
+            material.use_shadeless = True
+            textureSlot = material.texture_slots.add()
+            textureSlot.texture = self.getTexture(lightmap.lower(), lightmap)
+            textureSlot.texture_coords        = 'UV'
+            textureSlot.use_map_color_diffuse = True
+            textureSlot.blend_type            = 'OVERLAY'
+
+        registry.addMaterial(key, material)
         return material
 
 
+    def addGeometry(self, mesh):
+        """Add the vertices and triangles to mesh.
+
+        Loops and polygons are filled with a few foreach_set calls, edges
+        are calculated afterwards.
+        """
+        faces    = self.facelist.faces
+        numFaces = len(faces)
+        mesh.vertices.add(len(self.verts))
+        mesh.vertices.foreach_set('co', nvb_parse.flatList(self.verts))
+        mesh.loops.add(3 * numFaces)
+        mesh.loops.foreach_set('vertex_index', nvb_parse.flatTriangles(faces, faces))
+        mesh.polygons.add(numFaces)
+        mesh.polygons.foreach_set('loop_start', array.array('i', range(0, 3 * numFaces, 3)))
+        mesh.polygons.foreach_set('loop_total', array.array('i', [3]) * numFaces)
+        mesh.update(calc_edges=True)
+
+    def addUVLayer(self, mesh, layerName, tverts, uvIdx, image = None):
+        """Add a uv layer with one uv per loop, from tverts and the uv
+        indices of the faces.
+        """
+        uvTex = mesh.uv_textures.new(layerName)
+        loopUVs = nvb_parse.gather(tverts,
+                                   nvb_parse.flatTriangles(uvIdx, self.facelist.faces))
+        mesh.uv_layers[uvTex.name].data.foreach_set('uv', loopUVs)
+        if image is not None:
+            # The image of a face is a pointer, foreach_set only handles
+            # int, float and bool properties. The textured (multitexture)
+            # viewport and the uv editor show face images, not the image
+            # of the material's texture slot, so every face needs it.
+            for polyUV in uvTex.data:
+                polyUV.image = image
+        return uvTex
+
     def createMesh(self, name):
         # Create the mesh itself
         mesh = bpy.data.meshes.new(name)
-        mesh.vertices.add(len(self.verts))
-        mesh.vertices.foreach_set('co', unpack_list(self.verts))
-        mesh.tessfaces.add(len(self.facelist.faces))
-        mesh.tessfaces.foreach_set('vertices_raw', unpack_face_list(self.facelist.faces))
+        self.addGeometry(mesh)
 
         # Special handling for converted sabermesh
         if name.startswith('2081__'):
@@ -637,108 +791,39 @@ class Trimesh(GeometryNode):
                 mesh.materials.append(material)
 
             # Apply the walkmesh materials to each face
-            for idx, face in enumerate(mesh.tessfaces):
-                face.material_index = self.facelist.matId[idx]
+            mesh.polygons.foreach_set('material_index', self.facelist.matId)
 
         # Create material
         if nvb_glob.materialMode != 'NON' and self.roottype == 'mdl':
-            material = self.createMaterial(name, self.bitmap)
+            with nvb_profile.span('create material'):
+                material = self.createMaterial(name, self.bitmap)
             mesh.materials.append(material)
 
-            # Lightmap material?
-            if (not nvb_utils.isNull(self.bitmap2)):
-                # configure material:
-                material.use_shadeless = True
-                texName = self.bitmap2.lower()
-                textureSlot = material.texture_slots.add()
-                # If a texture with the same name was already created treat
-                # them as if they were the same, i.e. just use the old one
-                if (texName in bpy.data.textures):
-                    textureSlot.texture = bpy.data.textures[texName]
-                else:
-                    textureSlot.texture = bpy.data.textures.new(texName, type='IMAGE')
-                textureSlot.texture_coords        = 'UV'
-                textureSlot.use_map_color_diffuse = True
-                textureSlot.blend_type            = 'OVERLAY'
-                # set slot 0's uv layer now
-
-                # Load the image for the texture, but check if it was
-                # already loaded before. If so, use that one.
-                imgName = self.bitmap2
-                if (imgName in bpy.data.images):
-                    image = bpy.data.images[imgName]
-                    textureSlot.texture.image = image
-                else:
-                    image = self.createImage(imgName, nvb_glob.texturePath)
-                    if image is not None:
-                        textureSlot.texture.image = image
-
-            # Create UV map
-            if (len(self.tverts) > 0) and (mesh.tessfaces):
-                uv = mesh.tessface_uv_textures.new(name + '.uv')
-                mesh.tessface_uv_textures.active = uv
-
-                for i in range(len(self.facelist.uvIdx)):
-                    # Get a tessface
-                    tessface = mesh.tessfaces[i]
-                    # Apply material (there is only ever one)
-                    tessface.material_index = 0
-                    # Grab a uv for the face
-                    tessfaceUV = mesh.tessface_uv_textures[0].data[i]
-                    # Get the indices of the 3 uv's for this face
-                    uvIdx = self.facelist.uvIdx[i]
-
-                    # BEGIN EEEKADOODLE FIX
-                    # BUG: Evil eekadoodle problem where faces that have
-                    # vert index 0 at location 3 are shuffled.
-                    vertIdx = self.facelist.faces[i]
-                    if vertIdx[2] == 0:
-                        uvIdx = uvIdx[1], uvIdx[2], uvIdx[0]
-                    # END EEEKADOODLE FIX
-
-                    # Add uv coordinates to face
-                    tessfaceUV.uv1 = self.tverts[uvIdx[0]]
-                    tessfaceUV.uv2 = self.tverts[uvIdx[1]]
-                    tessfaceUV.uv3 = self.tverts[uvIdx[2]]
-
-                    # Apply texture to uv face
-                    if (not nvb_utils.isNull(self.bitmap)) and material.texture_slots[0]:
-                        tessfaceUV.image = material.texture_slots[0].texture.image
+            # Create UV map, there is only ever one material so the
+            # material indices stay 0
+            if (len(self.tverts) > 0) and (mesh.polygons):
+                image = None
+                if (not nvb_utils.isNull(self.bitmap)) and material.texture_slots[0]:
+                    image = material.texture_slots[0].texture.image
+                uv = self.addUVLayer(mesh, name + '.uv', self.tverts,
+                                     self.facelist.uvIdx, image)
+                mesh.uv_textures.active = uv
 
             # Create lightmap UV map
-            if (len(self.tverts1) > 0) and (mesh.tessfaces):
-                lm_idx = len(mesh.tessface_uv_textures)
-                uv = mesh.tessface_uv_textures.new(name + '_lm.uv')
-                #mesh.tessface_uv_textures.active = uv
-
-                for i in range(len(self.facelist.uvIdx)):
-                    # Get a tessface
-                    tessface = mesh.tessfaces[i]
-                    # Apply material (there is only ever one)
-                    tessface.material_index = 0
-                    # Grab a uv for the face
-                    tessfaceUV = mesh.tessface_uv_textures[lm_idx].data[i]
-                    # Get the indices of the 3 uv's for this face
-                    uvIdx = self.facelist.uvIdx[i]
-                    if len(self.texindices1) and i < len(self.texindices1):
-                        uvIdx = self.texindices1[i]
-
-                    # BEGIN EEEKADOODLE FIX
-                    # BUG: Evil eekadoodle problem where faces that have
-                    # vert index 0 at location 3 are shuffled.
-                    vertIdx = self.facelist.faces[i]
-                    if vertIdx[2] == 0:
-                        uvIdx = uvIdx[1], uvIdx[2], uvIdx[0]
-                    # END EEEKADOODLE FIX
-
-                    # Add uv coordinates to face
-                    tessfaceUV.uv1 = self.tverts1[uvIdx[0]]
-                    tessfaceUV.uv2 = self.tverts1[uvIdx[1]]
-                    tessfaceUV.uv3 = self.tverts1[uvIdx[2]]
-
-                    # Apply texture to uv face
-                    if (not nvb_utils.isNull(self.bitmap2)) and material.texture_slots[1]:
-                        tessfaceUV.image = material.texture_slots[1].texture.image
+            if (len(self.tverts1) > 0) and (mesh.polygons):
+                uvIdx = self.facelist.uvIdx
+                if len(self.texindices1) == len(uvIdx):
+                    uvIdx = self.texindices1
+                elif len(self.texindices1) > len(uvIdx):
+                    uvIdx = self.texindices1[:len(uvIdx)]
+                elif len(self.texindices1):
+                    # Only the first faces have their own lightmap indices
+                    uvIdx = list(self.texindices1) + \
+                            list(uvIdx[len(self.texindices1):])
+                image = None
+                if (not nvb_utils.isNull(self.bitmap2)) and material.texture_slots[1]:
+                    image = material.texture_slots[1].texture.image
+                self.addUVLayer(mesh, name + '_lm.uv', self.tverts1, uvIdx, image)
                 if material.texture_slots[1]:
                     material.texture_slots[1].uv_layer = name + '_lm.uv'
                 if material.texture_slots[0]:
@@ -746,20 +831,11 @@ class Trimesh(GeometryNode):
 
         # Import smooth groups as sharp edges
         if nvb_glob.importSmoothGroups:
-            bm = bmesh.new()
-            mesh.update()
-            bm.from_mesh(mesh)
-            if hasattr(bm.edges, "ensure_lookup_table"):
-                bm.edges.ensure_lookup_table()
             # Mark edge as sharp if its faces belong to different smooth groups
-            for e in bm.edges:
-                f = e.link_faces
-                #if (len(f) > 1) and (self.facelist.shdgr[f[0].index] != self.facelist.shdgr[f[1].index]):
-                if (len(f) > 1) and not (self.facelist.shdgr[f[0].index] & self.facelist.shdgr[f[1].index]):
-                    edgeIdx = e.index
-                    mesh.edges[edgeIdx].use_edge_sharp = True
-            bm.free()
-            del bm
+            loopEdges = nvb_parse.intBuffer(len(mesh.loops))
+            mesh.loops.foreach_get('edge_index', loopEdges)
+            mesh.edges.foreach_set('use_edge_sharp', nvb_parse.sharpEdges(
+                loopEdges, self.facelist.shdgr, len(mesh.edges)))
             mesh.show_edge_sharp = True
             mesh.update()
             # load all smoothgroup numbers into a mesh data layer per-poly
@@ -877,41 +953,59 @@ class Trimesh(GeometryNode):
         return obj
 
 
-    def addMaterialDataToAscii(self, obj, asciiLines):
+    def getMaterialData(self, obj):
+        '''
+        Return (diffuse, tangentspace, bitmap, alpha, bitmap2) of the active
+        material, None if there is none. tangentspace is None without a
+        texture, bitmap2 without a second texture slot.
+        '''
         # Check if this object has a material assigned to it
         material = obj.active_material
-        if material:
-            color = material.diffuse_color
+        if not material:
+            return None
+        diffuse = tuple(material.diffuse_color)
+
+        # Check if this material has a texture assigned
+        texture = material.active_texture
+        imgName = nvb_def.null
+        tangentspace = None
+        if texture:
+            # Only image textures will be exported
+            if (texture.type == 'IMAGE') and (texture.image):
+                imgName = nvb_utils.getImageFilename(texture.image)
+                if nvb_glob.exportTxi and not texture.nvb.exported_in_save:
+                    nvb_txi.saveTxi(texture)
+                    # set this to prevent multiple export of TXI in mdl save
+                    texture.nvb.exported_in_save = True
+            else:
+                imgName = nvb_def.null
+            tangentspace = int(texture.nvb.bumpmapped)
+        alpha = nvb_utils.getAuroraAlpha(obj)
+        # Test for lightmap assigned as second texture
+        bitmap2 = None
+        if material.texture_slots[1]:
+            texture  = material.texture_slots[1].texture
+            bitmap2 = nvb_def.null
+            if obj.nvb.lightmapped and texture and (texture.type == 'IMAGE') and (texture.image):
+                bitmap2 = nvb_utils.getImageFilename(texture.image)
+        return (diffuse, tangentspace, imgName, alpha, bitmap2)
+
+    def addMaterialDataToAscii(self, obj, asciiLines):
+        materialData = self.getMaterialData(obj)
+        if materialData:
+            (color, tangentspace, imgName, alpha, bitmap2) = materialData
             asciiLines.append('  diffuse ' +    str(round(color[0], 2)) + ' ' +
                                                 str(round(color[1], 2)) + ' ' +
                                                 str(round(color[2], 2))  )
-
-            # Check if this material has a texture assigned
-            texture = material.active_texture
-            imgName = nvb_def.null
-            if texture:
-                # Only image textures will be exported
-                if (texture.type == 'IMAGE') and (texture.image):
-                    imgName = nvb_utils.getImageFilename(texture.image)
-                    if nvb_glob.exportTxi and not texture.nvb.exported_in_save:
-                        nvb_txi.saveTxi(texture)
-                        # set this to prevent multiple export of TXI in mdl save
-                        texture.nvb.exported_in_save = True
-                else:
-                    imgName = nvb_def.null
-                asciiLines.append('  tangentspace ' + str(int(texture.nvb.bumpmapped)))
+            if tangentspace is not None:
+                asciiLines.append('  tangentspace ' + str(tangentspace))
             asciiLines.append('  bitmap ' + imgName)
-            asciiLines.append('  alpha ' + str(round(nvb_utils.getAuroraAlpha(obj), 2)))
-            # Test for lightmap assigned as second texture
-            if material.texture_slots[1]:
-                texture  = material.texture_slots[1].texture
-                imgName = nvb_def.null
-                if obj.nvb.lightmapped and texture and (texture.type == 'IMAGE') and (texture.image):
-                    imgName = nvb_utils.getImageFilename(texture.image)
+            asciiLines.append('  alpha ' + str(round(alpha, 2)))
+            if bitmap2 is not None:
                 # Write bitmap2 NULL if texture is removed/non-image or lightmapped was clicked off.
                 # this is for when a model that imported with lightmapping is being exported without it,
                 # possibly w/o disabling everything properly
-                asciiLines.append('  bitmap2 ' + imgName)
+                asciiLines.append('  bitmap2 ' + bitmap2)
 
         else:
             # No material, set some default values
@@ -920,15 +1014,38 @@ class Trimesh(GeometryNode):
             asciiLines.append('  bitmap ' + nvb_def.null)
             asciiLines.append('  tangentspace 0')
 
-
-    def addUVToList(self, uv, uvList, vert, vertList):
-        """Helper function to keep UVs unique."""
-        if uv in uvList and vert in vertList:
-            return uvList.index(uv)
+    def loadMaterialData(self, obj):
+        materialData = self.getMaterialData(obj)
+        if materialData:
+            (self.diffuse, tangentspace, self.bitmap, self.alpha, bitmap2) = materialData
+            if tangentspace is not None:
+                self.tangentspace = tangentspace
+            if bitmap2 is not None:
+                self.bitmap2 = bitmap2
         else:
-            uvList.append(uv)
-            vertList.append(vert)
-            return (len(uvList)-1)
+            # No material, set some default values
+            self.diffuse      = (1.0, 1.0, 1.0)
+            self.alpha        = 1.0
+            self.bitmap       = nvb_def.null
+            self.tangentspace = 0
+
+
+    def addUVToList(self, uv, uvList, vert, uvVerts, uvIndices):
+        """Helper function to keep UVs unique.
+
+        uvVerts is the set of verts of all uvs in uvList, uvIndices maps
+        every uv to its first index in uvList. A uv is reused if it is in
+        the list and its vert is used by any uv, not necessarily this one.
+        """
+        key = (uv[0], uv[1])
+        uvIdx = uvIndices.get(key)
+        if uvIdx is not None and vert in uvVerts:
+            return uvIdx
+        uvIdx = len(uvList)
+        uvList.append(uv)
+        uvVerts.add(vert)
+        uvIndices.setdefault(key, uvIdx)
+        return uvIdx
 
 
     def getExportMesh(self, obj):
@@ -936,13 +1053,33 @@ class Trimesh(GeometryNode):
         Get the export mesh for an object,
         This mesh has modifiers applied as requested,
         using settings matching nvb_glob meshConvert.
-        This mesh should be removed by caller when done with it, like so:
-          bpy.data.meshes.remove(mesh)
-        TODO: retain the mesh across contexts instead of recreating every time.
+        During saveMdl meshes are kept in nvb_glob.exportMeshes, so every
+        object is only evaluated once, and must not be modified.
+        The caller should hand the mesh to freeExportMesh when done with it.
         '''
         if obj is None:
             return None
 
+        exportMeshes = nvb_glob.exportMeshes
+        if exportMeshes is not None and obj.name in exportMeshes:
+            return exportMeshes[obj.name]
+
+        with nvb_profile.span('evaluate mesh', object=obj.name):
+            mesh = self.evaluateMesh(obj)
+        if exportMeshes is not None:
+            exportMeshes[obj.name] = mesh
+        return mesh
+
+
+    def freeExportMesh(self, mesh):
+        '''
+        Remove a mesh from getExportMesh, unless saveMdl removes it later.
+        '''
+        if nvb_glob.exportMeshes is None:
+            bpy.data.meshes.remove(mesh)
+
+
+    def evaluateMesh(self, obj):
         mesh = obj.to_mesh(nvb_glob.scene, nvb_glob.applyModifiers, nvb_glob.meshConvert)
         for p in mesh.polygons:
             p.use_smooth = True
@@ -971,9 +1108,13 @@ class Trimesh(GeometryNode):
         return mesh
 
 
-    def addMeshDataToAscii(self, obj, asciiLines, simple = False):
-        mesh = self.getExportMesh(obj)
-
+    def getMeshData(self, obj, mesh):
+        '''
+        Return (verts, faces, uvs, lightmap uvs, number of smooth groups)
+        of an export mesh. Every face is a list of the vertex indices, the
+        smooth group, the uv indices, the material index and the lightmap
+        uv indices.
+        '''
         # Calculate smooth groups
         smoothGroups    = []
         numSmoothGroups = 0
@@ -991,25 +1132,21 @@ class Trimesh(GeometryNode):
 
         faceList = [] # List of triangle faces
         uvList   = [] # List of uv indices
-        uvVertList = [] # Temp list of uv verts used for each geometry vert
+        uvVerts  = set() # Geometry verts used by the uvs
+        uvIndices = dict() # First index of every uv in uvList
         # separate lists for the lightmap UVs if they exist
-        uvListLM     = [] # List of uv indices
-        uvVertListLM = [] # Temp list of uv verts used for each geometry vert
+        uvListLM    = [] # List of uv indices
+        uvVertsLM   = set() # Geometry verts used by the uvs
+        uvIndicesLM = dict() # First index of every uv in uvListLM
 
         abs_pos = (0.0, 0.0, 0.0)
         if self.roottype == 'wok' and obj.nvb.lytposition:
             abs_pos = (obj.nvb.lytposition[0] + obj.location[0],
                        obj.nvb.lytposition[1] + obj.location[1],
                        obj.nvb.lytposition[2] + obj.location[2])
-        # Add vertices
-        asciiLines.append('  verts ' + str(len(mesh.vertices)))
-        l_round = round
-        formatString = '    {: .7g} {: .7g} {: .7g}'
-        for v in mesh.vertices:
-            s = formatString.format(l_round(v.co[0] + abs_pos[0], 7),
-                                    l_round(v.co[1] + abs_pos[1], 7),
-                                    l_round(v.co[2] + abs_pos[2], 7))
-            asciiLines.append(s)
+        verts = [(v.co[0] + abs_pos[0],
+                  v.co[1] + abs_pos[1],
+                  v.co[2] + abs_pos[2]) for v in mesh.vertices]
 
         # Add faces and corresponding tverts and shading groups
         tessfaces     = mesh.tessfaces
@@ -1033,22 +1170,38 @@ class Trimesh(GeometryNode):
             uv3 = 0
             if tessfaces_uvs:
                 uvData = tessfaces_uvs.data[idx]
-                uv1 = self.addUVToList(uvData.uv1, uvList, tface.vertices[0], uvVertList)
-                uv2 = self.addUVToList(uvData.uv2, uvList, tface.vertices[1], uvVertList)
-                uv3 = self.addUVToList(uvData.uv3, uvList, tface.vertices[2], uvVertList)
+                uv1 = self.addUVToList(uvData.uv1, uvList, tface.vertices[0], uvVerts, uvIndices)
+                uv2 = self.addUVToList(uvData.uv2, uvList, tface.vertices[1], uvVerts, uvIndices)
+                uv3 = self.addUVToList(uvData.uv3, uvList, tface.vertices[2], uvVerts, uvIndices)
             # constructing lightmap (second texture) UV list
             uv1LM = 0
             uv2LM = 0
             uv3LM = 0
             if tessfaces_uvs_lm:
                 uvData = tessfaces_uvs_lm.data[idx]
-                uv1LM = self.addUVToList(uvData.uv1, uvListLM, tface.vertices[0], uvVertListLM)
-                uv2LM = self.addUVToList(uvData.uv2, uvListLM, tface.vertices[1], uvVertListLM)
-                uv3LM = self.addUVToList(uvData.uv3, uvListLM, tface.vertices[2], uvVertListLM)
+                uv1LM = self.addUVToList(uvData.uv1, uvListLM, tface.vertices[0], uvVertsLM, uvIndicesLM)
+                uv2LM = self.addUVToList(uvData.uv2, uvListLM, tface.vertices[1], uvVertsLM, uvIndicesLM)
+                uv3LM = self.addUVToList(uvData.uv3, uvListLM, tface.vertices[2], uvVertsLM, uvIndicesLM)
 
             faceList.append([tface.vertices[0], tface.vertices[1], tface.vertices[2], smGroup,
                              uv1, uv2, uv3, matIdx, uv1LM, uv2LM, uv3LM])
 
+        return (verts, faceList, uvList, uvListLM, numSmoothGroups)
+
+    def addMeshDataToAscii(self, obj, asciiLines, simple = False):
+        mesh = self.getExportMesh(obj)
+        (verts, faceList, uvList, uvListLM, numSmoothGroups) = self.getMeshData(obj, mesh)
+
+        # Add vertices
+        asciiLines.append('  verts ' + str(len(mesh.vertices)))
+        l_round = round
+        formatString = '    {: .7g} {: .7g} {: .7g}'
+        for v in verts:
+            s = formatString.format(l_round(v[0], 7),
+                                    l_round(v[1], 7),
+                                    l_round(v[2], 7))
+            asciiLines.append(s)
+
         # Check a texture, we don't want uv's when there is no texture
         material = obj.active_material
         texture  = None
@@ -1127,7 +1280,33 @@ class Trimesh(GeometryNode):
                 for link in self.roomlinks:
                     asciiLines.append('    {:d} {:d}'.format(link[0], link[1]))
 
-        bpy.data.meshes.remove(mesh)
+        self.freeExportMesh(mesh)
+
+    def loadMeshData(self, obj, simple = False):
+        mesh = self.getExportMesh(obj)
+        (verts, faceList, uvList, uvListLM, _) = self.getMeshData(obj, mesh)
+
+        self.verts = nvb_parse.packed(verts, 'd', 3)
+        # Like the ascii exporter, no uvs in simple mode
+        useUVs   = not simple and len(uvList) > 0
+        facelist = FaceList()
+        for f in faceList:
+            facelist.faces.append(f[0:3])
+            facelist.shdgr.append(f[3])
+            facelist.uvIdx.append(f[4:7] if useUVs else (0, 0, 0))
+            facelist.matId.append(f[7])
+        self.facelist = facelist
+        if useUVs:
+            self.tverts = nvb_parse.packed([(uv[0], uv[1]) for uv in uvList], 'f', 2)
+            if len(uvListLM) > 0:
+                self.tverts1 = nvb_parse.packed([(uv[0], uv[1]) for uv in uvListLM], 'f', 2)
+                self.texindices1 = nvb_parse.packed([f[8:11] for f in faceList], 'i', 3)
+
+        if self.roottype == 'wok' or self.nodetype == 'aabb':
+            if self.nodetype == 'aabb':
+                self.getRoomLinks(mesh)
+
+        self.freeExportMesh(mesh)
 
 
     def addDataToAscii(self, obj, asciiLines, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
@@ -1168,11 +1347,48 @@ class Trimesh(GeometryNode):
 
         self.addMeshDataToAscii(obj, asciiLines, simple)
 
+    def loadObjectData(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
+        GeometryNode.loadObjectData(self, obj, classification, simple, nameDict=nameDict)
+
+        self.ambient = tuple(obj.nvb.ambientcolor)
+        self.loadMaterialData(obj)
+        if not simple:
+            self.selfillumcolor     = tuple(obj.nvb.selfillumcolor)
+            self.render             = int(obj.nvb.render)
+            self.shadow             = int(obj.nvb.shadow)
+            self.lightmapped        = int(obj.nvb.lightmapped)
+            self.beaming            = int(obj.nvb.beaming)
+            self.inheritcolor       = int(obj.nvb.inheritcolor)
+            self.m_bIsBackgroundGeometry = int(obj.nvb.m_bIsBackgroundGeometry)
+            self.dirt_enabled       = int(obj.nvb.dirt_enabled)
+            self.dirt_texture       = int(obj.nvb.dirt_texture)
+            self.dirt_worldspace    = int(obj.nvb.dirt_worldspace)
+            self.hologram_donotdraw = int(obj.nvb.hologram_donotdraw)
+            self.animateuv          = int(obj.nvb.animateuv)
+            self.uvdirectionx       = obj.nvb.uvdirectionx
+            self.uvdirectiony       = obj.nvb.uvdirectiony
+            self.uvjitter           = obj.nvb.uvjitter
+            self.uvjitterspeed      = obj.nvb.uvjitterspeed
+            self.transparencyhint   = int(obj.nvb.transparencyhint)
+            # These two are for tiles only
+            if classification == 'TILE':
+                self.rotatetexture = int(obj.nvb.rotatetexture)
+
+        self.loadMeshData(obj, simple)
+
 
 class Danglymesh(Trimesh):
     """
 
     """
+    __slots__ = ('period', 'tightness', 'displacement', 'constraints')
+
+    schema = {
+        'period':       ('period',       1, float, None),
+        'tightness':    ('tightness',    1, float, None),
+        'displacement': ('displacement', 1, float, None),
+        'constraints':  ('constraints',  1, float, 'counted'),
+    }
     def __init__(self, name = 'UNNAMED'):
         Trimesh.__init__(self, name)
         self.nodetype = 'danglymesh'
@@ -1184,37 +1400,6 @@ class Danglymesh(Trimesh):
         self.constraints  = []
 
 
-    def loadAscii(self, asciiNode):
-        Trimesh.loadAscii(self, asciiNode)
-
-        l_int   = int
-        l_float = float
-        l_isNumber = nvb_utils.isNumber
-        for idx, line in enumerate(asciiNode):
-            try:
-                label = line[0].lower()
-            except IndexError:
-                # Probably empty line or whatever, skip it
-                continue
-
-            if not l_isNumber(label):
-                if   (label == 'period'):
-                    self.period = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'tightness'):
-                    self.tightness = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'displacement'):
-                    self.displacement = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'constraints'):
-                    numVals = l_int(line[1])
-                    nvb_parse.f1(asciiNode[idx+1:idx+numVals+1], self.constraints)
-                    #self.constraints = [float(l[0]) for l in asciiNode[idx+1:idx+numVals+1]]
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-        if (self.nodetype == 'danglymesh'):
-            self.addUnparsedToRaw(asciiNode)
-
     def addConstraintsToObject(self, obj):
         '''
         Creates a vertex group for the object to contain the vertex
@@ -1237,15 +1422,17 @@ class Danglymesh(Trimesh):
         self.addConstraintsToObject(obj)
 
 
-    def addConstraintsToAscii(self, obj, asciiLines):
+    def getConstraints(self, obj):
+        '''
+        Return the constraint of every vertex of the export mesh, in the
+        range [0.0, 255.0].
+        '''
         vgroupName = obj.nvb.constraints
         vgroup     = obj.vertex_groups[vgroupName]
 
         mesh = self.getExportMesh(obj)
 
-        asciiLines.append(
-            '  constraints {}'.format(len(mesh.vertices))
-        )
+        constraints = []
         for v in mesh.vertices:
             # In case vertex is not weighted with dangly constraint
             weight = 0.0
@@ -1253,9 +1440,18 @@ class Danglymesh(Trimesh):
                 if vg.group != vgroup.index:
                     continue
                 weight = round(vg.weight * 255, 3)
-            asciiLines.append('    {}'.format(weight))
+            constraints.append(weight)
 
-        bpy.data.meshes.remove(mesh)
+        self.freeExportMesh(mesh)
+        return constraints
+
+    def addConstraintsToAscii(self, obj, asciiLines):
+        constraints = self.getConstraints(obj)
+        asciiLines.append(
+            '  constraints {}'.format(len(constraints))
+        )
+        for weight in constraints:
+            asciiLines.append('    {}'.format(weight))
 
 
     def addDataToAscii(self, obj, asciiLines, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
@@ -1266,11 +1462,22 @@ class Danglymesh(Trimesh):
         asciiLines.append('  displacement ' + str(round(obj.nvb.displacement, 3)))
         self.addConstraintsToAscii(obj, asciiLines)
 
+    def loadObjectData(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
+        Trimesh.loadObjectData(self, obj, classification, nameDict=nameDict)
+
+        self.period       = obj.nvb.period
+        self.tightness    = obj.nvb.tightness
+        self.displacement = obj.nvb.displacement
+        self.constraints  = array.array('f', self.getConstraints(obj))
+
 
 class Lightsaber(Trimesh):
     """
 
     """
+    __slots__ = ()
+
+    keepRaw = False
     def __init__(self, name = 'UNNAMED'):
         Trimesh.__init__(self, name)
         self.nodetype = 'lightsaber'
@@ -1286,6 +1493,11 @@ class Lightsaber(Trimesh):
 
 class Skinmesh(Trimesh):
     """Skinmeshes are Trimeshes where every vertex has a weight."""
+    __slots__ = ('weights',)
+
+    schema = {
+        'weights': (None, 2, 'getWeightsFromAscii', 'counted'),
+    }
 
     def __init__(self, name = 'UNNAMED'):
         Trimesh.__init__(self, name)
@@ -1294,27 +1506,6 @@ class Skinmesh(Trimesh):
         self.meshtype = nvb_def.Meshtype.SKIN
         self.weights = []
 
-    def loadAscii(self, asciiNode):
-        Trimesh.loadAscii(self, asciiNode)
-        l_int      = int
-        l_isNumber = nvb_utils.isNumber
-        for idx, line in enumerate(asciiNode):
-            try:
-                label = line[0].lower()
-            except IndexError:
-                # Probably empty line or whatever, skip it
-                continue
-
-            if not l_isNumber(label):
-                if (label == 'weights'):
-                    numVals = l_int(line[1])
-                    self.getWeightsFromAscii(asciiNode[idx+1:idx+numVals+1])
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-                    break  # Only one value here, abort loop when read
-        if (self.nodetype == 'skin'):
-            self.addUnparsedToRaw(asciiNode)
-
-
     def getWeightsFromAscii(self, asciiBlock):
         lfloat = float
         lchunker = nvb_utils.chunker
@@ -1346,7 +1537,11 @@ class Skinmesh(Trimesh):
 
         self.addSkinGroupsToObject(obj)
 
-    def addWeightsToAscii(self, obj, asciiLines):
+    def getWeights(self, obj):
+        '''
+        Return the bone weights of every vertex of the export mesh as
+        lists of [bone name, weight], at most 4 per vertex.
+        '''
         # Get a list of skingroups for this object:
         # A vertex group is a skingroup if there is an object in the mdl
         # with the same name as the group
@@ -1380,31 +1575,61 @@ class Skinmesh(Trimesh):
                 # normalize weights to equal 1.0
                 for w in weights:
                     w[1] /= total_weight
+            if not weights:
+                # No weights for this vertex ... this is a problem
+                print('Kotorblender - WARNING: Missing vertex weight in ' + obj.name)
             vertexWeights.append(weights)
 
-        numVerts = len(mesh.vertices)
-        asciiLines.append('  weights ' + str(numVerts))
+        self.freeExportMesh(mesh)
+        return vertexWeights
+
+    def addWeightsToAscii(self, obj, asciiLines):
+        vertexWeights = self.getWeights(obj)
+        asciiLines.append('  weights ' + str(len(vertexWeights)))
         for weights in vertexWeights:
             line = '  '
             if weights:
                 for w in weights:
                     line += '  ' + w[0] + ' ' + str(round(w[1], 6))
             else:
-                # No weights for this vertex ... this is a problem
-                print('Kotorblender - WARNING: Missing vertex weight in ' + obj.name)
                 line = 'ERROR: no weight'
             asciiLines.append(line)
 
-        bpy.data.meshes.remove(mesh)
-
 
     def addDataToAscii(self, obj, asciiLines, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
         Trimesh.addDataToAscii(self, obj, asciiLines, classification, nameDict=nameDict)
 
         self.addWeightsToAscii(obj, asciiLines)
 
+    def loadObjectData(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
+        Trimesh.loadObjectData(self, obj, classification, nameDict=nameDict)
+
+        self.weights = self.getWeights(obj)
+
 
 class Emitter(GeometryNode):
+    __slots__ = ('meshtype', 'deadspace', 'blastradius', 'blastlength',
+                 'numBranches', 'controlptsmoothing', 'xgrid', 'ygrid',
+                 'spawntype', 'update', 'render', 'blend', 'texture',
+                 'chunkName', 'twosidedtex', 'loop', 'renderorder',
+                 'm_bFrameBlending', 'm_sDepthTextureName', 'p2p', 'p2p_sel',
+                 'affectedByWind', 'm_isTinted', 'bounce', 'random', 'inherit',
+                 'inheritvel', 'inherit_local', 'splat', 'inherit_part',
+                 'depth_texture', 'alphastart', 'alphamid', 'alphaend',
+                 'birthrate', 'm_frandombirthrate', 'bounce_co', 'combinetime',
+                 'drag', 'fps', 'frameend', 'framestart', 'grav', 'lifeexp',
+                 'mass', 'p2p_bezier2', 'p2p_bezier3', 'particlerot',
+                 'randvel', 'sizestart', 'sizemid', 'sizeend', 'sizestart_y',
+                 'sizemid_y', 'sizeend_y', 'spread', 'threshold', 'velocity',
+                 'xsize', 'ysize', 'blurlength', 'lightningdelay',
+                 'lightningradius', 'lightningsubdiv', 'lightningscale',
+                 'lightningzigzag', 'percentstart', 'percentmid', 'percentend',
+                 'targetsize', 'numcontrolpts', 'controlptradius',
+                 'controlptdelay', 'tangentspread', 'tangentlength',
+                 'colorstart', 'colormid', 'colorend')
+
+    keepRaw   = True
+    rawIndent = '  '
     emitter_attrs = [
         "deadspace",
         "blastradius",
@@ -1573,58 +1798,27 @@ class Emitter(GeometryNode):
         self.rawascii = ''
 
 
-    def loadAscii(self, asciiNode):
-        l_float = float
-        l_isNumber = nvb_utils.isNumber
-
-        for line in asciiNode:
-            try:
-                label = line[0].lower()
-            except IndexError:
-                # Probably empty line or whatever, skip it
+    @classmethod
+    def extendSchema(cls, schema):
+        # this covers all object data and controllers, converters are
+        # chosen by the type of the default values
+        defaults = Emitter()
+        for attrname in cls.emitter_attrs:
+            default_value = getattr(defaults, attrname)
+            if isinstance(default_value, str):
+                prop = (attrname, 1, str, None)
+            elif isinstance(default_value, bool):
+                prop = (attrname, 1, nvb_parse.boolean, None)
+            elif isinstance(default_value, int):
+                # written as floats by some tools, e.g. 'birthrate 10.0'
+                prop = (attrname, 1, nvb_parse.integer, None)
+            elif isinstance(default_value, float):
+                prop = (attrname, 1, float, None)
+            elif isinstance(default_value, tuple):
+                prop = (attrname, None, float, None)
+            else:
                 continue
-
-            if not l_isNumber(label):
-                if (label == 'node'):
-                    self.name = nvb_utils.getName(line[2])
-                elif (label == 'endnode'):
-                    return
-                elif (label == 'parent'):
-                    self.parentName = nvb_utils.getName(line[1])
-                elif (label == 'position'):
-                    self.position = (l_float(line[1]),
-                                     l_float(line[2]),
-                                     l_float(line[3]))
-                elif (label == 'orientation'):
-                    self.orientation = (l_float(line[1]),
-                                        l_float(line[2]),
-                                        l_float(line[3]),
-                                        l_float(line[4]))
-                elif (label == 'scale'):
-                    self.scale = l_float(line[1])
-                elif (label == 'wirecolor'):
-                    self.wirecolor = (l_float(line[1]),
-                                      l_float(line[2]),
-                                      l_float(line[3]))
-                elif (label in list(map(lambda x: x.lower(), dir(self)))):
-                    # this block covers all object data and controllers
-                    attrname = [name for name in dir(self) if name.lower() == label][0]
-                    default_value = getattr(self, attrname)
-                    try:
-                        if isinstance(default_value, str):
-                            setattr(self, attrname, line[1])
-                        elif isinstance(default_value, bool):
-                            setattr(self, attrname, bool(int(line[1])))
-                        elif isinstance(default_value, int):
-                            setattr(self, attrname, int(line[1]))
-                        elif isinstance(default_value, float):
-                            setattr(self, attrname, float(line[1]))
-                        elif isinstance(default_value, tuple):
-                            setattr(self, attrname, tuple(map(float, line[1:])))
-                    except:
-                        continue
-                else:
-                    self.rawascii += '\n  ' + ' '.join(line)
+            schema[attrname.lower()] = prop
 
     def createMesh(self, objName):
         # Create the mesh itself
@@ -1762,8 +1956,62 @@ class Emitter(GeometryNode):
                 if label[0] != '#':
                     asciiLines.append('  ' + ' '.join(line))
 
+    def loadObjectData(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
+        GeometryNode.loadObjectData(self, obj, classification, simple, nameDict=nameDict)
+
+        # Values are converted just like parsed ones, by the schema
+        schema = type(self).getSchema()
+        for attrname in self.emitter_attrs:
+            if attrname == 'render':
+                value = obj.nvb.render_emitter
+            else:
+                value = getattr(obj.nvb, attrname)
+            if attrname == 'spawntype':
+                if value == 'Normal':
+                    value = 0
+                elif value == 'Trail':
+                    value = 1
+            if isinstance(value, str) and (not value or value == 'NONE'):
+                continue
+            _, numVals, convert, _ = schema[attrname.lower()]
+            try:
+                if numVals is None:
+                    value = tuple(map(convert, value))
+                else:
+                    value = convert(value)
+            except (ValueError, TypeError):
+                # Malformed values are dropped, keep the default
+                continue
+            setattr(self, attrname, value)
+
 
 class Light(GeometryNode):
+    __slots__ = ('shadow', 'radius', 'multiplier', 'lightpriority', 'color',
+                 'ambientonly', 'ndynamictype', 'isdynamic', 'affectdynamic',
+                 'negativelight', 'fadinglight', 'lensflares', 'flareradius',
+                 'flareList')
+
+    schema = {
+        'radius':           ('radius',        1, float, None),
+        'shadow':           ('shadow',        1, int, None),
+        'multiplier':       ('multiplier',    1, float, None),
+        'color':            ('color',         3, float, None),
+        'ambientonly':      ('ambientonly',   1, int, None),
+        'ndynamictype':     ('ndynamictype',  1, int, None),
+        'isdynamic':        ('isdynamic',     1, int, None),
+        'affectdynamic':    ('affectdynamic', 1, int, None),
+        'negativelight':    ('negativelight', 1, int, None),
+        'lightpriority':    ('lightpriority', 1, int, None),
+        'fadinglight':      ('fadinglight',   1, int, None),
+        'lensflares':       ('lensflares',    1, int, None),
+        'flareradius':      ('flareradius',   1, float, None),
+        'texturenames':     (None, 0, 'parseFlareTextureNames', 'method'),
+        'flaresizes':       ('flareList.sizes',       1, float, 'uncounted'),
+        'flarepositions':   ('flareList.positions',   1, float, 'uncounted'),
+        'flarecolorshifts': ('flareList.colorshifts', 3, float, 'uncounted'),
+    }
+    keepRaw = True
+
     def __init__(self, name = 'UNNAMED'):
         GeometryNode.__init__(self, name)
         self.nodetype = 'light'
@@ -1783,101 +2031,26 @@ class Light(GeometryNode):
         self.flareradius   = 1.0
         self.flareList     = FlareList()
 
-    def loadAscii(self, asciiNode):
-        GeometryNode.loadAscii(self, asciiNode)
-
-        flareTextureNamesStart = 0
-        numFlares              = 0
-        numVals                = 0
-
-        l_int = int
-        l_float = float
-        l_isNumber = nvb_utils.isNumber
-        for idx, line in enumerate(asciiNode):
-            try:
-                label = line[0].lower()
-            except IndexError:
-                # Probably empty line or whatever, skip it
-                continue
+    def parseFlareTextureNames(self, asciiNode, idx):
+        # List of names follows, but we don't necessarily know how
+        # many flares there are. Read up to the next label.
+        schema = type(self).getSchema()
+        numLines = 1
+        for line in asciiNode[idx+1:]:
+            label = line[0].lower() if line else ''
+            if not label or label in schema or label == 'endnode' or \
+               nvb_parse.countNumeric([line]):
+                break
+            self.flareList.textures.append(line[0])
+            numLines += 1
+        return numLines
 
-            if not l_isNumber(label):
-                if (label == 'radius'):
-                    self.radius = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'shadow'):
-                    self.shadow = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'multiplier'):
-                    self.multiplier = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'color'):
-                    self.color = (l_float(line[1]),
-                                  l_float(line[2]),
-                                  l_float(line[3]))
-                    self.parsed_lines.append(idx)
-                elif (label == 'ambientonly'):
-                    self.ambientonly = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'ndynamictype'):
-                    self.ndynamictype = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'isdynamic'):
-                    self.isdynamic = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'affectdynamic'):
-                    self.affectdynamic = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'negativelight'):
-                    self.negativelight = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'lightpriority'):
-                    self.lightpriority = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'fadinglight'):
-                    self.fadinglight = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'lensflares'):
-                    self.lensflares = l_int(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'flareradius'):
-                    self.flareradius = l_float(line[1])
-                    self.parsed_lines.append(idx)
-                elif (label == 'texturenames'):
-                    # List of names follows, but we don't necessarily know how
-                    # many flares there are
-                    # We 'll need to read them later. For now save the index
-                    flareTextureNamesStart = idx+1
-                    self.parsed_lines.append(idx)
-                elif (label == 'flaresizes'):
-                    # List of floats
-                    numVals = next((i for i, v in enumerate(asciiNode[idx+1:]) if not l_isNumber(v[0])), -1)
-                    nvb_parse.f1(asciiNode[idx+1:idx+numVals+1], self.flareList.sizes)
-                    #self.flareList.sizes = [float(l[0]) for l in asciiNode[idx+1:idx+numVals+1]]
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-                elif (label == 'flarepositions'):
-                    # List of floats
-                    numVals = next((i for i, v in enumerate(asciiNode[idx+1:]) if not l_isNumber(v[0])), -1)
-                    nvb_parse.f1(asciiNode[idx+1:idx+numVals+1], self.flareList.positions)
-                    #self.flareList.positions = [float(l[0]) for l in asciiNode[idx+1:idx+numVals+1]]
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-                elif (label == 'flarecolorshifts'):
-                    # List of float 3-tuples
-                    numVals = next((i for i, v in enumerate(asciiNode[idx+1:]) if not l_isNumber(v[0])), -1)
-                    nvb_parse.f3(asciiNode[idx+1:idx+numVals+1], self.flareList.colorshifts)
-                    #self.flareList.colorshifts = [(float(l[0]), float(l[1]), float(l[2])) for l in asciiNode[idx+1:idx+numVals+1]]
-                    self.parsed_lines.extend(range(idx,idx+numVals+1))
-
-        # Load flare texture names:
+    def finishAscii(self, asciiNode):
+        # Only keep names for complete flares
         numFlares = min(len(self.flareList.sizes),
                         min(len(self.flareList.colorshifts),
                             len(self.flareList.positions)))
-        for i in range(numFlares):
-            texName = asciiNode[flareTextureNamesStart+i][0]
-            self.flareList.textures.append(texName)
-            self.parsed_lines.append(flareTextureNamesStart+i)
-
-        if (self.nodetype == 'light'):
-            self.addUnparsedToRaw(asciiNode)
+        del self.flareList.textures[numFlares:]
 
     def createLamp(self, name):
         lamp = bpy.data.lamps.new(name, 'POINT')
@@ -1983,17 +2156,63 @@ class Light(GeometryNode):
         asciiLines.append('  fadingLight ' + str(int(obj.nvb.fadinglight)))
         self.addFlaresToAscii(obj, asciiLines)
 
+    def loadObjectData(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
+        GeometryNode.loadObjectData(self, obj, classification, nameDict=nameDict)
+
+        lamp = obj.data
+        color = (lamp.color[0], lamp.color[1], lamp.color[2])
+        if lamp.use_negative:
+            color = (0.0 - lamp.color[0],
+                     0.0 - lamp.color[1],
+                     0.0 - lamp.color[2])
+        self.radius        = lamp.distance
+        self.multiplier    = lamp.energy
+        self.color         = color
+        self.ambientonly   = int(obj.nvb.ambientonly)
+        self.ndynamictype  = obj.nvb.isdynamic
+        self.affectdynamic = int(obj.nvb.affectdynamic)
+        self.shadow        = int(obj.nvb.shadow)
+        self.lightpriority = obj.nvb.lightpriority
+        self.fadinglight   = int(obj.nvb.fadinglight)
+        if obj.nvb.lensflares:
+            self.lensflares = int(obj.nvb.lensflares)
+            for flare in obj.nvb.flareList:
+                self.flareList.textures.append(flare.texture)
+                self.flareList.positions.append(flare.position)
+                self.flareList.sizes.append(flare.size)
+                self.flareList.colorshifts.append(tuple(flare.colorshift))
+        self.flareradius = obj.nvb.flareradius
+
 
 class Aabb(Trimesh):
     '''
     No need to import Aaabb's. Aabb nodes in mdl files will be
     treated as trimeshes
     '''
+    __slots__ = ('aabbTree',)
+
+    schema = {
+        'aabb': (None, 0, 'parseAabbTree', 'method'),
+    }
+    keepRaw = False
     def __init__(self, name = 'UNNAMED'):
         Trimesh.__init__(self, name)
         self.nodetype = 'aabb'
 
         self.meshtype = nvb_def.Meshtype.AABB
+        # Tree nodes in pre-order, (bbmin x, y, z, bbmax x, y, z, face index)
+        self.aabbTree = []
+
+    def parseAabbTree(self, asciiNode, idx):
+        # The first tree node follows the label, the others are on the
+        # following lines
+        tree = [asciiNode[idx][1:8]]
+        numNodes = nvb_parse.countNumeric(asciiNode[idx+1:])
+        tree.extend(asciiNode[idx+1:idx+numNodes+1])
+        l_float = float
+        self.aabbTree = [tuple(map(l_float, node[:6])) + (int(node[6]),)
+                         for node in tree]
+        return numNodes + 1
 
     def computeLayoutPosition(self, wkm):
         wkmv1 = wkm.verts[wkm.facelist.faces[0][0]]
@@ -2012,8 +2231,13 @@ class Aabb(Trimesh):
         bpy.data.objects[self.objref].nvb.lytposition = self.lytposition
         #pprint(bpy.data.objects[self.name])
 
-    def addAABBToAscii(self, obj, asciiLines):
-        walkmesh = obj.to_mesh(nvb_glob.scene, nvb_glob.applyModifiers, nvb_glob.meshConvert)
+    def getAabbTree(self, obj):
+        '''
+        Generate the aabb tree of the export mesh, in pre-order. Returns
+        None if the mesh can't be split into triangles.
+        '''
+        # Same triangles as the face list
+        walkmesh = self.getExportMesh(obj)
 
         faceList = []
         faceIdx  = 0
@@ -2045,10 +2269,16 @@ class Aabb(Trimesh):
             else:
                 # Ngon or no polygon at all (This should never be the case with tessfaces)
                 print('Kotorblender - WARNING: Ngon in walkmesh. Unable to generate aabb.')
-                return
+                self.freeExportMesh(walkmesh)
+                return None
 
         aabbTree = []
         nvb_aabb.generateTree(aabbTree, faceList)
+        self.freeExportMesh(walkmesh)
+        return aabbTree
+
+    def addAABBToAscii(self, obj, asciiLines):
+        aabbTree = self.getAabbTree(obj)
 
         l_round = round
         if aabbTree:
@@ -2112,14 +2342,23 @@ class Aabb(Trimesh):
         if self.roottype != 'wok':
             self.addAABBToAscii(obj, asciiLines)
 
+    def loadObjectData(self, obj, classification = nvb_def.Classification.UNKNOWN, simple = False, nameDict=None):
+        self.parentName  = self.getExportName(obj.parent, nameDict)
+        self.position    = tuple(obj.location)
+        self.orientation = tuple(nvb_utils.getAuroraRotFromObject(obj))
+        self.wirecolor   = tuple(obj.nvb.wirecolor)
+        self.ambient     = (1.0, 1.0, 1.0)
+        self.diffuse     = (1.0, 1.0, 1.0)
+        self.bitmap      = nvb_def.null
+        Trimesh.loadMeshData(self, obj, simple)
+        if self.roottype != 'wok':
+            self.aabbTree = self.getAabbTree(obj) or []
+
 
     def createMesh(self, name):
         # Create the mesh itself
         mesh = bpy.data.meshes.new(name)
-        mesh.vertices.add(len(self.verts))
-        mesh.vertices.foreach_set('co', unpack_list(self.verts))
-        mesh.tessfaces.add(len(self.facelist.faces))
-        mesh.tessfaces.foreach_set('vertices_raw', unpack_face_list(self.facelist.faces))
+        self.addGeometry(mesh)
 
         # Create materials
         for wokMat in nvb_def.wok_materials:
@@ -2137,25 +2376,13 @@ class Aabb(Trimesh):
             mesh.materials.append(material)
 
         # Create UV map
-        uv = None
-        if (len(self.tverts) > 0) and (mesh.tessfaces):
-            uv = mesh.tessface_uv_textures.new(name + '.uv')
-            mesh.tessface_uv_textures.active = uv
+        if (len(self.tverts) > 0) and (mesh.polygons):
+            uv = self.addUVLayer(mesh, name + '.uv', self.tverts,
+                                 self.facelist.uvIdx)
+            mesh.uv_textures.active = uv
 
         # Apply the walkmesh materials to each face
-        for idx, face in enumerate(mesh.tessfaces):
-            face.material_index = self.facelist.matId[idx]
-            if uv:
-                faceUV = mesh.tessface_uv_textures[0].data[idx]
-                uvIdx = self.facelist.uvIdx[idx]
-                if self.facelist.faces[idx][2] == 0:
-                    uvIdx = uvIdx[1], uvIdx[2], uvIdx[0]
-                faceUV.uv1 = self.tverts[uvIdx[0]]
-                faceUV.uv2 = self.tverts[uvIdx[1]]
-                faceUV.uv3 = self.tverts[uvIdx[2]]
-                # Apply texture to uv face
-                #if (not nvb_utils.isNull(self.bitmap)) and material.texture_slots[0]:
-                #    faceUV.image = material.texture_slots[0].texture.image
+        mesh.polygons.foreach_set('material_index', self.facelist.matId)
 
         mesh.update()
         return mesh
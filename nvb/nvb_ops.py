@@ -6,6 +6,7 @@ from . import nvb_def
 from . import nvb_utils
 from . import nvb_io
 from . import nvb_txi
+from . import nvb_props
 
 from mathutils import Matrix, Vector, Quaternion
 
@@ -495,6 +496,23 @@ class NVB_OP_Import(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
             default=False,
             )
 
+    parseWorkers = bpy.props.IntProperty(
+            name = 'Parse Workers',
+            description = 'Tokenize nodes and animations in this many ' \
+                          'processes, 0 to parse in Blender only. Starting ' \
+                          'them takes a moment, so this only pays off ' \
+                          'for large models',
+            default = 0, min = 0, max = 64,
+            )
+
+    profile = bpy.props.BoolProperty(
+            name = 'Profile',
+            description = 'Report the time spent in each import phase. ' \
+                          'Set KOTORBLENDER_PROFILE to a .json path to ' \
+                          'also write a Chrome trace',
+            default = False,
+            )
+
     # Hidden option, only used for batch minimap creation
     minimapMode = bpy.props.BoolProperty(
             name = 'Minimap Mode',
@@ -514,9 +532,37 @@ class NVB_OP_Import(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         keywords = self.as_keywords(ignore=('filter_glob',
                                             'check_existing',
                                             ))
+        keywords['parseCache'] = nvb_props.getParseCache(context)
         return nvb_io.loadMdl(self, context, **keywords)
 
 
+class NVB_OP_ClearParseCache(bpy.types.Operator):
+    '''Remove all entries from the parse cache'''
+
+    bl_idname = 'kb.parse_cache_clear'
+    bl_label  = 'Clear Cache'
+
+    def execute(self, context):
+        parseCache = nvb_props.getParseCache(context, True)
+        if parseCache is not None:
+            parseCache.clear()
+            nvb_props.cacheUsage[parseCache.directory] = (0, 0)
+        return {'FINISHED'}
+
+
+class NVB_OP_ParseCacheUsage(bpy.types.Operator):
+    '''Count the entries in the parse cache and their size'''
+
+    bl_idname = 'kb.parse_cache_usage'
+    bl_label  = 'Refresh Cache Usage'
+
+    def execute(self, context):
+        parseCache = nvb_props.getParseCache(context, True)
+        if parseCache is not None:
+            nvb_props.cacheUsage[parseCache.directory] = parseCache.usage()
+        return {'FINISHED'}
+
+
 class NVB_OP_Export(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
     '''Export Odyssey Engine model (.mdl)'''
 
@@ -558,6 +604,23 @@ class NVB_OP_Export(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
             default=True,
             )
 
+    exportFormat = bpy.props.EnumProperty(
+            name = 'Format',
+            items = (('ASCII', 'ASCII', 'Export an ascii model, needs to be compiled'),
+                     ('BINARY_K1', 'Binary (KotOR)', 'Export a compiled model and mdx for KotOR'),
+                     ('BINARY_TSL', 'Binary (TSL)', 'Export a compiled model and mdx for TSL'),
+                     ),
+            default = 'ASCII',
+            )
+
+    profile = bpy.props.BoolProperty(
+            name = 'Profile',
+            description = 'Report the time spent in each export phase. ' \
+                          'Set KOTORBLENDER_PROFILE to a .json path to ' \
+                          'also write a Chrome trace',
+            default = False,
+            )
+
     def execute(self, context):
         keywords = self.as_keywords(ignore=('filter_glob',
                                             'check_existing',
@@ -0,0 +1,38 @@
+"""Tokenize the blocks of an ascii mdl in worker processes.
+
+Workers only use nvb_index and nvb_parse, they don't need Blender. They
+return the blocks as plain segments (see nvb_parse.prepare), with the
+numeric lines already converted to arrays, nodes and animations are
+created from them in the calling process.
+"""
+import multiprocessing
+
+from . import nvb_index
+from . import nvb_parse
+
+
+def prepareBlocks(filepath, ranges):
+    '''
+    Tokenize the blocks at the byte ranges of the file, run in a worker.
+    '''
+    with nvb_index.MdlIndex(filepath, scan = False) as mdlIndex:
+        return [nvb_parse.prepare(mdlIndex.lines(start, end))
+                for start, end in ranges]
+
+
+def prepare(filepath, batches, workers, executable = None):
+    '''
+    Tokenize batches (lists of byte ranges) of the file in a pool of
+    workers, return the segments of every block of every batch.
+
+    Workers are spawned, forking a process with Blender's state isn't
+    safe. executable is the python interpreter used for them, if
+    sys.executable isn't one. Raises OSError or
+    multiprocessing.ProcessError if the workers can't be run.
+    '''
+    context = multiprocessing.get_context('spawn')
+    if executable:
+        context.set_executable(executable)
+    with context.Pool(workers) as pool:
+        return pool.starmap(prepareBlocks,
+                            [(filepath, ranges) for ranges in batches])
@@ -1,4 +1,503 @@
 """TODO: DOC."""
+import array
+import bisect
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def tokenize(lines):
+    """Tokenize ascii mdl lines, stripping comments.
+
+    lines may be any iterable of text lines. An open file object works best,
+    it is read incrementally in buffered chunks and never held in memory as
+    a whole. Yields (line_no, tokens) tuples for every line that has tokens
+    left after the comment has been removed.
+    """
+    for line_no, line in enumerate(lines):
+        comment = line.find('#')
+        if comment >= 0:
+            line = line[:comment]
+        tokens = line.split()
+        if tokens:
+            yield line_no, tokens
+
+
+def blocks(tokens):
+    """Group a token stream into the sections of an ascii mdl.
+
+    Yields (event, lines) tuples where event is one of
+      'header': everything before the first node or animation
+      'node':   a single 'node' ... 'endnode' block
+      'anim':   a single 'newanim' ... 'doneanim' block
+    lines is a list of token lists. Only the current block is kept in memory.
+    """
+    header = []
+    block  = None
+    event  = None
+    for line_no, line in tokens:
+        label = line[0].lower()
+        if event == 'anim':
+            block.append(line)
+            if label == 'doneanim':
+                yield event, block
+                event, block = None, None
+            continue
+        if event == 'node':
+            if label == 'node':
+                # Missing 'endnode', the next node terminates this one
+                yield event, block
+                block = [line]
+                continue
+            block.append(line)
+            if label == 'endnode':
+                yield event, block
+                event, block = None, None
+            continue
+        if label == 'node' or label == 'newanim':
+            if header is not None:
+                yield 'header', header
+                header = None
+            event = 'node' if label == 'node' else 'anim'
+            block = [line]
+        elif header is not None:
+            header.append(line)
+    if header is not None:
+        yield 'header', header
+    if block:
+        yield event, block
+
+
+def _convert(tokens, dtype):
+    """Convert a list of number tokens to an array, None on failure."""
+    try:
+        return numpy.array(tokens, dtype=dtype)
+    except (ValueError, OverflowError):
+        return None
+
+def _array(asciiBlock, numVals, dtype):
+    """Parse a counted block of numeric lines into a (len, numVals) array.
+
+    All values are converted by numpy in a single pass. Returns None if
+    numpy is not available or the block doesn't parse cleanly, e.g. if a line
+    is too short or holds a non-numeric value. The caller should fall back to
+    the tuple parsers in that case.
+    """
+    if numpy is None or not asciiBlock:
+        return None
+    values = preparsed(asciiBlock, numVals)
+    if values is not None:
+        return values[:, 0] if numVals == 1 else values
+    numLines = len(asciiBlock)
+    tokens = list(itertools.chain.from_iterable(asciiBlock))
+    if len(tokens) != numLines * numVals:
+        # Extra values on some lines, only use the leading ones
+        if any(len(line) < numVals for line in asciiBlock):
+            return None
+        tokens = list(itertools.chain.from_iterable(line[:numVals] for line in asciiBlock))
+    values = _convert(tokens, dtype)
+    if values is None and dtype != numpy.float64:
+        # Integers written as floats, e.g. '1.0'
+        values = _convert(tokens, numpy.float64)
+    if values is None:
+        return None
+    if numVals == 1:
+        return values
+    return values.reshape(numLines, numVals)
+
+def farray(asciiBlock, numVals):
+    """Parse a block into a contiguous float64 array, None on failure.
+
+    Values keep double precision, e.g. for vertex positions, they are
+    converted to float32 when passed to Blender, see flatList().
+    """
+    return _array(asciiBlock, numVals, numpy and numpy.float64)
+
+def iarray(asciiBlock, numVals):
+    """Parse a block into a contiguous int32 array, None on failure."""
+    values = _array(asciiBlock, numVals, numpy and numpy.int64)
+    if values is None:
+        return None
+    return values.astype(numpy.int32)
+
+def facearrays(asciiFaces):
+    """Parse a face block into contiguous column arrays, None on failure.
+
+    Returns a tuple (faces, shdgr, uvIdx, matId) of int32 arrays.
+    """
+    faces = iarray(asciiFaces, 8)
+    if faces is None:
+        return None
+    return (numpy.ascontiguousarray(faces[:, 0:3]),
+            numpy.ascontiguousarray(faces[:, 3]),
+            numpy.ascontiguousarray(faces[:, 4:7]),
+            numpy.ascontiguousarray(faces[:, 7]))
+
+def isarray(values):
+    """Check if values were parsed into a numpy array."""
+    return numpy is not None and isinstance(values, numpy.ndarray)
+
+class Rows():
+    """Rows of a fixed number of values, packed into a single array.
+
+    Holds parsed blocks if numpy is not available. Rows are returned as
+    tuples, just like from a list of tuples, but are stored as plain
+    values of the array typecode, e.g. int32, float32 or float64.
+    """
+    __slots__ = ('data', 'width')
+
+    def __init__(self, typecode, width, values=()):
+        self.data  = array.array(typecode, values)
+        self.width = width
+
+    def append(self, row):
+        self.data.extend(row)
+
+    def __len__(self):
+        return len(self.data) // self.width
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('row index out of range')
+        start = idx * self.width
+        return tuple(self.data[start:start+self.width])
+
+    def __iter__(self):
+        data  = self.data
+        width = self.width
+        for start in range(0, len(data), width):
+            yield tuple(data[start:start+width])
+
+def packed(values, typecode, numVals):
+    """Pack a list of parsed tuples (or values if numVals is 1)."""
+    if numVals == 1:
+        return array.array(typecode, values)
+    rows = Rows(typecode, numVals)
+    for v in values:
+        rows.append(v)
+    return rows
+
+def flatList(values):
+    """Flatten parsed tuples or an array into float32 values for foreach_set."""
+    if isarray(values):
+        return numpy.ascontiguousarray(values, dtype=numpy.float32).ravel()
+    if isinstance(values, Rows):
+        if values.data.typecode == 'f':
+            return values.data
+        return array.array('f', values.data)
+    return array.array('f', [v for t in values for v in t])
+
+def flatTriangles(indices, faces):
+    """Flatten per face index triples (vertex or uv indices) into one index
+    per loop.
+
+    Triangles with vertex index 0 in the last position are rotated, just
+    like bpy_extras.io_utils.unpack_face_list does for tessfaces
+    (eekadoodle), so the vertex order matches earlier imports. The rotation
+    is applied to uv indices as well.
+    """
+    if isarray(faces):
+        loops  = numpy.array(indices, dtype=numpy.int32).reshape(-1, 3)
+        rotate = faces[:, 2] == 0
+        loops[rotate] = loops[rotate][:, [1, 2, 0]]
+        return loops.ravel()
+    loops = array.array('i')
+    for idx, f in zip(indices, faces):
+        if f[2] == 0:
+            loops.extend((idx[1], idx[2], idx[0]))
+        else:
+            loops.extend(idx)
+    return loops
+
+def gather(values, indices):
+    """Return the rows of values at indices, flattened for foreach_set."""
+    if numpy is not None and (isarray(values) or isarray(indices)):
+        if isinstance(values, Rows):
+            values = numpy.array(values.data, dtype=numpy.float32).reshape(-1, values.width)
+        values = numpy.asarray(values, dtype=numpy.float32)
+        return values[numpy.asarray(indices, dtype=numpy.intp)].ravel()
+    flat = array.array('f')
+    for idx in indices:
+        flat.extend(values[idx])
+    return flat
+
+def intBuffer(size):
+    """Return a zeroed int32 buffer for foreach_get."""
+    if numpy is not None:
+        return numpy.zeros(size, dtype=numpy.int32)
+    return array.array('i', bytes(4 * size))
+
+def sharpEdges(loopEdges, smoothGroups, numEdges):
+    """Return a sharp flag per edge for a triangle mesh.
+
+    loopEdges holds the edge index of every loop, three per face. An edge
+    is sharp if the first two faces using it have no smooth group in
+    common.
+    """
+    if numpy is not None:
+        loopEdges = numpy.asarray(loopEdges, dtype=numpy.int64)
+        order     = numpy.argsort(loopEdges, kind='stable')
+        edges     = loopEdges[order]
+        faces     = order // 3
+        # Loops of the same edge are now adjacent, pair each edge's first
+        # loop with its second one
+        first = numpy.ones(len(edges), dtype=bool)
+        first[1:] = edges[1:] != edges[:-1]
+        pairs = numpy.nonzero(first[:-1] & ~first[1:])[0]
+        groups = numpy.asarray(smoothGroups, dtype=numpy.int64)
+        split  = (groups[faces[pairs]] & groups[faces[pairs + 1]]) == 0
+        sharp  = numpy.zeros(numEdges, dtype=bool)
+        sharp[edges[pairs[split]]] = True
+        return sharp
+    sharp     = [False] * numEdges
+    firstFace = [-1] * numEdges
+    paired    = [False] * numEdges
+    for loopIdx, edge in enumerate(loopEdges):
+        face  = loopIdx // 3
+        other = firstFace[edge]
+        if other < 0:
+            firstFace[edge] = face
+        elif not paired[edge]:
+            paired[edge] = True
+            sharp[edge]  = not (smoothGroups[other] & smoothGroups[face])
+    return sharp
+
+def _isNumber(s):
+    try:
+        float(s)
+    except ValueError:
+        return False
+    else:
+        return True
+
+def integer(s):
+    """Convert an ascii integer, which may be written as a float, to an int."""
+    return int(float(s))
+
+def boolean(s):
+    """Convert an ascii flag, e.g. '1' or '1.0', to a bool."""
+    return bool(integer(s))
+
+def countNumeric(asciiBlock):
+    """Count the leading lines of asciiBlock starting with a number."""
+    if isinstance(asciiBlock, Lines):
+        return asciiBlock.countNumeric()
+    for idx, line in enumerate(asciiBlock):
+        if not line or not _isNumber(line[0]):
+            return idx
+    return len(asciiBlock)
+
+def block(asciiBlock, numVals, convert):
+    """Parse a block of numVals float or int values per line.
+
+    Returns a numpy array if possible, otherwise Rows (or an array.array if
+    numVals is 1).
+    """
+    if convert is int:
+        values = iarray(asciiBlock, numVals)
+    else:
+        values = farray(asciiBlock, numVals)
+    if values is not None:
+        return values
+    values = []
+    if convert is int:
+        _i(asciiBlock, values, numVals, initialFloat=False)
+        return packed(values, 'i', numVals)
+    _f(asciiBlock, values, numVals)
+    return packed(values, 'd', numVals)
+
+def _numericRun(asciiBlock):
+    text = '\n'.join([' '.join(line) for line in asciiBlock])
+    values = None
+    if numpy is not None:
+        width  = min(len(line) for line in asciiBlock)
+        values = _array(asciiBlock, width, numpy.float64)
+        if values is not None:
+            values = values.reshape(len(asciiBlock), width)
+    return (text, values)
+
+def prepare(asciiBlock):
+    """Split tokenized lines into plain segments, e.g. to return them from
+    a worker process.
+
+    Every run of lines starting with a number becomes a (text, values)
+    tuple. text holds the lines joined by newlines, values the leading
+    values of every line as a float64 array, None if they don't convert.
+    All other lines are kept as lists of tokens. Lines() turns the
+    segments back into a sequence of lines.
+    """
+    segments = []
+    tokens   = []
+    run      = []
+    for line in asciiBlock:
+        if line and _isNumber(line[0]):
+            if tokens:
+                segments.append(tokens)
+                tokens = []
+            run.append(line)
+        else:
+            if run:
+                segments.append(_numericRun(run))
+                run = []
+            tokens.append(line)
+    if tokens:
+        segments.append(tokens)
+    if run:
+        segments.append(_numericRun(run))
+    return segments
+
+class Lines():
+    """Tokenized lines, made from the segments returned by prepare().
+
+    Behaves like the list of token lists the segments were made from,
+    slices share the segments. Numeric runs are only split into tokens
+    when their lines are accessed, block parsers use the converted values
+    of the run instead, see preparsed().
+    """
+    __slots__ = ('_segments', '_starts', '_start', '_stop')
+
+    def __init__(self, segments=()):
+        self._segments = []  # [text, values, tokens, numLines]
+        self._starts   = []
+        pos = 0
+        for segment in segments:
+            self._starts.append(pos)
+            if isinstance(segment, tuple):
+                text, values = segment
+                numLines = text.count('\n') + 1
+                self._segments.append([text, values, None, numLines])
+            else:
+                numLines = len(segment)
+                self._segments.append([None, None, segment, numLines])
+            pos += numLines
+        self._start = 0
+        self._stop  = pos
+
+    def _locate(self, pos):
+        """Return the index of the segment holding the absolute line pos."""
+        return bisect.bisect_right(self._starts, pos) - 1
+
+    def _tokens(self, segment):
+        if segment[2] is None:
+            segment[2] = [line.split() for line in segment[0].split('\n')]
+        return segment[2]
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            lines = Lines()
+            lines._segments = self._segments
+            lines._starts   = self._starts
+            lines._start    = self._start + start
+            lines._stop     = self._start + max(start, stop)
+            return lines
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('line index out of range')
+        pos = self._start + idx
+        segIdx = self._locate(pos)
+        return self._tokens(self._segments[segIdx])[pos - self._starts[segIdx]]
+
+    def __iter__(self):
+        pos = self._start
+        if pos >= self._stop:
+            return
+        for segIdx in range(self._locate(pos), len(self._segments)):
+            start = self._starts[segIdx]
+            if start >= self._stop:
+                break
+            tokens = self._tokens(self._segments[segIdx])
+            yield from tokens[max(pos, start) - start:self._stop - start]
+
+    def countNumeric(self):
+        """Count the leading lines starting with a number."""
+        if not len(self):
+            return 0
+        segIdx  = self._locate(self._start)
+        segment = self._segments[segIdx]
+        if segment[0] is None:
+            return 0
+        return min(self._starts[segIdx] + segment[3], self._stop) - self._start
+
+    def values(self, numVals):
+        """Return the leading numVals values of all lines as a float64
+        array, if they are part of one converted numeric run."""
+        if not len(self):
+            return None
+        segIdx  = self._locate(self._start)
+        segment = self._segments[segIdx]
+        values  = segment[1]
+        offset  = self._start - self._starts[segIdx]
+        if values is None or offset + len(self) > segment[3] or \
+           values.shape[1] < numVals:
+            return None
+        return numpy.array(values[offset:offset+len(self), :numVals])
+
+def preparsed(asciiBlock, numVals):
+    """Return the values of a block as a (len, numVals) float64 array if
+    it was converted by prepare(), None otherwise."""
+    if numpy is None or not isinstance(asciiBlock, Lines):
+        return None
+    return asciiBlock.values(numVals)
+
+def preparsedRows(asciiBlock, numVals):
+    """Return the values of a block as double Rows if it was converted by
+    prepare(), None otherwise."""
+    values = preparsed(asciiBlock, numVals)
+    if values is None:
+        return None
+    rows = Rows('d', numVals)
+    rows.data.frombytes(values.tobytes())
+    return rows
+
+class RawAscii():
+    """Unparsed ascii lines, preserved for export.
+
+    Lines are collected as they are found and only joined into a single
+    text when it is requested. The text is identical to appending
+    '\\n' + indent + line for every line to the initial text.
+    """
+
+    def __init__(self, text=''):
+        self._head  = text
+        self._lines = []
+        self._text  = text
+
+    def addLine(self, tokens, indent=''):
+        self._lines.append(indent + ' '.join(tokens))
+        self._text = None
+
+    def addLines(self, asciiBlock, indent=''):
+        """Add all non-empty lines of asciiBlock."""
+        self._lines.extend([indent + ' '.join(line) for line in asciiBlock if line])
+        self._text = None
+
+    def text(self):
+        if self._text is None:
+            self._text = self._head + ''.join(['\n' + l for l in self._lines])
+        return self._text
+
+    def __bool__(self):
+        return bool(self._head or self._lines)
+
+    def __len__(self):
+        return len(self.text())
+
+    def __str__(self):
+        return self.text()
 
 def _i(asciiBlock, intList, numVals, initialFloat=True):
     """Parse a float and integers into a numVals tuple into intList"""
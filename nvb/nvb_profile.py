@@ -0,0 +1,204 @@
+"""Timing spans and counters for import and export."""
+import collections
+import json
+import os
+import threading
+import time
+
+
+# Set to profile every import and export. A path ending in .json receives
+# the trace of the last run, a directory one trace file per run.
+ENV_VAR = 'KOTORBLENDER_PROFILE'
+
+# Datablock collections counted before and after a run
+DATABLOCKS = ('objects', 'meshes', 'materials', 'textures', 'images',
+              'actions', 'lamps', 'texts')
+
+# Profiler of the running import or export, None if not profiling
+active = None
+
+
+class NullSpan():
+    '''
+    Span used while not profiling, does nothing.
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+class Span():
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name     = name
+        self.args     = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.events.append((self.name, self.start,
+                                     time.perf_counter() - self.start,
+                                     self.args))
+        return False
+
+
+class Profiler():
+    '''
+    Collects nested timing spans and counters.
+
+    Spans are stored as (name, start, duration, args) in the order they
+    end, nesting is implied by their start and duration.
+    '''
+    def __init__(self, name = ''):
+        self.name     = name
+        self.origin   = time.perf_counter()
+        self.events   = []
+        self.counters = collections.Counter()
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def count(self, name, n = 1):
+        self.counters[name] += n
+
+    def countDatablocks(self, before, after):
+        '''
+        Add the differences of two datablockCounts() to the counters.
+        '''
+        for name, num in after.items():
+            if num != before.get(name, 0):
+                self.counters['new ' + name] += num - before.get(name, 0)
+
+    def totals(self):
+        '''
+        Return (name, calls, total seconds) for every span name, slowest
+        first. Nested spans of the same name are counted once.
+        '''
+        calls   = collections.Counter()
+        seconds = collections.Counter()
+        ends    = dict()
+        for (name, start, duration, args) in sorted(self.events, key=lambda e: e[1]):
+            calls[name] += 1
+            # Skip the time of spans inside another span of the same name
+            if start >= ends.get(name, 0.0):
+                seconds[name] += duration
+                ends[name] = start + duration
+        return sorted(((name, calls[name], seconds[name]) for name in calls),
+                      key=lambda t: -t[2])
+
+    def summary(self, limit = 10):
+        '''
+        Return a list of lines with the slowest spans and all counters.
+        '''
+        lines = ['{}: {:.3f}s'.format(self.name or 'Profile',
+                                      time.perf_counter() - self.origin)]
+        for (name, calls, seconds) in self.totals()[:limit]:
+            lines.append('  {:<24} {:8.3f}s {:6d}x'.format(name, seconds, calls))
+        for name in sorted(self.counters):
+            lines.append('  {:<24} {:8d}'.format(name, self.counters[name]))
+        return lines
+
+    def traceEvents(self):
+        '''
+        Return the spans and counters as Chrome trace events
+        (chrome://tracing, Perfetto, speedscope).
+        '''
+        pid = os.getpid()
+        tid = threading.get_ident()
+        events = []
+        for (name, start, duration, args) in self.events:
+            events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': (start - self.origin) * 1e6,
+                           'dur': duration * 1e6,
+                           'args': {k: str(v) for k, v in args.items()}})
+        events.sort(key=lambda e: e['ts'])
+        if self.counters:
+            events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'tid': tid,
+                           'ts': (time.perf_counter() - self.origin) * 1e6,
+                           'args': dict(self.counters)})
+        return events
+
+    def writeTrace(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.traceEvents(),
+                       'displayTimeUnit': 'ms'}, f)
+
+
+def span(name, **args):
+    '''
+    Return a context manager timing its block as name, if profiling.
+    '''
+    if active is None:
+        return NULL_SPAN
+    return Span(active, name, args)
+
+
+def count(name, n = 1):
+    if active is not None:
+        active.counters[name] += n
+
+
+def datablockCounts(data):
+    '''
+    Return the number of datablocks and keyframes in data (bpy.data).
+    '''
+    counts = {name: len(getattr(data, name)) for name in DATABLOCKS
+              if hasattr(data, name)}
+    counts['keyframes'] = sum(len(fcurve.keyframe_points)
+                              for action in data.actions
+                              for fcurve in action.fcurves)
+    return counts
+
+
+def start(name, enabled = False):
+    '''
+    Start profiling if enabled or requested by the environment variable,
+    return the profiler or None.
+    '''
+    global active
+    if not (enabled or os.environ.get(ENV_VAR)):
+        active = None
+    else:
+        active = Profiler(name)
+    return active
+
+
+def stop(operator = None, filepath = ''):
+    '''
+    Stop profiling, report the summary to operator (or print it) and
+    write the trace if requested by the environment variable.
+    '''
+    global active
+    profiler = active
+    active   = None
+    if profiler is None:
+        return None
+    lines = profiler.summary()
+    for line in lines:
+        print('Kotorblender - ' + line)
+    if operator is not None:
+        operator.report({'INFO'}, '\n'.join(lines))
+
+    tracePath = os.environ.get(ENV_VAR, '')
+    if os.path.isdir(tracePath):
+        tracePath = os.path.join(tracePath, '{}.{}.trace.json'.format(
+            os.path.basename(filepath) or 'kotorblender',
+            profiler.name.lower().replace(' ', '_') or 'profile'))
+    if tracePath.endswith('.json'):
+        try:
+            profiler.writeTrace(tracePath)
+            print('Kotorblender - Trace written to ' + tracePath)
+        except OSError as e:
+            print('Kotorblender - WARNING: Unable to write trace ' +
+                  tracePath + ': ' + str(e))
+    return profiler
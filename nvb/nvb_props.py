@@ -6,6 +6,7 @@ from mathutils import Color
 from . import nvb_def
 from . import nvb_utils
 from . import nvb_txi
+from . import nvb_cache
 
 
 def KB_anim_root_obj_poll(self, object):
@@ -97,6 +98,9 @@ class KB_PG_TEXTURE(bpy.types.PropertyGroup):
         #print(self)
         #print(dir(self))
         #print(dir(context))
+        if nvb_txi.applying:
+            # applyTxi() updates once it is done
+            return
         self.modified_properties.clear()
         for tok in nvb_txi.tokens:
             attr_def = getattr(KB_PG_TEXTURE, tok)[1]
@@ -583,3 +587,76 @@ class KB_PG_OBJECT(bpy.types.PropertyGroup):
     splat = bpy.props.BoolProperty(name="Splat", description="Splat", default = False, options=set())
     inherit_part = bpy.props.BoolProperty(name="Part", description="???", default = False, options=set())
     depth_texture = bpy.props.BoolProperty(name="Use Depth Texture", description="Use Depth Texture", default = False, options=set())
+
+
+# Entries and size in bytes of parse cache directories, by directory.
+# Scanning a directory is slow, it is only done by kb.parse_cache_usage.
+cacheUsage = dict()
+
+
+class KB_AddonPreferences(bpy.types.AddonPreferences):
+    '''
+    Add-on wide settings, shown in the user preferences
+    '''
+    bl_idname = __package__.partition('.')[0]
+
+    useParseCache = bpy.props.BoolProperty(
+        name = 'Cache Parsed Models',
+        description = 'Keep parsed models and walkmeshes on disk, ' \
+                      'unchanged files are imported without parsing them',
+        default = True)
+    parseCacheDir = bpy.props.StringProperty(
+        name = 'Cache Directory',
+        description = 'Directory of the parse cache, ' \
+                      'leave empty for the cache directory of the user',
+        subtype = 'DIR_PATH',
+        default = '')
+    parseCacheSize = bpy.props.IntProperty(
+        name = 'Cache Size (MB)',
+        description = 'Least recently used entries are removed ' \
+                      'above this size',
+        default = 256, min = 1)
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, 'useParseCache')
+        col = layout.column()
+        col.enabled = self.useParseCache
+        col.prop(self, 'parseCacheDir')
+        col.prop(self, 'parseCacheSize')
+        parseCache = nvb_cache.ParseCache(bpy.path.abspath(self.parseCacheDir))
+        usage = cacheUsage.get(parseCache.directory)
+        stats = nvb_cache.stats
+        row = col.row()
+        if usage is None:
+            row.label(text = 'Entries: unknown')
+        else:
+            row.label(text = 'Entries: {}, {:.1f} MB'.format(usage[0], usage[1] / 1048576.0))
+        row.operator('kb.parse_cache_usage', text = '', icon = 'FILE_REFRESH')
+        col.label(text = 'Hits: {}, Misses: {}, Evicted: {}'.format(
+            stats['hits'], stats['misses'], stats['evictions']))
+        col.operator('kb.parse_cache_clear', icon = 'CANCEL')
+
+
+def getPreferences(context):
+    '''
+    Return the add-on preferences, or None if unavailable
+    '''
+    try:
+        return context.user_preferences.addons[KB_AddonPreferences.bl_idname].preferences
+    except (AttributeError, KeyError):
+        return None
+
+
+def getParseCache(context, force = False):
+    '''
+    Return the parse cache configured in the preferences, or None if it is
+    disabled. force returns it regardless of useParseCache.
+    '''
+    prefs = getPreferences(context)
+    if prefs is None:
+        return None
+    if not (prefs.useParseCache or force):
+        return None
+    return nvb_cache.ParseCache(bpy.path.abspath(prefs.parseCacheDir),
+                                prefs.parseCacheSize * 1024 * 1024)
@@ -0,0 +1,226 @@
+"""Locate texture files by name in texture directories."""
+import concurrent.futures
+import hashlib
+import json
+import os
+
+from . import nvb_cache
+from . import nvb_txi
+
+
+TEXTURE_EXTS = ('.tga', '.dds', '.tpc', '.txi')
+
+# Files Blender can load as images, in order of preference
+IMAGE_EXTS = ('.tga', '.dds')
+
+# Bump whenever the layout of persisted indices changes
+INDEX_VERSION = 1
+
+# Locators of this session, by (root, recursive)
+locators = dict()
+
+# Threads reading textures ahead of the import
+PREFETCH_WORKERS = 8
+
+# Bytes read at once when prefetching images
+PREFETCH_CHUNK = 1 << 20
+
+
+class TextureLocator():
+    '''
+    Case insensitive map of texture names (without extension) to the paths
+    of their files, for one texture directory and optionally all of its
+    subdirectories.
+
+    The directory tree is scanned once. refresh() only lists directories
+    whose modification time changed, unchanged ones are merely stat'ed.
+    '''
+    def __init__(self, root, recursive = False):
+        self.root      = os.path.abspath(root)
+        self.recursive = recursive
+        # directory: [mtime_ns, subdirectory names, texture file names]
+        self.dirs      = dict()
+        self.index     = dict()
+        self.changed   = False
+
+    def refresh(self):
+        '''
+        Update the index with the current contents of the directories.
+        '''
+        dirs    = dict()
+        changed = not self.index
+        pending = [self.root]
+        while pending:
+            path = pending.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            entry = self.dirs.get(path)
+            if entry is None or entry[0] != mtime:
+                entry   = self.scanDir(path, mtime)
+                changed = True
+            dirs[path] = entry
+            if self.recursive:
+                pending.extend(os.path.join(path, name) for name in entry[1])
+        if dirs.keys() != self.dirs.keys():
+            changed = True
+        self.dirs = dirs
+        if changed:
+            self.changed = True
+            self.buildIndex()
+
+    @staticmethod
+    def scanDir(path, mtime):
+        subdirs = []
+        files   = []
+        try:
+            for dirEntry in os.scandir(path):
+                # Don't follow links, they may lead into a loop
+                if dirEntry.is_dir(follow_symlinks=False):
+                    subdirs.append(dirEntry.name)
+                elif os.path.splitext(dirEntry.name)[1].lower() in TEXTURE_EXTS:
+                    files.append(dirEntry.name)
+        except OSError:
+            pass
+        subdirs.sort()
+        files.sort()
+        return [mtime, subdirs, files]
+
+    def buildIndex(self):
+        # Files closer to the root win, like a breadth first search
+        index = dict()
+        for path in sorted(self.dirs, key=lambda p: (p.count(os.sep), p)):
+            for filename in self.dirs[path][2]:
+                (name, ext) = os.path.splitext(filename.lower())
+                index.setdefault(name, dict()).setdefault(
+                    ext, os.path.join(path, filename))
+        self.index = index
+
+    def find(self, name, exts = IMAGE_EXTS):
+        '''
+        Return the path of the texture file name with the first of exts
+        found, or None.
+        '''
+        files = self.index.get(name.lower())
+        if files:
+            for ext in exts:
+                if ext in files:
+                    return files[ext]
+        return None
+
+    def indexPath(self, directory):
+        digest = hashlib.sha1(repr((self.root, self.recursive)).encode('utf-8'))
+        return os.path.join(directory, 'textures-' + digest.hexdigest() + '.json')
+
+    def load(self, directory):
+        '''
+        Load the directories scanned by an earlier session, call refresh()
+        afterwards to pick up changes.
+        '''
+        try:
+            with nvb_cache.openPrivate(self.indexPath(directory), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != INDEX_VERSION:
+            return False
+        self.dirs = data['dirs']
+        return True
+
+    def save(self, directory):
+        if not self.changed:
+            return
+        path    = self.indexPath(directory)
+        tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            nvb_cache.makeDirectory(directory)
+            with nvb_cache.createPrivate(tmpPath, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'dirs': self.dirs}, f)
+            os.replace(tmpPath, path)
+        except OSError as e:
+            print('Kotorblender - WARNING: Unable to save texture index ' +
+                  path + ': ' + str(e))
+            return
+        self.changed = False
+
+
+def getLocator(root, recursive = False, refresh = True, directory = ''):
+    '''
+    Return the locator for textures in root, refreshed if refresh is set
+    or it is new. Locators are kept for the session, recursive ones are
+    also persisted in directory (defaults to the parse cache directory) to
+    speed up the first scan.
+    '''
+    key     = (os.path.abspath(root), recursive)
+    locator = locators.get(key)
+    if locator is None:
+        locator = TextureLocator(root, recursive)
+        if recursive:
+            locator.load(directory or nvb_cache.defaultDirectory())
+        locators[key] = locator
+    elif not refresh:
+        return locator
+    locator.refresh()
+    if recursive:
+        locator.save(directory or nvb_cache.defaultDirectory())
+    return locator
+
+
+class Prefetcher():
+    '''
+    Reads the texture files of a model on a thread pool, while the model
+    is still being parsed and imported. File reads release the GIL, so disk
+    and network latency overlap with the import.
+
+    Blender only loads images from files, so image files are read to get
+    them into the file cache of the os and their contents are dropped.
+    Txi files are parsed into their catalogs (see nvb_txi.TxiCatalog).
+    '''
+    def __init__(self, locator, workers = PREFETCH_WORKERS):
+        self.locator  = locator
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.futures  = dict()
+
+    def request(self, name):
+        key = name.lower()
+        if key not in self.futures:
+            self.futures[key] = self.executor.submit(self.fetch, key)
+
+    def fetch(self, name):
+        '''
+        Read the image and txi of texture name, return the txi properties
+        or None.
+        '''
+        imagePath = self.locator.find(name)
+        if imagePath is not None:
+            with open(imagePath, 'rb') as f:
+                while f.read(PREFETCH_CHUNK):
+                    pass
+        txiPath = self.locator.find(name, ('.txi',))
+        if txiPath is None:
+            return None
+        return nvb_txi.getProperties(txiPath)
+
+    def has(self, name):
+        return name.lower() in self.futures
+
+    def wait(self, name):
+        '''
+        Wait until the files of texture name were read, return the
+        properties of its txi or None.
+        '''
+        future = self.futures.get(name.lower())
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except OSError as e:
+            print('Kotorblender - WARNING: Unable to read texture ' + name +
+                  ': ' + str(e))
+            return None
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
@@ -1,13 +1,20 @@
 """TXI texture properties file support"""
-import bpy
-
+import hashlib
+import json
 import os
+import threading
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
 
 from datetime import datetime
 
-# these should probably live in nvb_def sometime,
-# and separate lists is not necessarily a great way to do it,
-# a hash might be better...
+from . import nvb_cache
+
+# these should probably live in nvb_def sometime. The lists keep the order
+# of the properties, lookups go through tokenTypes below.
 tokens = [
     "proceduretype",
     "filter",
@@ -142,6 +149,200 @@ float_tokens = [
     "spacingB"
 ]
 
+
+def toBool(value):
+    lowered = value.lower()
+    if lowered == 'true':
+        return True
+    if lowered == 'false':
+        return False
+    return int(value) >= 1
+
+
+def toColor(values):
+    if len(values) < 3:
+        raise ValueError('specularcolor needs 3 values')
+    return tuple(float(v) for v in values[:3])
+
+
+# Converter of the value of every token, bool wins over int and float
+# for tokens in more than one list
+tokenTypes = dict.fromkeys(tokens, str)
+tokenTypes.update(dict.fromkeys(float_tokens, float))
+tokenTypes.update(dict.fromkeys(int_tokens, int))
+tokenTypes.update(dict.fromkeys(bool_tokens, toBool))
+
+# Tokens as they appear in files, by lower case name
+tokenNames = {token.lower(): token for token in tokens}
+
+# Tokens followed by a count and that many lines of values
+LIST_TOKENS = frozenset(['channelscale', 'channeltranslate'])
+
+# Bump whenever the layout of persisted catalogs changes
+CATALOG_VERSION = 1
+
+# Catalogs of this session, by directory
+catalogs     = dict()
+catalogsLock = threading.Lock()
+
+# Set while applyTxi() sets properties, to skip their update callbacks
+applying = False
+
+
+def parseTxi(lines):
+    '''
+    Return the properties in the lines of a txi file as a list of
+    (token, value), with values converted to the types of their properties.
+    Unknown tokens and invalid values are skipped.
+    '''
+    asciiLines = [line.split() for line in lines]
+    properties = []
+    for line_idx, line in enumerate(asciiLines):
+        if len(line) < 2:
+            continue
+        token = tokenNames.get(line[0].lower())
+        if token is None:
+            continue
+        try:
+            if token == 'specularcolor':
+                properties.append((token, toColor(line[1:])))
+            elif token in LIST_TOKENS:
+                count = int(line[1])
+                values = [(token + str(i), float(asciiLines[line_idx + 1 + i][0]))
+                          for i in range(count)]
+                properties.append((token, count))
+                properties.extend(values)
+            else:
+                properties.append((token, tokenTypes[token](line[1])))
+        except (ValueError, IndexError):
+            pass
+    return properties
+
+
+class TxiCatalog():
+    '''
+    Parsed txi files of one directory.
+
+    Every file is parsed once and its properties kept with its modification
+    time and size, so it is only parsed again after it changed. Catalogs are
+    persisted, later sessions start with the files parsed by earlier ones.
+    '''
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        # file name: [mtime_ns, size, properties]
+        self.records   = dict()
+        self.changed   = False
+
+    def get(self, filename):
+        '''
+        Return the properties of txi file filename, or None if it doesn't
+        exist or can't be read.
+        '''
+        path = os.path.join(self.directory, filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        record = self.records.get(filename)
+        if record is None or record[0] != st.st_mtime_ns or record[1] != st.st_size:
+            try:
+                with open(os.fsencode(path), 'r') as f:
+                    properties = parseTxi(f)
+            except (OSError, UnicodeDecodeError) as e:
+                print('Kotorblender - WARNING: Unable to read ' + path +
+                      ': ' + str(e))
+                return None
+            record = [st.st_mtime_ns, st.st_size, properties]
+            self.records[filename] = record
+            self.changed = True
+        return record[2]
+
+    def catalogPath(self, directory):
+        digest = hashlib.sha1(self.directory.encode('utf-8', 'surrogateescape'))
+        return os.path.join(directory, 'txi-' + digest.hexdigest() + '.json')
+
+    def load(self, directory):
+        try:
+            with nvb_cache.openPrivate(self.catalogPath(directory), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != CATALOG_VERSION:
+            return False
+        self.records = {filename: [mtime, size, [tuple(p) for p in properties]]
+                        for (filename, (mtime, size, properties))
+                        in data['records'].items()}
+        return True
+
+    def save(self, directory):
+        if not self.changed:
+            return
+        path    = self.catalogPath(directory)
+        tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            nvb_cache.makeDirectory(directory)
+            with nvb_cache.createPrivate(tmpPath, 'w') as f:
+                json.dump({'version': CATALOG_VERSION,
+                           'records': self.records}, f)
+            os.replace(tmpPath, path)
+        except OSError as e:
+            print('Kotorblender - WARNING: Unable to save txi catalog ' +
+                  path + ': ' + str(e))
+            return
+        self.changed = False
+
+
+def getCatalog(directory, cacheDirectory = ''):
+    '''
+    Return the catalog of txi files in directory. Safe to call from
+    several threads.
+    '''
+    directory = os.path.abspath(directory)
+    with catalogsLock:
+        catalog = catalogs.get(directory)
+        if catalog is None:
+            catalog = TxiCatalog(directory)
+            catalog.load(cacheDirectory or nvb_cache.defaultDirectory())
+            catalogs[directory] = catalog
+    return catalog
+
+
+def getProperties(filepath):
+    '''
+    Return the properties of the txi file filepath, or None.
+    '''
+    (directory, filename) = os.path.split(os.fsdecode(filepath))
+    return getCatalog(directory).get(filename)
+
+
+def saveCatalogs(cacheDirectory = ''):
+    '''
+    Persist the catalogs which parsed new files.
+    '''
+    with catalogsLock:
+        for catalog in catalogs.values():
+            catalog.save(cacheDirectory or nvb_cache.defaultDirectory())
+
+
+def applyTxi(imagetexture, properties):
+    '''
+    Set the txi properties of imagetexture. The list of modified properties
+    is updated once, not for every property set.
+    '''
+    global applying
+    props = imagetexture.nvb
+    applying = True
+    try:
+        for (token, value) in properties:
+            try:
+                setattr(props, token, value)
+            except (TypeError, ValueError, AttributeError):
+                pass
+    finally:
+        applying = False
+    props.prop_update(None)
+
+
 def loadTxi(imagetexture, operator=None):
     try:
         filepath = imagetexture.image.filepath
@@ -155,42 +356,11 @@ def loadTxi(imagetexture, operator=None):
     else:
         return False
 
-    fp = os.fsencode(filepath)
-    asciiLines = [line.strip().split() for line in open(fp, 'r')]
+    properties = getProperties(filepath)
+    if properties is None:
+        return False
+    applyTxi(imagetexture, properties)
 
-    for line_idx, line in enumerate(asciiLines):
-        try:
-            if line[0] in tokens:
-                value = line[1]
-                # special types
-                if line[0] == 'specularcolor':
-                    value = (line[1], line[2], line[3])
-                elif line[0] == 'channelscale':
-                    for scale_counter in range(0,int(line[1])):
-                        setattr(imagetexture.nvb,
-                                'channelscale' + str(scale_counter),
-                                asciiLines[line_idx + 1 + scale_counter][0])
-                elif line[0] == 'channeltranslate':
-                    for scale_counter in range(0,int(line[1])):
-                        setattr(imagetexture.nvb,
-                                'channeltranslate' + str(scale_counter),
-                                asciiLines[line_idx + 1 + scale_counter][0])
-                # the generalized types
-                elif line[0] in bool_tokens:
-                    if value == 'TRUE' or value == 'true' or int(value) >= 1:
-                        value = True
-                    else:
-                        value = False
-                elif line[0] in int_tokens:
-                    value = int(value)
-                elif line[0] in float_tokens:
-                    value = float(value)
-                setattr(imagetexture.nvb, line[0], value)
-                print(line[0])
-                print(getattr(imagetexture.nvb, line[0]))
-        except:
-            pass
-    
     if operator is not None:
         operator.report({'INFO'}, "Imported {}".format(os.path.basename(filepath)))
 
@@ -1,8 +1,12 @@
 ﻿import math
-import mathutils
-import bpy
 import os
 
+try:
+    import bpy
+    import mathutils
+except ImportError:
+    bpy = mathutils = None
+
 from . import nvb_def
 
 
@@ -473,6 +477,31 @@ def euler2nwangle(eul):
     return [q.axis[0], q.axis[1], q.axis[2], q.angle]
 
 
+def quat2nwangle(quat):
+    '''
+    Convert a quaternion (x, y, z, w), as stored in binary mdls, to the axis
+    angle format used by ascii mdls, [X, Y, Z, Angle]
+    '''
+    x, y, z, w = quat
+    w = max(-1.0, min(1.0, w))
+    s = math.sqrt(1.0 - w*w)
+    if s < 0.000001:
+        return [0.0, 0.0, 0.0, 0.0]
+    return [x/s, y/s, z/s, 2.0*math.acos(w)]
+
+
+def nwangle2quat(nwangle):
+    '''
+    Convert an axis angle [X, Y, Z, Angle] to a quaternion (x, y, z, w)
+    '''
+    x, y, z, angle = nwangle
+    length = math.sqrt(x*x + y*y + z*z)
+    if length < 0.000001:
+        return (0.0, 0.0, 0.0, 1.0)
+    s = math.sin(angle/2.0) / length
+    return (x*s, y*s, z*s, math.cos(angle/2.0))
+
+
 def nwangle2euler(nwangle):
     q = mathutils.Quaternion((nwangle[0], nwangle[1], nwangle[2]), nwangle[3])
     return q.to_euler()
@@ -0,0 +1 @@
+"""Tests for the parts of the add-on which run without Blender."""
@@ -0,0 +1,124 @@
+"""Run the headless benchmark scenarios on a small corpus.
+
+Keeps the parsers, the binary writers and the walkmesh export working on
+every kind of file the benchmark generates.
+"""
+import os
+
+import pytest
+
+from .. import bench
+from ..bench import corpus
+from ..bench import scenarios
+from ..nvb import nvb_binmdl
+from ..nvb import nvb_index
+from ..nvb import nvb_mdl
+from ..nvb import nvb_node
+
+
+SCALE = 0.05
+
+
+@pytest.fixture(scope='module')
+def corpusPaths(tmp_path_factory):
+    scenarios.prepare()
+    return corpus.generate(str(tmp_path_factory.mktemp('corpus')), scale=SCALE)
+
+
+def meshNodes(mdl):
+    return {key: node for key, node in mdl.nodeDict.items()
+            if isinstance(node, nvb_node.Trimesh)}
+
+
+@pytest.mark.parametrize('name, scenario, extensions', scenarios.SCENARIOS,
+                         ids=[entry[0] for entry in scenarios.SCENARIOS])
+def test_scenario(corpusPaths, name, scenario, extensions):
+    paths = [p for p in corpusPaths if os.path.splitext(p)[1] in extensions]
+    assert paths
+    for path in paths:
+        scenario(path)()
+
+
+def test_index_matches_ascii(corpusPaths):
+    for path in corpusPaths:
+        if not path.endswith('.mdl'):
+            continue
+        streamed = scenarios.loadAscii(path)
+        mdlIndex = nvb_index.MdlIndex(path)
+        try:
+            indexed = nvb_mdl.Mdl()
+            indexed.loadAsciiIndex(mdlIndex)
+        finally:
+            mdlIndex.close()
+        assert sorted(indexed.nodeDict) == sorted(streamed.nodeDict)
+        assert sorted(indexed.animDict) == sorted(streamed.animDict)
+        assert [n.name for n in indexed.mdlnodes] == [n.name for n in streamed.mdlnodes]
+        assert [a.name for a in indexed.animations] == [a.name for a in streamed.animations]
+        for key, node in meshNodes(streamed).items():
+            other = indexed.nodeDict[key]
+            assert len(other.verts) == len(node.verts)
+            assert len(other.facelist.faces) == len(node.facelist.faces)
+
+
+def test_binary_round_trip(corpusPaths):
+    for path in corpusPaths:
+        if not path.endswith('.mdl'):
+            continue
+        source = scenarios.loadAscii(path)
+        mdlData, mdxData = nvb_binmdl.MdlWriter(source).write()
+        binary = nvb_mdl.Mdl()
+        binary.loadBinary(mdlData, mdxData)
+        assert sorted(binary.nodeDict) == sorted(source.nodeDict)
+        assert sorted(binary.animDict) == sorted(source.animDict)
+        binaryMeshes = meshNodes(binary)
+        for key, node in meshNodes(source).items():
+            other = binaryMeshes[key]
+            assert len(other.facelist.faces) == len(node.facelist.faces)
+            # Vertices are only split, never lost
+            assert len(node.verts) <= len(other.verts) <= 0xFFFF
+
+
+@pytest.mark.skipif(nvb_binmdl.numpy is None, reason='needs numpy')
+def test_mesh_vertices_without_numpy(corpusPaths, monkeypatch):
+    path = next(p for p in corpusPaths if p.endswith('bench_char.mdl'))
+    source = scenarios.loadAscii(path)
+    writer = nvb_binmdl.MdlWriter(source)
+    for node in meshNodes(source).values():
+        faces, sources, normals = writer.getMeshVertices(node)
+        with monkeypatch.context() as patch:
+            patch.setattr(nvb_binmdl, 'numpy', None)
+            fallback = writer.getMeshVertices(node)
+        assert fallback[0] == faces
+        assert fallback[1] == sources
+        assert fallback[2] == pytest.approx(normals)
+
+
+def test_run(corpusPaths):
+    directory = os.path.dirname(corpusPaths[0])
+    results = bench.run(directory, repeat=1, verbose=False)['results']
+    expected = {name + '/' + os.path.basename(path)
+                for name, _, extensions in scenarios.SCENARIOS
+                for path in corpusPaths
+                if os.path.splitext(path)[1] in extensions}
+    assert set(results) == expected
+
+
+
+def test_index_add_node(corpusPaths):
+    path = next(p for p in corpusPaths if p.endswith('bench_super.mdl'))
+    mdlIndex = nvb_index.MdlIndex(path)
+    try:
+        mdl = nvb_mdl.Mdl()
+        mdl.loadAsciiIndex(mdlIndex)
+        numNodes = len(mdl.mdlnodes)
+        node = nvb_node.Dummy('extra')
+        node.parentName = mdl.name
+        mdl.addNode(node)
+        assert len(mdl.mdlnodes) == numNodes + 1
+        assert mdl.mdlnodes[-1] is node
+        anim = mdl.animations[0]
+        mdl.addAnimation(anim)  # name conflict, not added again
+        assert len(mdl.animDict) == len(mdl.animations)
+        assert mdl.animDict[mdl.animKey(anim.name.upper())] is anim
+    finally:
+        mdlIndex.close()
@@ -0,0 +1,91 @@
+"""Tokenizing blocks in worker processes gives the same models as parsing
+them in a single process."""
+import pytest
+
+from ..bench import corpus
+from ..bench import scenarios
+from ..nvb import nvb_index
+from ..nvb import nvb_mdl
+from ..nvb import nvb_parse
+
+
+LINES = [['node', 'trimesh', 'body'],
+         ['verts', '3'],
+         ['0.0', '1.0', '2.0'],
+         ['3.0', '4.0', '5.0', 'extra'],
+         ['6', '7', '8'],
+         ['faces', '1'],
+         ['0', '1', '2', '1', '0', '1', '2', '1'],
+         ['endnode']]
+
+
+def test_lines_behave_like_a_list():
+    lines = nvb_parse.Lines(nvb_parse.prepare(LINES))
+    assert len(lines) == len(LINES)
+    assert list(lines) == LINES
+    assert [lines[i] for i in range(-len(LINES), len(LINES))] == LINES + LINES
+    for start in range(len(LINES) + 1):
+        for stop in range(len(LINES) + 1):
+            assert list(lines[start:stop]) == LINES[start:stop]
+            assert nvb_parse.countNumeric(lines[start:stop]) == \
+                nvb_parse.countNumeric(LINES[start:stop])
+    assert list(lines[1:7][1:3]) == LINES[2:4]
+    with pytest.raises(IndexError):
+        lines[len(LINES)]
+
+
+@pytest.mark.skipif(nvb_parse.numpy is None, reason='needs numpy')
+def test_lines_preparsed_values():
+    lines = nvb_parse.Lines(nvb_parse.prepare(LINES))
+    verts = nvb_parse.block(lines[2:5], 3, float)
+    assert verts.tolist() == nvb_parse.block(LINES[2:5], 3, float).tolist()
+    assert nvb_parse.preparsed(lines[2:5], 3) is not None
+    assert nvb_parse.preparsed(lines[2:5], 4) is None   # short lines
+    assert nvb_parse.preparsed(lines[1:5], 3) is None   # not numeric
+    assert nvb_parse.preparsed(lines[3:4], 3).tolist() == [[3.0, 4.0, 5.0]]
+
+
+@pytest.fixture(scope='module')
+def corpusPaths(tmp_path_factory):
+    scenarios.prepare()
+    return corpus.generate(str(tmp_path_factory.mktemp('corpus')), scale=0.05)
+
+
+def plain(values):
+    if nvb_parse.isarray(values):
+        return values.tolist()
+    return [list(v) if isinstance(v, tuple) else v for v in values]
+
+
+def loadIndexed(path, workers):
+    mdlIndex = nvb_index.MdlIndex(path)
+    try:
+        mdl = nvb_mdl.Mdl()
+        warning = mdl.loadAsciiIndex(mdlIndex, workers)
+        nodes = dict(mdl.nodeDict)
+        anims = dict(mdl.animDict)
+    finally:
+        mdlIndex.close()
+    return warning, nodes, anims
+
+
+def test_parallel_matches_serial(corpusPaths):
+    path = next(p for p in corpusPaths if p.endswith('bench_char.mdl'))
+    _, nodes, anims = loadIndexed(path, 0)
+    warning, parallelNodes, parallelAnims = loadIndexed(path, 2)
+    assert warning is None
+    assert list(parallelNodes) == list(nodes)
+    assert sorted(parallelAnims) == sorted(anims)
+    for key, node in nodes.items():
+        other = parallelNodes[key]
+        assert type(other) is type(node)
+        assert other.rawascii == node.rawascii
+        for attr in ('verts', 'tverts', 'weights', 'constraints'):
+            if hasattr(node, attr):
+                assert plain(getattr(other, attr)) == plain(getattr(node, attr))
+    for key, anim in anims.items():
+        other = parallelAnims[key]
+        assert [n.name for n in other.nodes] == [n.name for n in anim.nodes]
+        for node, otherNode in zip(anim.nodes, other.nodes):
+            for name, (rows, _, _) in node.object_data.items():
+                assert otherNode.object_data[name][0].data == rows.data